@@ -0,0 +1,334 @@
+"""
+Catalog of all backups of a destination. The file backup_catalog.json in the destination holds one entry per backup
+folder (time, strategy, info file, size, status and the backup folders it references), so finding the latest backup,
+the info file of a backup or the backups to delete does not need to scan the destination. Old backups are thinned
+out by a retention policy (keep last/daily/weekly/monthly) and deleted in a background thread.
+"""
+
+import os
+import json
+import shutil
+import logging
+import threading
+import concurrent.futures
+from datetime import datetime
+
+logger = logging.getLogger()
+
+catalog_filename = "backup_catalog.json"
+deleting_prefix = ".deleting_"  # backup folders are renamed to this prefix before they get deleted
+time_format = "%Y%m%d_%H%M%S"
+default_retention = {"keep_last": 3, "keep_daily": 0, "keep_weekly": 0, "keep_monthly": 0}
+delete_workers = 8
+
+_lock = threading.RLock()
+_pruning_jobs = {}  # running and finished background deletions per destination, see wait_for_pruning
+
+
+def _find_info_file(folder_path: str):
+    for entry in sorted(os.listdir(folder_path)):
+        if "backup_information" in entry and os.path.isfile(os.path.join(folder_path, entry)):
+            return entry
+    return None
+
+
+def get_references(info_dict: dict):
+    """
+    Returns the names of all backup folders that hold data of unchanged items of the given backup
+    """
+    references = set()
+    for prefix in ["file", "folder"]:
+        for item_info in info_dict.get(f"found_{prefix}s", []):
+            if item_info.get(f"{prefix}_backup_reference") is not None:
+                references.add(item_info[f"{prefix}_backup_reference"])
+    return sorted(references)
+
+
+def new_entry(folder: str, status: str = "running", info_dict: dict = None, info_file: str = None):
+    """
+    Returns a catalog entry for a backup folder, filled from its info dict if given
+    """
+    entry = {"folder": folder, "status": status, "start_time": datetime.now().strftime(time_format),
+             "end_time": None, "strategy": None, "info_file": info_file, "file_manifest": None,
+             "size_in_bytes": None, "references": []}
+    if info_dict is not None:
+        totals = info_dict.get("metrics", {}).get("totals", {})
+        entry.update({"start_time": info_dict.get("start_time") or entry["start_time"],
+                      "end_time": info_dict.get("end_time"),
+                      "strategy": info_dict.get("strategy"),
+                      "size_in_bytes": totals.get("bytes_written"),
+                      "file_manifest": info_dict.get("file_manifest"),
+                      "references": get_references(info_dict)})
+    return entry
+
+
+def rebuild_catalog(backup_path: str):
+    """
+    Creates the catalog by scanning all backup folders of the destination. Only needed once for destinations with
+    backups of older versions, afterwards the catalog is kept up to date by every backup.
+
+    Returns
+    -------
+    catalog: dict
+        catalog with one entry per backup folder
+    """
+    catalog = {"backups": {}}
+    for folder in sorted(os.listdir(backup_path)):
+        folder_path = os.path.join(backup_path, folder)
+        if not os.path.isdir(folder_path) or "backup" not in folder or folder.startswith(deleting_prefix):
+            continue
+        info_file = _find_info_file(folder_path)
+        if info_file is None:
+            catalog["backups"][folder] = new_entry(folder, status="incomplete")
+            continue
+        with open(os.path.join(folder_path, info_file), "r", encoding="utf-8") as f:
+            info_dict = json.load(f)
+        catalog["backups"][folder] = new_entry(folder, status="complete", info_dict=info_dict, info_file=info_file)
+    logger.debug(f"Catalog of {backup_path} rebuilt with {len(catalog['backups'])} backups")
+    return catalog
+
+
+def load_catalog(backup_path: str):
+    """
+    Loads the catalog of a destination, creates it with rebuild_catalog if it does not exist yet.
+    Entries of backup folders that were deleted by hand are dropped.
+
+    Parameters
+    ----------
+    backup_path: str
+        path to folder where backups get stored
+
+    Returns
+    -------
+    catalog: dict
+        dict with key "backups": catalog entry per backup folder name
+    """
+    with _lock:
+        catalog_path = os.path.join(backup_path, catalog_filename)
+        if not os.path.isfile(catalog_path):
+            catalog = rebuild_catalog(backup_path)
+            save_catalog(backup_path, catalog)
+            return catalog
+        with open(catalog_path, "r", encoding="utf-8") as f:
+            catalog = json.load(f)
+        for folder in list(catalog["backups"]):
+            if not os.path.isdir(os.path.join(backup_path, folder)) \
+                    and not os.path.isdir(os.path.join(backup_path, deleting_prefix + folder)):
+                del catalog["backups"][folder]
+        return catalog
+
+
+def save_catalog(backup_path: str, catalog: dict):
+    """
+    Writes the catalog to a temp file and renames it, so a crash never leaves a half written catalog
+    """
+    with _lock:
+        catalog_path = os.path.join(backup_path, catalog_filename)
+        tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(catalog, f, indent=4)
+        os.replace(tmp_path, catalog_path)
+
+
+def update_entry(backup_path: str, folder: str, entry: dict = None):
+    """
+    Stores (or removes if entry is None) the entry of a backup folder in the catalog
+    """
+    with _lock:
+        catalog = load_catalog(backup_path)
+        if entry is None:
+            catalog["backups"].pop(folder, None)
+        else:
+            catalog["backups"][folder] = entry
+        save_catalog(backup_path, catalog)
+
+
+def get_latest_backup(catalog: dict):
+    """
+    Returns the entry of the latest complete backup, None if there is none
+    """
+    complete = [entry for entry in catalog["backups"].values() if entry["status"] == "complete"]
+    if len(complete) == 0:
+        return None
+    return max(complete, key=lambda entry: (entry["start_time"], entry["folder"]))
+
+
+def get_info_file_path(backup_path: str, folder: str):
+    """
+    Returns the path to the info file of a backup folder from the catalog, None if the folder is not cataloged
+    """
+    catalog_path = os.path.join(backup_path, catalog_filename)
+    if not os.path.isfile(catalog_path):
+        return None
+    entry = load_catalog(backup_path)["backups"].get(folder)
+    if entry is None or entry.get("info_file") is None:
+        return None
+    return os.path.join(backup_path, folder, entry["info_file"])
+
+
+def select_backups_to_delete(catalog: dict, retention: dict = None, now: datetime = None):
+    """
+    Applies a retention policy to the complete backups of a catalog. The backup about to be created counts as the
+    newest one (at now). A backup is kept if one of the rules keeps it:
+    keep_last keeps the newest backups, keep_daily/keep_weekly/keep_monthly keep the newest backup of each of the
+    latest days/weeks/months that have a backup. Backups referenced by kept backups are kept as well. Incomplete
+    backups are deleted once a newer complete backup exists.
+
+    Parameters
+    ----------
+    catalog: dict
+        result of load_catalog
+    retention: dict
+        numbers for the rules of default_retention, missing rules use the default
+    now: datetime
+        time of the new backup, current time if None
+
+    Returns
+    -------
+    to_delete: list
+        names of the backup folders to delete
+    """
+    retention = {**default_retention, **{key: value for key, value in (retention or {}).items()
+                                         if value is not None}}
+    now = now or datetime.now()
+    backups = catalog["backups"]
+    complete = sorted([entry for entry in backups.values() if entry["status"] == "complete"],
+                      key=lambda entry: (entry["start_time"], entry["folder"]), reverse=True)
+    # None stands for the new backup
+    candidates = [(now, None)] + [(datetime.strptime(entry["start_time"], time_format), entry["folder"])
+                                  for entry in complete]
+
+    keep = set(folder for _, folder in candidates[:max(retention["keep_last"], 1)])
+    for rule, period in [("keep_daily", lambda t: t.date()), ("keep_weekly", lambda t: t.isocalendar()[:2]),
+                         ("keep_monthly", lambda t: (t.year, t.month))]:
+        periods = []
+        for backup_time, folder in candidates:
+            if len(periods) >= retention[rule]:
+                break
+            if period(backup_time) not in periods:
+                periods.append(period(backup_time))
+                keep.add(folder)
+
+    # referenced backups hold data of kept backups, references of references are already direct references
+    for folder in list(keep):
+        if folder is not None:
+            keep.update(backups[folder].get("references", []))
+
+    newest_complete = complete[0]["start_time"] if complete else None
+    to_delete = [entry["folder"] for entry in complete if entry["folder"] not in keep]
+    to_delete += [entry["folder"] for entry in backups.values()
+                  if entry["status"] in ["running", "incomplete"] and newest_complete is not None
+                  and entry["start_time"] < newest_complete]
+    return to_delete
+
+
+def _delete_tree(path: str, workers: int = delete_workers):
+    """
+    Deletes a folder with its top-level entries in parallel
+    """
+    with os.scandir(path) as it:
+        entries = [(entry.path, entry.is_dir(follow_symlinks=False)) for entry in it]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda e: shutil.rmtree(e[0]) if e[1] else os.remove(e[0]), entries))
+    os.rmdir(path)
+
+
+def _delete_folders(backup_path: str, job: dict):
+    """
+    Deletes the renamed folders of a deletion job. A folder that can not be deleted is logged and marked as
+    "delete_failed" in the catalog, it keeps its deleting name and is deleted again by the next run.
+    """
+    for folder in job["folders"]:
+        logger.debug(f"Delete backup folder {folder}")
+        try:
+            _delete_tree(os.path.join(backup_path, deleting_prefix + folder))
+            update_entry(backup_path, folder, None)
+            job["deleted"].append(folder)
+        except Exception as e:
+            logger.error(f"Could not delete backup folder {folder} of {backup_path}: {e}. Retried by the next run.")
+            job["failed"].append(folder)
+            try:
+                with _lock:
+                    catalog = load_catalog(backup_path)
+                    if folder in catalog["backups"]:
+                        catalog["backups"][folder]["status"] = "delete_failed"
+                        save_catalog(backup_path, catalog)
+            except Exception as e:
+                logger.error(f"Could not mark backup folder {folder} of {backup_path} as delete_failed: {e}")
+    logger.debug(f"Deleted {len(job['deleted'])} of {len(job['folders'])} backup folders of {backup_path}")
+
+
+def delete_backups(backup_path: str, folders: list, background: bool = True):
+    """
+    Deletes backup folders. Every folder is renamed first (instant), so it is out of the way of the new backup, and
+    marked as "deleting" in the catalog. The slow deletion of the trees runs in parallel, in a background thread
+    if background is True (see wait_for_pruning). Leftovers of interrupted or failed deletions are deleted as well,
+    unless a running deletion of the destination still works on them.
+
+    Parameters
+    ----------
+    backup_path: str
+        path to folder where backups get stored
+    folders: list
+        names of the backup folders to delete
+    background: bool
+        return immediately and delete in a background thread
+
+    Returns
+    -------
+    job: dict
+        "folders" to delete, "deleted" and "failed" folders (filled when the deletion is done) and the background
+        "thread" (None if deleted in the foreground). None if there is nothing to delete
+    """
+    renamed = []
+    with _lock:
+        catalog = load_catalog(backup_path)
+        for folder in folders:
+            folder_path = os.path.join(backup_path, folder)
+            if os.path.isdir(folder_path):
+                os.rename(folder_path, os.path.join(backup_path, deleting_prefix + folder))
+                renamed.append(folder)
+            if folder in catalog["backups"]:
+                catalog["backups"][folder]["status"] = "deleting"
+        save_catalog(backup_path, catalog)
+
+        # leftovers of an interrupted deletion are deleted as well, but not the folders of running deletions
+        running = {folder for job in _pruning_jobs.get(os.path.normpath(backup_path), [])
+                   if job["thread"].is_alive() for folder in job["folders"]}
+        leftovers = [entry[len(deleting_prefix):] for entry in os.listdir(backup_path)
+                     if entry.startswith(deleting_prefix) and entry[len(deleting_prefix):] not in renamed
+                     and entry[len(deleting_prefix):] not in running]
+        if len(renamed) + len(leftovers) == 0:
+            return None
+        job = {"folders": renamed + leftovers, "deleted": [], "failed": [], "thread": None}
+        if background:
+            # registered before the lock is released, so a parallel call does not take the same leftovers
+            job["thread"] = threading.Thread(target=_delete_folders, args=(backup_path, job),
+                                             name=f"pruning {backup_path}")
+            _pruning_jobs.setdefault(os.path.normpath(backup_path), []).append(job)
+            job["thread"].start()
+
+    if not background:
+        _delete_folders(backup_path, job)
+    return job
+
+
+def wait_for_pruning(backup_path: str):
+    """
+    Waits until all background deletions of the destination are finished
+
+    Returns
+    -------
+    result: dict
+        "deleted" and "failed" backup folders of the finished deletions
+    """
+    with _lock:
+        jobs = _pruning_jobs.pop(os.path.normpath(backup_path), [])
+    result = {"deleted": [], "failed": []}
+    for job in jobs:
+        job["thread"].join()
+        result["deleted"] += job["deleted"]
+        result["failed"] += job["failed"]
+    if result["failed"]:
+        logger.warning(f"Backup folders {result['failed']} of {backup_path} could not be deleted")
+    return result
@@ -0,0 +1,144 @@
+"""
+Checkpoints of a running backup, so an interrupted backup can be resumed instead of started again. Every item is
+written to a temp name (partial_prefix + item) and renamed when it is complete, so a partial output is never taken
+for a complete one. After the rename the item and the exact path of its output are appended to the journal file of
+the backup folder (one JSON line, fsynced). Only these recorded paths are renamed or removed, never the outputs of
+sibling items with similar names (e.g. "a" and "a.zip"). The next run of the same backup skips all items of the
+journal whose source did not change and whose outputs exist. The journal is removed when the backup is complete.
+"""
+
+import os
+import json
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger()
+
+journal_filename = "backup_journal.jsonl"
+partial_prefix = ".partial_"
+
+
+def get_partial_path(dst: str, item: str):
+    """
+    Returns the temp path an item is written to before it is complete
+    """
+    return os.path.join(dst, partial_prefix + item)
+
+
+def remove_output(path: str):
+    """
+    Removes one output of an item (copied file/folder, archive or manifest), e.g. the leftover of an interrupted run
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def commit_output(partial_path: str, path: str):
+    """
+    Renames the output of a complete item from the temp name to the final name
+
+    Parameters
+    ----------
+    partial_path: str
+        exact path the backup method wrote, see get_partial_path
+    path: str
+        final path of the output
+
+    Returns
+    -------
+    output: str
+        file name of the final output, recorded in the journal
+    """
+    os.replace(partial_path, path)
+    return os.path.basename(path)
+
+
+def clean_partial_outputs(folder: str):
+    """
+    Removes the temp outputs of items that were not finished by an interrupted run
+    """
+    for entry in os.listdir(folder):
+        if entry.startswith(partial_prefix):
+            path = os.path.join(folder, entry)
+            remove_output(path)
+            logger.debug(f"Removed partial output {path}")
+
+
+def has_journal(folder: str):
+    return os.path.isfile(os.path.join(folder, journal_filename))
+
+
+class BackupJournal:
+    """
+    Journal of the complete items of a backup folder. Thread-safe, items of parallel workers can be recorded.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = os.path.join(folder, journal_filename)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a run that died while writing it
+                        continue
+                    self.entries[entry["item"]] = entry
+            logger.debug(f"Journal {self.path} holds {len(self.entries)} complete items")
+        else:
+            open(self.path, "a").close()
+
+    def get_done(self, item: str, fingerprint: str, method: str):
+        """
+        Returns the journal entry of an item if it is complete for the given source fingerprint and backup method
+        and all its outputs exist, else None
+        """
+        entry = self.entries.get(item)
+        if entry is None or entry["fingerprint"] != fingerprint or entry["method"] != method:
+            return None
+        if not all(os.path.lexists(os.path.join(self.folder, output)) for output in entry["outputs"]):
+            return None
+        return entry
+
+    def get_recorded_outputs(self, item: str):
+        """
+        Returns the paths of the outputs recorded for an item, e.g. written by an interrupted run with other settings
+        """
+        entry = self.entries.get(item)
+        if entry is None:
+            return []
+        return [os.path.join(self.folder, output) for output in entry["outputs"]]
+
+    def record(self, item: str, fingerprint: str, method: str, hash: str, outputs: list):
+        """
+        Appends a complete item to the journal and syncs it to disk
+        """
+        entry = {"item": item, "fingerprint": fingerprint, "method": method, "hash": hash, "outputs": outputs}
+        with self.lock:
+            self.entries[item] = entry
+            # opened per item, so nothing has to be closed if the backup fails
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def finish(self):
+        """
+        Removes the journal when the backup is complete
+        """
+        with self.lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+
+def open_journal(folder: str):
+    """
+    Opens the journal of a backup folder, creates it if it does not exist
+    """
+    return BackupJournal(folder)
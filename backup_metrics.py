@@ -0,0 +1,243 @@
+"""
+Timing and throughput metrics of a backup. The metrics are collected per phase (scan, size, hash, copy, compress,
+write manifest) and per item, written into the info dict and optionally exported as Prometheus textfile or as line
+in a JSON-lines file. Items processed in parallel add up their time in "phases_in_s" (thread time), "phases_wall_s"
+holds the wall-clock time in which at least one thread worked on the phase.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger()
+
+phases = ["scan", "size", "compare", "hash", "copy", "compress", "write_manifest"]
+_lock = threading.Lock()
+
+
+def new_metrics():
+    """
+    Returns an empty metrics dict with all phases set to 0 seconds
+    """
+    return {"phases_in_s": {phase: 0.0 for phase in phases}, "phases_wall_s": {phase: 0.0 for phase in phases},
+            "phase_intervals": {}, "items": {}, "compression_policy": {}, "files_read": 0, "totals": {}}
+
+
+def _add_phase_time(metrics: dict, phase: str, start: float, end: float):
+    with _lock:
+        metrics["phases_in_s"][phase] = metrics["phases_in_s"].get(phase, 0.0) + end - start
+        metrics["phase_intervals"].setdefault(phase, []).append((start, end))
+
+
+def _get_wall_seconds(intervals: list):
+    """
+    Returns the length of the union of (start, end) intervals, overlapping work of threads counts once
+    """
+    seconds, covered_until = 0.0, None
+    for start, end in sorted(intervals):
+        if covered_until is None or start > covered_until:
+            seconds += end - start
+            covered_until = end
+        elif end > covered_until:
+            seconds += end - covered_until
+            covered_until = end
+    return seconds
+
+
+@contextlib.contextmanager
+def measure_phase(metrics: dict, phase: str):
+    """
+    Context manager that adds the time spent inside to the given phase. Does nothing if metrics is None.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            _add_phase_time(metrics, phase, start, time.perf_counter())
+
+
+def record_item(metrics: dict, item: str, phase: str, bytes_read: int, bytes_written: int, seconds: float):
+    """
+    Stores the metrics of one backuped item and adds its time to the phase
+
+    Parameters
+    ----------
+    metrics: dict
+        metrics of the backup, nothing is recorded if None
+    item: str
+        name of the file/folder
+    phase: str
+        phase the item belongs to (copy or compress)
+    bytes_read: int
+        bytes read from the source
+    bytes_written: int
+        bytes written to the destination
+    seconds: float
+        duration of the backup of the item, it ended now
+    """
+    if metrics is None:
+        return
+    end = time.perf_counter()
+    item_metrics = {
+        "phase": phase,
+        "seconds": round(seconds, 6),
+        "bytes_read": bytes_read,
+        "bytes_written": bytes_written,
+        "mb_per_s": round(bytes_read / 1e6 / seconds, 3) if seconds > 0 else None,
+        "compression_ratio": round(bytes_read / bytes_written, 3) if bytes_written > 0 else None
+    }
+    with _lock:
+        metrics["items"][item] = item_metrics
+    _add_phase_time(metrics, phase, end - seconds, end)
+    logger.debug(f"Metrics of <{item}>: {item_metrics}")
+
+
+def record_compression(metrics: dict, extension: str, compressed: bool, reason: str, bytes_read: int,
+                       bytes_written: int):
+    """
+    Adds the compression decision of one file to the statistics of its extension
+
+    Parameters
+    ----------
+    metrics: dict
+        metrics of the backup, nothing is recorded if None
+    extension: str
+        extension of the file, see compression_policy.get_extension
+    compressed: bool
+        True if the file was compressed, False if it was stored
+    reason: str
+        reason of the decision, see compression_policy.decide
+    bytes_read: int
+        size of the file
+    bytes_written: int
+        size of the file in the backup
+    """
+    if metrics is None:
+        return
+    with _lock:
+        stats = metrics["compression_policy"].setdefault(extension or "(none)", {
+            "compressed_files": 0, "stored_files": 0, "bytes_read": 0, "bytes_written": 0, "reasons": {}})
+        stats["compressed_files" if compressed else "stored_files"] += 1
+        stats["bytes_read"] += bytes_read
+        stats["bytes_written"] += bytes_written
+        stats["reasons"][reason] = stats["reasons"].get(reason, 0) + 1
+
+
+def record_files(metrics: dict, num_files: int):
+    """
+    Adds the number of backuped files, the planner uses files per second for trees of small files. Does nothing if
+    metrics is None.
+    """
+    if metrics is None:
+        return
+    with _lock:
+        metrics["files_read"] = metrics.get("files_read", 0) + num_files
+
+
+def finalize_metrics(metrics: dict, seconds: float):
+    """
+    Calculates the totals and the wall-clock time per phase of the backup from the item metrics. Called once at the
+    end of the backup, the recorded intervals of the phases are dropped.
+
+    Parameters
+    ----------
+    metrics: dict
+        metrics of the backup
+    seconds: float
+        wall time of the whole backup
+
+    Returns
+    -------
+    metrics: dict
+        metrics with filled "totals" and "phases_wall_s"
+    """
+    bytes_read = sum(item["bytes_read"] for item in metrics["items"].values())
+    bytes_written = sum(item["bytes_written"] for item in metrics["items"].values())
+    intervals = metrics.pop("phase_intervals", {})
+    metrics["phases_in_s"] = {phase: round(value, 6) for phase, value in metrics["phases_in_s"].items()}
+    metrics["phases_wall_s"] = {phase: round(_get_wall_seconds(intervals.get(phase, [])), 6)
+                                for phase in metrics["phases_in_s"]}
+    for stats in metrics.get("compression_policy", {}).values():
+        stats["compression_ratio"] = round(stats["bytes_read"] / stats["bytes_written"], 3) \
+            if stats["bytes_written"] > 0 else None
+    metrics["totals"] = {
+        "seconds": round(seconds, 6),
+        "bytes_read": bytes_read,
+        "bytes_written": bytes_written,
+        "files_read": metrics.get("files_read", 0),
+        "mb_per_s": round(bytes_read / 1e6 / seconds, 3) if seconds > 0 else None,
+        "files_per_s": round(metrics.get("files_read", 0) / seconds, 3) if seconds > 0 else None,
+        "compression_ratio": round(bytes_read / bytes_written, 3) if bytes_written > 0 else None,
+        # by wall-clock time, the thread time of parallel items can be longer than the whole backup
+        "bottleneck_phase": max(metrics["phases_wall_s"], key=metrics["phases_wall_s"].get)
+    }
+    return metrics
+
+
+def _escape_label(value: str):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def write_prometheus_textfile(metrics: dict, path: str, labels: dict):
+    """
+    Writes the metrics in the Prometheus text format, e.g. for the textfile collector of the node exporter.
+    The file is written to a temp file first and renamed, so the collector never reads a half written file.
+
+    Parameters
+    ----------
+    metrics: dict
+        finalized metrics of the backup
+    path: str
+        path to the .prom file
+    labels: dict
+        labels added to every sample, e.g. source and destination
+    """
+    label_str = ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+    lines = [
+        "# HELP backup_tool_phase_seconds Thread time of the phases of the last backup, parallel items add up",
+        "# TYPE backup_tool_phase_seconds gauge"
+    ]
+    for phase, seconds in metrics["phases_in_s"].items():
+        lines.append(f'backup_tool_phase_seconds{{{label_str},phase="{phase}"}} {seconds}')
+    lines.append("# HELP backup_tool_phase_wall_seconds Wall-clock time of the phases of the last backup")
+    lines.append("# TYPE backup_tool_phase_wall_seconds gauge")
+    for phase, seconds in metrics["phases_wall_s"].items():
+        lines.append(f'backup_tool_phase_wall_seconds{{{label_str},phase="{phase}"}} {seconds}')
+
+    totals = metrics["totals"]
+    for name, key, help_text in [("duration_seconds", "seconds", "Duration of the last backup"),
+                                 ("read_bytes", "bytes_read", "Bytes read from the source by the last backup"),
+                                 ("written_bytes", "bytes_written", "Bytes written by the last backup"),
+                                 ("throughput_mb_per_second", "mb_per_s", "Read throughput of the last backup"),
+                                 ("compression_ratio", "compression_ratio", "Read bytes per written byte")]:
+        if totals.get(key) is None:
+            continue
+        lines.append(f"# HELP backup_tool_{name} {help_text}")
+        lines.append(f"# TYPE backup_tool_{name} gauge")
+        lines.append(f"backup_tool_{name}{{{label_str}}} {totals[key]}")
+    lines.append("# HELP backup_tool_last_run_timestamp_seconds Unix time of the end of the last backup")
+    lines.append("# TYPE backup_tool_last_run_timestamp_seconds gauge")
+    lines.append(f"backup_tool_last_run_timestamp_seconds{{{label_str}}} {time.time():.0f}")
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+    logger.debug(f"Metrics written to Prometheus textfile {path}")
+
+
+def append_jsonl(metrics: dict, path: str, info: dict):
+    """
+    Appends the metrics together with the given info (e.g. source, destination, start time) as one line to a
+    JSON-lines file
+    """
+    line = dict(info)
+    line["metrics"] = metrics
+    with _lock:
+        with open(path, "a") as f:
+            f.write(json.dumps(line) + "\n")
+    logger.debug(f"Metrics appended to {path}")
@@ -0,0 +1,215 @@
+"""
+Estimates of the cost of backups before they run. The throughput of a destination is learned from the metrics of its
+latest backups (info files of the backup catalog): bytes and files per second of the transfer, the fixed time for
+scanning and comparing and the achieved compression ratio. Together with the bytes and files a backup has to read
+(see plan_backup_instruction in backup_tool) this gives its duration and output size. The rows of the backup
+instructions are ordered so they fit into a backup window: rows with the same destination run one after another,
+the longest chains of rows start first on the parallel slots.
+"""
+
+import os
+import json
+import logging
+import statistics
+from datetime import datetime, timedelta
+
+import backup_catalog
+
+logger = logging.getLogger()
+
+history_size = 5  # latest backups of a destination the throughput is learned from
+default_mb_per_s = 50.0  # used for destinations without history
+default_files_per_s = 500.0
+default_compression_ratio = 1.0
+overhead_phases = ["scan", "size", "compare", "write_manifest"]  # time that does not depend on the changed bytes
+
+
+def get_history(backup_path: str, catalog: dict, compression: str = None):
+    """
+    Returns the metrics of the latest complete backups of a destination
+
+    Parameters
+    ----------
+    backup_path: str
+        path to folder where backups get stored
+    catalog: dict
+        catalog of the destination, see backup_catalog
+    compression: str
+        only backups with this compression method are used if at least one of them exists. Backups of older
+        versions do not record their method and are always used.
+
+    Returns
+    -------
+    history: list
+        "metrics" of the info dicts, latest first
+    """
+    complete = sorted([entry for entry in catalog["backups"].values()
+                       if entry["status"] == "complete" and entry.get("info_file")],
+                      key=lambda entry: (entry["start_time"], entry["folder"]), reverse=True)
+    history, same_method = [], []
+    for entry in complete:
+        info_path = os.path.join(backup_path, entry["folder"], entry["info_file"])
+        if not os.path.isfile(info_path):
+            continue
+        with open(info_path, "r", encoding="utf-8") as f:
+            info_dict = json.load(f)
+        if "metrics" not in info_dict or not info_dict["metrics"].get("totals"):
+            continue
+        history.append(info_dict["metrics"])
+        if info_dict.get("compression") in [None, compression]:
+            same_method.append(info_dict["metrics"])
+        if len(same_method) >= history_size:
+            break
+    return same_method if same_method else history[:history_size]
+
+
+def get_throughput(history: list):
+    """
+    Learns the throughput of a destination from the metrics of its latest backups
+
+    Parameters
+    ----------
+    history: list
+        result of get_history
+
+    Returns
+    -------
+    throughput: dict
+        "mb_per_s" and "files_per_s" of the transfer (read, hash, compress, write), "overhead_s" (median time of
+        the overhead_phases), "compression_ratio" (read bytes per written byte), "runs" (number of backups learned
+        from) and "source" ("history" or "default")
+    """
+    seconds, bytes_read, bytes_written, files_seconds, files_read, overheads = 0.0, 0, 0, 0.0, 0, []
+    for metrics in history:
+        totals = metrics["totals"]
+        overhead = sum(metrics.get("phases_in_s", {}).get(phase, 0.0) for phase in overhead_phases)
+        overheads.append(overhead)
+        transfer_s = max(totals["seconds"] - overhead, 1e-3)
+        if totals.get("bytes_read"):
+            seconds += transfer_s
+            bytes_read += totals["bytes_read"]
+            bytes_written += totals.get("bytes_written") or 0
+        if totals.get("files_read"):
+            files_seconds += transfer_s
+            files_read += totals["files_read"]
+
+    throughput = {
+        "mb_per_s": bytes_read / 1e6 / seconds if bytes_read > 0 else default_mb_per_s,
+        # backups of older versions did not count their files, without count the files are no limit
+        "files_per_s": files_read / files_seconds if files_read > 0 else None,
+        "overhead_s": statistics.median(overheads) if overheads else 0.0,
+        "compression_ratio": bytes_read / bytes_written if bytes_written > 0 else default_compression_ratio,
+        "runs": len(history),
+        "source": "history" if bytes_read > 0 else "default"
+    }
+    if throughput["source"] == "default":
+        throughput["files_per_s"] = default_files_per_s
+    return throughput
+
+
+def estimate(bytes_to_read: int, files_to_read: int, throughput: dict, max_read_bytes_per_s: float = 0):
+    """
+    Estimates duration and output size of a backup
+
+    Parameters
+    ----------
+    bytes_to_read: int
+        size of the changed items
+    files_to_read: int
+        number of files of the changed items
+    throughput: dict
+        result of get_throughput
+    max_read_bytes_per_s: float
+        rate limit of the reads (see rate_limiter), 0 if unlimited
+
+    Returns
+    -------
+    estimate: dict
+        "seconds", "expected_output_bytes" and "limited_by" ("bytes", "files" or "rate_limit")
+    """
+    bytes_per_s = throughput["mb_per_s"] * 1e6
+    limited_by = "bytes"
+    if max_read_bytes_per_s and max_read_bytes_per_s < bytes_per_s:
+        bytes_per_s, limited_by = max_read_bytes_per_s, "rate_limit"
+    transfer_s = bytes_to_read / bytes_per_s if bytes_per_s > 0 else 0.0
+    # trees of small files are limited by the files per second and not by the bandwidth
+    if throughput.get("files_per_s") and files_to_read / throughput["files_per_s"] > transfer_s:
+        transfer_s, limited_by = files_to_read / throughput["files_per_s"], "files"
+    return {"seconds": round(throughput["overhead_s"] + transfer_s, 3),
+            "expected_output_bytes": int(bytes_to_read / throughput["compression_ratio"]),
+            "limited_by": limited_by}
+
+
+def parse_window(value: str, now: datetime = None):
+    """
+    Returns start and end of the next backup window
+
+    Parameters
+    ----------
+    value: str
+        "HH:MM-HH:MM", may wrap midnight (e.g. "22:00-06:00")
+    now: datetime
+        current time, now if None. If now is inside the window, the window starts now.
+
+    Returns
+    -------
+    start: datetime
+    end: datetime
+    """
+    now = now or datetime.now()
+    times = []
+    for part in value.split("-"):
+        hours, minutes = part.strip().split(":")
+        times.append(now.replace(hour=int(hours), minute=int(minutes), second=0, microsecond=0))
+    start, end = times
+    if end <= start:
+        end += timedelta(days=1)
+    # the window of yesterday may still be open (e.g. 02:00 in a window 22:00-06:00)
+    if end - timedelta(days=1) > now:
+        start, end = start - timedelta(days=1), end - timedelta(days=1)
+    elif end <= now:
+        start, end = start + timedelta(days=1), end + timedelta(days=1)
+    return max(start, now), end
+
+
+def schedule_rows(plans: list, start: datetime, workers: int, end: datetime = None):
+    """
+    Orders the planned rows for a backup window. Rows with the same destination form a chain that runs one after
+    another (like run_backup_instructions). The longest chains start first, every chain starts on the parallel slot
+    that is free first (longest processing time first scheduling).
+
+    Parameters
+    ----------
+    plans: list
+        plan per row, dicts with "index", "destination" and "seconds"
+    start: datetime
+        start of the backups
+    workers: int
+        rows with different destinations that run in parallel
+    end: datetime
+        end of the backup window, no check if None
+
+    Returns
+    -------
+    plans: list
+        the plans in the order they should be started, with "start", "eta" (end time) and "fits" (ends before
+        end of the window, None without window)
+    """
+    chains = {}
+    for plan in plans:
+        chains.setdefault(os.path.normpath(plan["destination"]), []).append(plan)
+    ordered_chains = sorted(chains.values(), key=lambda chain: sum(plan["seconds"] for plan in chain), reverse=True)
+
+    slots = [start] * max(workers, 1)
+    ordered = []
+    for chain in ordered_chains:
+        slot = slots.index(min(slots))
+        slot_time = slots[slot]
+        for plan in chain:
+            plan["start"] = slot_time.strftime(backup_catalog.time_format)
+            slot_time = slot_time + timedelta(seconds=plan["seconds"])
+            plan["eta"] = slot_time.strftime(backup_catalog.time_format)
+            plan["fits"] = None if end is None else slot_time <= end
+            ordered.append(plan)
+        slots[slot] = slot_time
+    return ordered
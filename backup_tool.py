@@ -7,48 +7,100 @@ Script to perform backups of directories.
 """
 
 import os
+import sys
+import csv
 import shutil
-import pandas as pd
+import getpass
 import logging
-from datetime import datetime
+import argparse
+from datetime import datetime, timedelta
 import time
 import json
 import zipfile
-import gzip
-from checksumdir import dirhash
 import hashlib
-import restore_test_data_to_original_state
+import hash_cache
+import parallel_compression
+import chunk_store
+import backup_metrics
+import copy_engine
+import streaming_io
+import restore_engine
+import backup_catalog
+import file_manifest
+import compression_policy
+import rate_limiter
+import backup_journal
+import change_watcher
+import small_files
+import hash_functions
+import backup_planner
+import threading
+import contextlib
+import concurrent.futures
 
-# Configure logging
 logger = logging.getLogger()
 
-# create file handler which logs even debug messages
-filename = datetime.now().strftime(f'%Y%m%d_%H%M%S_{os.getlogin()}.log')
-basepath = "./logs_backup_tool"
-if not os.path.exists(basepath):
-    os.makedirs(basepath)
-fh = logging.FileHandler(f'{basepath}/{filename}', mode='w')
-fh.setLevel(logging.DEBUG)
-sh = logging.StreamHandler()
-fh.setLevel(logging.DEBUG)
-
-# create formatter and add it to the handlers
-formatter = logging.Formatter("%(asctime)s - %(levelname)s [%(module)s - %(funcName)s()]: %(message)s",
-                              "%Y-%m-%d %H:%M:%S")
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-sh.setFormatter(formatter)
-# logger.addHandler(sh)
-logger.setLevel(logging.DEBUG)
-
-
+log_foldername = "./logs_backup_tool"
 instructions_filename = "backup_instruction.csv"
 instructions_foldername = "data"
+backup_strategies = ["full", "incremental", "differential", "snapshot"]
+zip64_min_size = 1024 * 1024 * 1024  # zip members from this size on always get zip64 headers
+max_parallel_rows = os.cpu_count() or 1  # rows with different destinations are processed in parallel
+max_jobs_per_device = 1  # default number of parallel items per disk, can be set per row in the instructions
+compression_methods = {"zip": "SINGLE_PASS", "none": "SINGLE_PASS_COPY", "gz": "gz", "xz": "xz", "zstd": "zstd",
+                       "lz4": "lz4", "chunks": "CHUNK_STORE"}  # values of the compression column in the instructions
+
+
+def setup_logging(basepath: str = log_foldername):
+    """
+    Configures the logging of the script: everything from debug level on is written to a new log file in basepath.
+    Only called by main(), so importing the module has no side effects.
+
+    Parameters
+    ----------
+    basepath: str
+        folder for the log files, created if not existing
+
+    Returns
+    -------
+    log_path: str
+        path to the created log file
+    """
+    # getpass works without a terminal (cron, scheduler) in contrast to os.getlogin
+    filename = datetime.now().strftime(f'%Y%m%d_%H%M%S_{getpass.getuser()}.log')
+    if not os.path.exists(basepath):
+        os.makedirs(basepath)
+    log_path = os.path.join(basepath, filename)
+    fh = logging.FileHandler(log_path, mode='w')
+    fh.setLevel(logging.DEBUG)
+
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s [%(module)s - %(funcName)s()]: %(message)s",
+                                  "%Y-%m-%d %H:%M:%S")
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+    logger.setLevel(logging.DEBUG)
+    return log_path
+
+
+def _convert_instruction_value(value: str):
+    """
+    Converts a value of the instructions csv to bool, int or None (empty), everything else stays a string
+    """
+    value = value.strip()
+    if value == "":
+        return None
+    if value.lower() in ["true", "false"]:
+        return value.lower() == "true"
+    try:
+        return int(value)
+    except ValueError:
+        return value
 
 
 def read_backup_instructions(path: str, file: str):
     """
-    Return Pandas DataFrame with instructions for backups from given path to csv file
+    Return list of rows with instructions for backups from given path to csv file
     Parameters
     ----------
     path: str
@@ -58,15 +110,18 @@ def read_backup_instructions(path: str, file: str):
 
     Returns
     -------
-    instructions_pd: pandas.core.frame.DataFrame
-        Pandas DataFrame with read in csv data
+    instructions: list
+        one dict per row with the headers as keys. True/False and numbers are converted, empty values are None
     """
     file_path = os.path.join(path, file)
     logger.debug(f"Read file: {file_path}")
     if os.path.exists(file_path) and os.path.isfile(file_path):
-        instructions_pd = pd.read_csv(file_path, sep=";", encoding="utf-8")
-        logger.debug(f"Content is: {instructions_pd}")
-        return instructions_pd
+        # utf-8-sig removes the BOM that e.g. Excel writes at the beginning of the file
+        with open(file_path, "r", encoding="utf-8-sig", newline="") as f:
+            instructions = [{header.strip(): _convert_instruction_value(value or "") for header, value in row.items()}
+                            for row in csv.DictReader(f, delimiter=";")]
+        logger.debug(f"Content is: {instructions}")
+        return instructions
 
     else:
         logger.warning(f"file could not be found! ({file_path})")
@@ -76,7 +131,8 @@ def read_backup_instructions(path: str, file: str):
 
 def check_and_setup_directories(index: int, src: str, dst: str):
     """
-    Checks if directories exists, create dir for destination if not already exists.
+    Checks if directories exists, create dir for destination if not already exists. An existing destination of
+    today is deleted, unless it holds the journal of an interrupted backup, then the backup is resumed there.
 
     Parameters
     ----------
@@ -108,6 +164,13 @@ def check_and_setup_directories(index: int, src: str, dst: str):
     dst = os.path.join(dst, today_str)
     valid_dst = os.path.exists(dst)
 
+    if valid_dst is True and backup_journal.has_journal(dst):
+        # interrupted backup of today, complete items are reused (see backup_journal)
+        logger.info(f"Destination already existing with journal of an interrupted backup. Resume it")
+        print(f"Resume interrupted backup in {dst}")
+        backup_journal.clean_partial_outputs(dst)
+        return src, dst
+
     if valid_dst is True:
         logger.debug(f"Destination already existing. Delete now")
         shutil.rmtree(dst)
@@ -135,59 +198,1094 @@ def backup_folder_with_zipfile_method(src: str, dst: str):
         dst = dst + ".zip"
         logger.debug(f"Adjust dst with '.zip' ending. dst is now: {dst}")
 
-    zip_file = zipfile.ZipFile(str(dst), mode='w')
+    # one scandir walk, the files are packed like in backup_folder_single_pass
+    with zipfile.ZipFile(str(dst), mode='w', allowZip64=True) as zip_file:
+        write_files_to_zip(zip_file=zip_file, src=src, files=scan_item(src)["files"],
+                           arc_root=os.path.basename(os.path.normpath(src)))
 
-    for root, dirs, files in os.walk(src):
-        for file in files:
-            zip_file.write(os.path.join(root, file),
-                           os.path.relpath(os.path.join(root, file),
-                                           os.path.join(src, '..')),
-                           compress_type=zipfile.ZIP_DEFLATED)
 
-    zip_file.close()
+def set_zip_compression_level(zip_info: zipfile.ZipInfo, compression_level: int = None):
+    """
+    Sets the compression level of one zip member. ZipFile.open and ZipFile.writestr with a ZipInfo do not use the
+    compresslevel of the ZipFile, it has to be set per member. The attribute is named _compresslevel up to python 3.12
+    and compress_level since python 3.13.
+    """
+    attribute = "compress_level" if hasattr(zip_info, "compress_level") else "_compresslevel"
+    setattr(zip_info, attribute, compression_level)
 
 
-def backup_items_from_src_to_dst(src: str, dst: str, items: list, compression: str = None):
+def write_file_to_zip(zip_file: zipfile.ZipFile, src_file: str, arcname: str, hash_func: str = 'md5',
+                      compression_level: int = None, adaptive_compression: bool = False, metrics: dict = None,
+                      write_behind: int = None, limiter=None):
     """
-    Loops given items list and backup them from source to destination. Decide with compression about method.
+    Streams a file into an opened zip archive with bounded memory (see streaming_io). The zip CRC and the hash are
+    built from the same buffers. Big files always get zip64 headers, so they can not break the archive.
+    With adaptive compression, compression_policy decides if the file is stored or compressed and with which level.
+
+    Parameters
+    ----------
+    zip_file: zipfile.ZipFile
+        zip archive opened for writing
+    src_file: str
+        path to file to be added
+    arcname: str
+        name of the file in the archive
+    hash_func: str
+        method of hash algorithm
+    compression_level: int
+        zlib level 0-9, zlib default if None
+    adaptive_compression: bool
+        decide per file with compression_policy, else every file is compressed
+    metrics: dict
+        metrics of the backup, the compression decision and the achieved ratio are recorded there
+    write_behind: int
+        number of buffers compressed and written by a writer thread, see streaming_io.stream_file
+    limiter: rate_limiter.RateLimiter
+        limits of the read and written bytes and the file operations, not limited if None
+
+    Returns
+    -------
+    hash: str
+        hexdigest of the file content
+    """
+    zip_info = zipfile.ZipInfo.from_file(src_file, arcname)
+    compress, reason = True, "always"
+    if adaptive_compression:
+        compress, compression_level, reason = compression_policy.decide(src_file, zip_info.file_size,
+                                                                        level=compression_level)
+    zip_info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    set_zip_compression_level(zip_info, compression_level)
+    with zip_file.open(zip_info, mode="w", force_zip64=zip_info.file_size >= zip64_min_size) as member:
+        hash, size = streaming_io.stream_file(src_file, member.write, hash_func=hash_func,
+                                              write_behind=write_behind, limiter=limiter)
+    backup_metrics.record_compression(metrics, extension=compression_policy.get_extension(src_file),
+                                      compressed=compress, reason=reason, bytes_read=size,
+                                      bytes_written=zip_info.compress_size)
+    return hash
+
+
+def write_files_to_zip(zip_file: zipfile.ZipFile, src: str, files: list, arc_root: str = "", hash_func: str = 'md5',
+                       compression_level: int = None, adaptive_compression: bool = False, metrics: dict = None,
+                       write_behind: int = None, limiter=None):
+    """
+    Writes scanned files of a folder to an opened zip archive. Runs of small files are read and hashed in batches by
+    reader threads (see small_files) while the previous batch is written, big files are streamed with
+    write_file_to_zip.
 
     Parameters
     ----------
+    zip_file: zipfile.ZipFile
+        zip archive opened for writing
     src: str
-        path where items are located
+        path to the scanned folder
+    files: list
+        tuples (relative_path, size, mtime_ns, inode) of scan_item
+    arc_root: str
+        folder in the archive the relative paths are placed in, "" for the root of the archive
+    hash_func, compression_level, adaptive_compression, metrics, write_behind, limiter:
+        see write_file_to_zip
+
+    Returns
+    -------
+    hashes: list
+        hexdigest per file in the order of files
+    """
+    hashes = []
+    for is_small, group in small_files.group_files(files):
+        if is_small:
+            # the compression decision compresses a sample, it is done by the reader threads
+            decide = (lambda path, data: compression_policy.decide(path, len(data), level=compression_level,
+                                                                   sample=data)) if adaptive_compression else None
+            contents = small_files.read_small_files([os.path.join(src, f[0]) for f in group], [f[1] for f in group],
+                                                    hash_func=hash_func, process=decide, limiter=limiter)
+            for (rel_path, size, mtime_ns, ino), (data, hash, stat, decision) in zip(group, contents):
+                write_data_to_zip(zip_file=zip_file, data=data, stat=stat, src_file=os.path.join(src, rel_path),
+                                  arcname=os.path.join(arc_root, rel_path), compression_level=compression_level,
+                                  decision=decision, metrics=metrics, limiter=limiter)
+                hashes.append(hash)
+        else:
+            for rel_path, size, mtime_ns, ino in group:
+                hashes.append(write_file_to_zip(zip_file=zip_file, src_file=os.path.join(src, rel_path),
+                                                arcname=os.path.join(arc_root, rel_path), hash_func=hash_func,
+                                                compression_level=compression_level,
+                                                adaptive_compression=adaptive_compression, metrics=metrics,
+                                                write_behind=write_behind, limiter=limiter))
+    return hashes
+
+
+def write_data_to_zip(zip_file: zipfile.ZipFile, data: bytes, stat: os.stat_result, src_file: str, arcname: str,
+                      compression_level: int = None, decision: tuple = None, metrics: dict = None, limiter=None):
+    """
+    Writes a small file that is already in memory (see small_files.read_small_files) to an opened zip archive. The
+    zip header is built from the fstat of the read, so the file is not stat'ed again. Same member as
+    write_file_to_zip.
+
+    Parameters
+    ----------
+    zip_file: zipfile.ZipFile
+        zip archive opened for writing
+    data: bytes
+        content of the file
+    stat: os.stat_result
+        stat of the file, mtime and mode are stored in the archive
+    src_file: str
+        path to the file, used for the compression decision
+    arcname: str
+        name of the file in the archive
+    compression_level: int
+        zlib level 0-9, zlib default if None
+    decision: tuple
+        result of compression_policy.decide for the file, every file is compressed with compression_level if None
+    metrics: dict
+        metrics of the backup, the compression decision and the achieved ratio are recorded there
+    limiter: rate_limiter.RateLimiter
+        limits of the written bytes, not limited if None
+    """
+    zip_info = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime)[0:6])
+    zip_info.external_attr = (stat.st_mode & 0xFFFF) << 16
+    compress, reason = True, "always"
+    if decision is not None:
+        compress, compression_level, reason = decision
+    zip_info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    set_zip_compression_level(zip_info, compression_level)
+    zip_file.writestr(zip_info, data)
+    if limiter is not None:
+        limiter.write(zip_info.compress_size)
+    backup_metrics.record_compression(metrics, extension=compression_policy.get_extension(src_file),
+                                      compressed=compress, reason=reason, bytes_read=len(data),
+                                      bytes_written=zip_info.compress_size)
+
+
+def scan_item(path: str):
+    """
+    Walks given path exactly once with os.scandir and collects size, mtime and inode of every file below it.
+    The result is used for sizing, hashing and archiving so that no later stage has to walk the tree again.
+
+    Parameters
+    ----------
+    path: str
+        Path to file or directory
+
+    Returns
+    -------
+    scan: dict
+        dict with keys "path", "is_dir", "size", "mtime_ns" (newest mtime of all files and folders), "dirs" (list of
+        relative folder paths), "files" (list of tuples with relative_path, size in bytes, mtime_ns and inode),
+        "fingerprint" and "dir_fingerprints" (see build_fingerprints)
+    """
+    scan = {
+        "path": path,
+        "is_dir": os.path.isdir(path),
+        "size": 0,
+        "mtime_ns": 0,
+        "dirs": [],
+        "files": []
+    }
+
+    if scan["is_dir"]:
+        # folder mtimes are part of mtime_ns, so renamed or deleted files change it as well
+        scan["mtime_ns"] = os.stat(path).st_mtime_ns
+        pending = [""]
+        while pending:
+            rel_dir = pending.pop()
+            with os.scandir(os.path.join(path, rel_dir)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir():
+                    scan["dirs"].append(rel_path)
+                    scan["mtime_ns"] = max(scan["mtime_ns"], entry.stat().st_mtime_ns)
+                    # do not follow linked folders, same behaviour as os.walk
+                    if not entry.is_symlink():
+                        pending.append(rel_path)
+                else:
+                    stat = entry.stat()
+                    scan["files"].append((rel_path, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+                    scan["size"] += stat.st_size
+                    scan["mtime_ns"] = max(scan["mtime_ns"], stat.st_mtime_ns)
+        scan["dirs"].sort()
+        scan["files"].sort()
+
+    elif os.path.isfile(path):
+        stat = os.stat(path)
+        scan["files"].append((os.path.basename(path), stat.st_size, stat.st_mtime_ns, stat.st_ino))
+        scan["size"] = stat.st_size
+        scan["mtime_ns"] = stat.st_mtime_ns
+    else:
+        raise Exception("Should not be reached!!")
+
+    scan["dir_fingerprints"] = build_fingerprints(scan)
+    scan["fingerprint"] = scan["dir_fingerprints"][""]
+    return scan
+
+
+def build_fingerprints(scan: dict):
+    """
+    Builds a Merkle tree over (name, size, mtime_ns) of all files of a scan. The fingerprint of a folder covers its
+    files and the fingerprints of its sub folders, so any new, deleted, renamed or modified file below a folder changes
+    the fingerprint of the folder and all its parents. Costs nothing but the metadata of the scan.
+
+    Parameters
+    ----------
+    scan: dict
+        result of scan_item
+
+    Returns
+    -------
+    fingerprints: dict
+        hexdigest per relative folder path, "" is the scanned item itself
+    """
+    files_per_dir, dirs_per_dir = {}, {}
+    for rel_path, size, mtime_ns, ino in scan["files"]:
+        rel_dir = os.path.dirname(rel_path) if scan["is_dir"] else ""
+        files_per_dir.setdefault(rel_dir, []).append((os.path.basename(rel_path), size, mtime_ns))
+    for rel_dir in scan["dirs"]:
+        dirs_per_dir.setdefault(os.path.dirname(rel_dir), []).append(rel_dir)
+
+    fingerprints = {}
+    # deepest folders first, so the fingerprints of all sub folders are known
+    for rel_dir in sorted(scan["dirs"], key=lambda d: d.count(os.sep), reverse=True) + [""]:
+        fingerprint = hashlib.blake2b(digest_size=16)
+        for name, size, mtime_ns in files_per_dir.get(rel_dir, []):
+            fingerprint.update(f"f/{name}/{size}/{mtime_ns}\n".encode("utf-8", "surrogateescape"))
+        for sub_dir in dirs_per_dir.get(rel_dir, []):
+            fingerprint.update(f"d/{os.path.basename(sub_dir)}/{fingerprints[sub_dir]}\n"
+                               .encode("utf-8", "surrogateescape"))
+        fingerprints[rel_dir] = fingerprint.hexdigest()
+    return fingerprints
+
+
+def get_tree_file_hashes(scan: dict, hash_func: str = 'md5', cache=None):
+    """
+    Returns the hashes of all files of a scanned folder. With a cache, the file hashes of every folder are stored
+    together with its fingerprint: folders whose fingerprint did not change since the last call are taken from the
+    cache without looking at their files, only the files of changed folders are hashed (via
+    build_hashes_of_scanned_files).
+
+    Parameters
+    ----------
+    scan: dict
+        result of scan_item for a folder
+    hash_func: str
+        method of hash algorithm
+    cache: sqlite3.Connection
+        opened hash cache, every file is hashed if None
+
+    Returns
+    -------
+    file_hashes: list
+        hexdigests of all files of the folder
+    """
+    root = os.path.abspath(scan["path"])
+    cached_dirs = hash_cache.get_tree_hashes(cache, root, hash_func) if cache is not None else {}
+    files_per_dir = {}
+    for path, f in get_scanned_file_paths(scan):
+        files_per_dir.setdefault(os.path.dirname(f[0]), []).append((path, f))
+
+    dir_hashes, changed_dirs = {}, []
+    for rel_dir, fingerprint in scan["dir_fingerprints"].items():
+        cached = cached_dirs.get(rel_dir)
+        if cached is not None and cached[0] == fingerprint:
+            dir_hashes[rel_dir] = cached[1]
+        else:
+            changed_dirs.append(rel_dir)
+
+    # the files of all changed folders are hashed together, so small files of many folders share the batches
+    paths = [p for rel_dir in changed_dirs for p in files_per_dir.get(rel_dir, [])]
+    hashes = iter(build_hashes_of_scanned_files(paths, hash_func=hash_func, cache=cache,
+                                                cached_hashes=get_bulk_cached_hashes(cache, root, hash_func, paths)))
+    for rel_dir in changed_dirs:
+        dir_hashes[rel_dir] = [next(hashes) for _ in files_per_dir.get(rel_dir, [])]
+    file_hashes = [hash for rel_dir in scan["dir_fingerprints"] for hash in dir_hashes[rel_dir]]
+
+    if cache is not None:
+        hash_cache.store_tree_hashes(cache, root, hash_func, {rel_dir: (scan["dir_fingerprints"][rel_dir], hashes)
+                                                              for rel_dir, hashes in dir_hashes.items()})
+    return file_hashes
+
+
+def get_bulk_cached_hashes(cache, root: str, hash_func: str, paths: list):
+    """
+    Returns the cached hashes below root with one query (see hash_cache.get_cached_hashes) if many files are looked
+    up, None (one query per file) for a few files or without cache
+    """
+    if cache is None or len(paths) <= small_files.batch_files:
+        return None
+    return hash_cache.get_cached_hashes(cache, root, hash_func)
+
+
+def build_hashes_of_scanned_files(paths: list, hash_func: str = 'md5', cache=None, cached_hashes: dict = None):
+    """
+    Returns the hashes of many scanned files. Files without valid cached hash are hashed in batches, small files by
+    small_files.hash_small_files (one read per file, several reader threads), big files by build_hash_of_file in
+    hash_functions.hash_workers threads.
+
+    Parameters
+    ----------
+    paths: list
+        tuples of absolute path and scan tuple, see get_scanned_file_paths
+    hash_func: str
+        method of hash algorithm
+    cache: sqlite3.Connection
+        opened hash cache, new hashes are stored there
+    cached_hashes: dict
+        result of hash_cache.get_cached_hashes covering all paths, the cache is asked per file if None
+
+    Returns
+    -------
+    hashes: list
+        hexdigest per file in the order of paths
+    """
+    hashes = [None] * len(paths)
+    if cache is not None:
+        for i, (path, (rel_path, size, mtime_ns, ino)) in enumerate(paths):
+            if cached_hashes is None:
+                hashes[i] = hash_cache.get_cached_hash(cache, path, ino, size, mtime_ns, hash_func)
+            else:
+                cached = cached_hashes.get(path)
+                if cached is not None and cached[:3] == (ino, size, mtime_ns):
+                    hashes[i] = cached[3]
+
+    missing = [i for i, hash in enumerate(hashes) if hash is None]
+    small = [i for i in missing if paths[i][1][1] <= small_files.small_file_size]
+    if small:
+        for i, hash in zip(small, small_files.hash_small_files([paths[i][0] for i in small],
+                                                               [paths[i][1][1] for i in small], hash_func=hash_func)):
+            hashes[i] = hash
+    big = [i for i in missing if hashes[i] is None]
+    if big:
+        # hashlib releases the GIL for big blocks, so the files are hashed on several cores
+        with concurrent.futures.ThreadPoolExecutor(max_workers=hash_functions.hash_workers) as executor:
+            for i, hash in zip(big, executor.map(lambda i: build_hash_of_file(filepath=paths[i][0],
+                                                                              hash_func=hash_func,
+                                                                              signature=paths[i][1][1:]), big)):
+                hashes[i] = hash
+    if cache is not None:
+        for i in missing:
+            rel_path, size, mtime_ns, ino = paths[i][1]
+            hash_cache.store_hash(cache, paths[i][0], ino, size, mtime_ns, hash_func, hashes[i])
+    return hashes
+
+
+def get_scanned_file_paths(scan: dict):
+    """
+    Returns the absolute path of every file found by scan_item together with its scan tuple
+
+    Parameters
+    ----------
+    scan: dict
+        result of scan_item
+
+    Returns
+    -------
+    paths: list
+        list of tuples with absolute path and the scan tuple (relative_path, size, mtime_ns, inode)
+    """
+    root = os.path.abspath(scan["path"])
+    if scan["is_dir"]:
+        return [(os.path.join(root, f[0]), f) for f in scan["files"]]
+    return [(root, f) for f in scan["files"]]
+
+
+def reduce_file_hashes(hashes: list, hash_func: str = 'md5'):
+    """
+    Combines the hashes of all files of a directory to one directory hash. Same result as checksumdir's dirhash.
+
+    Parameters
+    ----------
+    hashes: list
+        list of hexdigests of the single files
+    hash_func: str
+        method of hash algorithm
+
+    Returns
+    -------
+    hash: str
+        hash string of the directory
+    """
+    hash = hash_functions.new_hash(hash_func)
+    for hash_value in sorted(hashes):
+        hash.update(hash_value.encode("utf-8"))
+    return hash.hexdigest()
+
+
+def copy_file_and_hash(src: str, dst, hash_func: str = 'md5', write_behind: int = None, limiter=None):
+    """
+    Reads src once in large pooled blocks, writes every block to dst and feeds the same block into the hash.
+
+    Parameters
+    ----------
+    src: str
+        path to file to be copied
+    dst: str or file object
+        path to target file or already opened binary file object (e.g. a zip member)
+    hash_func: str
+        method of hash algorithm
+    write_behind: int
+        number of buffers written by a writer thread, see streaming_io.stream_file. Helps with slow destinations
+    limiter: rate_limiter.RateLimiter
+        limits of the read and written bytes and the file operations, not limited if None
+
+    Returns
+    -------
+    hash: str
+        hexdigest of the copied bytes
+    """
+    if not isinstance(dst, str):
+        return streaming_io.stream_file(src, dst.write, hash_func=hash_func, write_behind=write_behind,
+                                        limiter=limiter)[0]
+
+    with open(dst, "wb") as f_dst:
+        return streaming_io.stream_file(src, f_dst.write, hash_func=hash_func, write_behind=write_behind,
+                                        limiter=limiter)[0]
+
+
+def backup_folder_single_pass(src: str, dst: str, scan: dict, compression: bool = True, hash_func: str = 'md5',
+                              cache=None, compression_level: int = None, adaptive_compression: bool = False,
+                              metrics: dict = None, write_behind: int = None, limiter=None):
+    """
+    Backups a folder with the files found by scan_item. Every file is read only once, the bytes are written to the
+    archive (or copied) and hashed at the same time. The archive has the same layout as shutil.make_archive.
+    Runs of small files are read and hashed in batches by reader threads (see small_files) while the previous batch
+    is written, big files are streamed.
+
+    Parameters
+    ----------
+    src: str
+        path to directory to be backuped
     dst: str
-        path where backup should be stored
+        path to target directory, '.zip' is added if compression is used
+    scan: dict
+        result of scan_item for src
+    compression: bool
+        write a zip archive if True, else copy the folder tree
+    hash_func: str
+        method of hash algorithm
+    cache: sqlite3.Connection
+        opened hash cache, the hashes of all copied files are stored there
+    compression_level: int
+        zlib level 0-9 of the zip archive, zlib default if None
+    adaptive_compression: bool
+        decide per file if it is compressed, see write_file_to_zip
+    metrics: dict
+        metrics of the backup, the compression decisions are recorded there
+    write_behind: int
+        number of buffers written by a writer thread per file, see streaming_io.stream_file
+    limiter: rate_limiter.RateLimiter
+        limits of the read and written bytes and the file operations, not limited if None
+
+    Returns
+    -------
+    hash: str
+        hash string of the directory, same value as build_checksum_of_directory
+    """
+    file_hashes = []
+
+    if compression:
+        if not dst.endswith(".zip"):
+            dst = dst + ".zip"
+        with zipfile.ZipFile(dst, mode="w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for rel_dir in scan["dirs"]:
+                zip_file.write(os.path.join(src, rel_dir), rel_dir)
+            file_hashes = write_files_to_zip(zip_file=zip_file, src=src, files=scan["files"], hash_func=hash_func,
+                                             compression_level=compression_level,
+                                             adaptive_compression=adaptive_compression, metrics=metrics,
+                                             write_behind=write_behind, limiter=limiter)
+    else:
+        os.makedirs(dst)
+        for rel_dir in scan["dirs"]:
+            os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+        for is_small, files in small_files.group_files(scan["files"]):
+            if is_small:
+                contents = small_files.read_small_files([os.path.join(src, f[0]) for f in files],
+                                                        [f[1] for f in files], hash_func=hash_func, limiter=limiter)
+                for (rel_path, size, mtime_ns, ino), (data, hash, stat, _) in zip(files, contents):
+                    src_file, dst_file = os.path.join(src, rel_path), os.path.join(dst, rel_path)
+                    if limiter is not None:
+                        limiter.file_op()
+                        limiter.write(len(data))
+                    with open(dst_file, "wb") as f_dst:
+                        f_dst.write(data)
+                    shutil.copystat(src_file, dst_file)
+                    file_hashes.append(hash)
+            else:
+                for rel_path, size, mtime_ns, ino in files:
+                    src_file, dst_file = os.path.join(src, rel_path), os.path.join(dst, rel_path)
+                    file_hashes.append(copy_file_and_hash(src_file, dst_file, hash_func=hash_func,
+                                                          write_behind=write_behind, limiter=limiter))
+                    shutil.copystat(src_file, dst_file)
+
+    if cache is not None:
+        for (rel_path, size, mtime_ns, ino), hash in zip(scan["files"], file_hashes):
+            hash_cache.store_hash(cache, os.path.abspath(os.path.join(src, rel_path)), ino, size, mtime_ns,
+                                  hash_func, hash)
+
+    return reduce_file_hashes(file_hashes, hash_func=hash_func)
+
+
+def backup_with_copy_engine(src: str, dst: str, scan: dict, copy_method: str = "auto", hash_func: str = 'md5',
+                            cache=None, limiter=None):
+    """
+    Copies a file or folder with the copy engine (reflink, copy_file_range, sendfile). The data does not pass
+    through python, so the hashes are built afterwards. Files with unchanged inode, size and mtime are not read
+    again if a hash cache is given.
+
+    Parameters
+    ----------
+    src: str
+        path to file/folder to be backuped
+    dst: str
+        path to target file/folder
+    scan: dict
+        result of scan_item for src
+    copy_method: str
+        one of copy_engine.copy_methods
+    hash_func: str
+        method of hash algorithm
+    cache: sqlite3.Connection
+        opened hash cache
+    limiter: rate_limiter.RateLimiter
+        limits of the copied bytes and the file operations, not limited if None
+
+    Returns
+    -------
+    hash: str
+        hash of the file or the folder (same value as build_checksum_of_directory)
+    """
+    if scan["is_dir"]:
+        copy_engine.copy_tree(src, dst, scan=scan, method=copy_method, limiter=limiter)
+    else:
+        copy_engine.copy_file(src, dst, method=copy_method, limiter=limiter)
+
+    paths = get_scanned_file_paths(scan)
+    file_hashes = build_hashes_of_scanned_files(paths, hash_func=hash_func, cache=cache,
+                                                cached_hashes=get_bulk_cached_hashes(cache, os.path.abspath(src),
+                                                                                     hash_func, paths))
+    if scan["is_dir"]:
+        return reduce_file_hashes(file_hashes, hash_func=hash_func)
+    return file_hashes[0]
+
+
+def backup_with_hard_links(src: str, dst: str, scan: dict, link_src: str, copy_method: str = None,
+                           hash_func: str = 'md5', cache=None, write_behind: int = None, limiter=None):
+    """
+    Snapshot of a file or folder like rsync --link-dest. Files with the same size and mtime as in the previous
+    backup are hard linked to it, only changed files are copied. The result is a complete browsable tree that only
+    costs the space of the changed files.
+
+    Parameters
+    ----------
+    src: str
+        path to file/folder to be backuped
+    dst: str
+        path to target file/folder
+    scan: dict
+        result of scan_item for src
+    link_src: str
+        path to the same file/folder in the previous backup
+    copy_method: str
+        one of copy_engine.copy_methods for changed files. Copy through python while hashing if None or "read_write"
+    hash_func: str
+        method of hash algorithm
+    cache: sqlite3.Connection
+        opened hash cache, hashes of linked files are taken from there
+    write_behind: int
+        number of buffers written by a writer thread per copied file, see streaming_io.stream_file
+    limiter: rate_limiter.RateLimiter
+        limits of the copied bytes and the file operations (links count as well), not limited if None
+
+    Returns
+    -------
+    hash: str
+        hash of the file or the folder (same value as build_checksum_of_directory)
+    bytes_copied: int
+        size of the copied (not linked) files
+    """
+    if scan["is_dir"]:
+        os.makedirs(dst)
+        for rel_dir in scan["dirs"]:
+            os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+
+    file_hashes = []
+    bytes_copied, num_linked = 0, 0
+    for path, (rel_path, size, mtime_ns, ino) in get_scanned_file_paths(scan):
+        target = os.path.join(dst, rel_path) if scan["is_dir"] else dst
+        previous = os.path.join(link_src, rel_path) if scan["is_dir"] else link_src
+        linked = False
+        try:
+            previous_stat = os.stat(previous)
+            if previous_stat.st_size == size and previous_stat.st_mtime_ns == mtime_ns:
+                if limiter is not None:
+                    limiter.file_op()
+                os.link(previous, target)
+                linked = True
+        except OSError:
+            # previous file missing or hard links not possible (e.g. other device) --> copy
+            pass
+
+        if linked:
+            num_linked += 1
+            file_hashes.append(build_hash_of_file(filepath=path, hash_func=hash_func, cache=cache,
+                                                  signature=(size, mtime_ns, ino)))
+        elif copy_method not in [None, "read_write"]:
+            copy_engine.copy_file(path, target, method=copy_method, limiter=limiter)
+            file_hashes.append(build_hash_of_file(filepath=path, hash_func=hash_func, cache=cache,
+                                                  signature=(size, mtime_ns, ino)))
+            bytes_copied += size
+        else:
+            file_hashes.append(copy_file_and_hash(path, target, hash_func=hash_func, write_behind=write_behind,
+                                                  limiter=limiter))
+            # mtime is needed to link the file in the next snapshot
+            shutil.copystat(path, target)
+            if cache is not None:
+                hash_cache.store_hash(cache, path, ino, size, mtime_ns, hash_func, file_hashes[-1])
+            bytes_copied += size
+
+    if scan["is_dir"]:
+        for rel_dir in reversed(scan["dirs"]):
+            shutil.copystat(os.path.join(src, rel_dir), os.path.join(dst, rel_dir))
+    logger.debug(f"Snapshot of {src}: {num_linked} files linked to {link_src}, {bytes_copied} bytes copied")
+
+    if scan["is_dir"]:
+        return reduce_file_hashes(file_hashes, hash_func=hash_func), bytes_copied
+    return file_hashes[0], bytes_copied
+
+
+def new_device_semaphores():
+    """
+    Returns an empty registry for get_device_semaphores. One registry is shared by all rows of one call of
+    run_backup_instructions, so their jobs on the same device count together.
+    """
+    return {"lock": threading.Lock(), "semaphores": {}}
+
+
+def get_device_semaphores(paths: list, limit: int, registry: dict):
+    """
+    Returns one semaphore per storage device of the given paths. Jobs on the same device with the same limit share
+    the semaphore, so at most limit jobs work on one device at the same time while jobs on other devices are not
+    blocked.
+
+    Parameters
+    ----------
+    paths: list
+        paths whose devices are used by a job
+    limit: int
+        number of parallel jobs per device. Rows with another limit get their own semaphores
+    registry: dict
+        semaphores of the running backups, see new_device_semaphores
+
+    Returns
+    -------
+    semaphores: list
+        semaphores sorted by device id, acquire them in this order to prevent deadlocks
+    """
+    limit = max(int(limit), 1)
+    devices = sorted({os.stat(path).st_dev for path in paths})
+    with registry["lock"]:
+        for device in devices:
+            if (device, limit) not in registry["semaphores"]:
+                logger.debug(f"Allow {limit} parallel jobs on device {device}")
+                registry["semaphores"][(device, limit)] = threading.BoundedSemaphore(limit)
+        return [registry["semaphores"][(device, limit)] for device in devices]
+
+
+def get_item_output_path(dst_item: str, compression: str = None, is_dir: bool = True, link_dest: str = None):
+    """
+    Returns the exact path the backup method of an item writes to (copied file/folder, archive or manifest)
+
+    Parameters
+    ----------
+    dst_item: str
+        path of the item in the backup folder without ending
+    compression: str
+        indicator which compression method is used, see backup_item_from_src_to_dst
+    is_dir: bool
+        the item is a folder, files are always copied (except for the chunk store)
+    link_dest: str
+        path to the previous backup folder for snapshots with hard links
+
+    Returns
+    -------
+    output: str
+        dst_item with the ending of the method
+    """
+    if compression == "CHUNK_STORE":
+        return dst_item + chunk_store.manifest_ending
+    if not is_dir or (link_dest is not None and compression in [None, "SINGLE_PASS_COPY"]):
+        return dst_item
+    if compression in ["ZIPFILE", "shutil.make_archive", "SINGLE_PASS"]:
+        return dst_item + ".zip"
+    if compression in parallel_compression.codecs:
+        return f"{dst_item}.tar.{compression}"
+    return dst_item
+
+
+def get_colliding_items(src: str, items: list, compression: str = None, link_dest: str = None):
+    """
+    Returns the items whose output with ending would clash with the name of another item of the same backup folder,
+    e.g. the folder "a" stored as "a.zip" next to the file "a.zip". These items are stored with their plain name
+    (see find_stored_item of restore_engine, which looks for the plain name first).
+
+    Parameters
+    ----------
+    src: str
+        path where the items are located
     items: list
-        list of files/folders to be backuped
+        names of all items of src
     compression: str
-        indicator which compression method should be used
+        indicator which compression method is used
+    link_dest: str
+        path to the previous backup folder for snapshots with hard links
+
+    Returns
+    -------
+    colliding_items: set
+        names of the items that have to be stored with their plain name
     """
+    names = set(items)
+    endings = ["", ".zip", chunk_store.manifest_ending] + [f".tar.{codec}" for codec in parallel_compression.codecs]
+    colliding_items = set()
     for item in items:
+        output = get_item_output_path(item, compression=compression, is_dir=os.path.isdir(os.path.join(src, item)),
+                                      link_dest=link_dest)
+        if output != item and any(item + ending in names for ending in endings[1:]):
+            colliding_items.add(item)
+    return colliding_items
+
+
+def get_backup_output_size(output: str):
+    """
+    Returns the number of bytes a backup method wrote for an item
+
+    Parameters
+    ----------
+    output: str
+        path of the output, see get_item_output_path
+
+    Returns
+    -------
+    size: int
+        size in bytes of the output
+    """
+    if not os.path.lexists(output):
+        return 0
+    return scan_item(output)["size"]
+
+
+def backup_item_from_src_to_dst(src: str, dst: str, item: str, compression: str = None, scan: dict = None,
+                                hash_func: str = 'md5', cache=None, device_limit: int = None,
+                                compression_level: int = None, metrics: dict = None, copy_method: str = None,
+                                link_dest: str = None, adaptive_compression: bool = True,
+                                write_behind: int = None, limiter=None, journal=None, method: str = None,
+                                device_semaphores: dict = None):
+    """
+    Backups one file/folder from source to destination. Decide with compression about method.
+
+    Parameters
+    ----------
+    src: str
+        path where the item is located
+    dst: str
+        path where backup should be stored
+    item: str
+        name of file/folder to be backuped
+    compression: str
+        indicator which compression method should be used
+    scan: dict
+        result of scan_item for the item. Used by the single pass method, the item is scanned here if None
+    hash_func: str
+        method of hash algorithm for the single pass method
+    cache: sqlite3.Connection
+        opened hash cache, hashes built while copying are stored there
+    device_limit: int
+        number of parallel jobs per device of src and dst, see get_device_semaphores
+    compression_level: int
+        level of the used compression, default of the method if None
+    metrics: dict
+        metrics of the backup, bytes and duration of the item are recorded there (see backup_metrics)
+    copy_method: str
+        one of copy_engine.copy_methods for files and uncompressed folders. Copy through python while hashing if
+        None or "read_write"
+    link_dest: str
+        path to the previous backup folder. Uncompressed items are backuped as snapshot with hard links to it
+        (see backup_with_hard_links)
+    adaptive_compression: bool
+        zip archives and the chunk store decide per file if compressing is worth it (see compression_policy)
+    write_behind: int
+        number of buffers written by a writer thread while the next ones are read and hashed, for slow destinations
+        like network shares (see streaming_io.stream_file). streaming_io.write_behind_buffers if None
+    limiter: rate_limiter.RateLimiter
+        limits of read and written bytes and file operations per second, shared by all items. Not limited if None.
+        The methods ZIPFILE, shutil.make_archive and the plain copytree are not limited.
+    journal: backup_journal.BackupJournal
+        journal of the backup folder, the complete item is recorded there. Not recorded if None
+    method: str
+        description of the backup settings recorded in the journal, see get_journal_method
+    device_semaphores: dict
+        semaphores per device shared with the other running items, see new_device_semaphores. A new registry if
+        None
+
+    Returns
+    -------
+    hash: str
+        hash of the item if it was hashed while copying, else None
+    """
+    if device_limit is None:
+        device_limit = max_jobs_per_device
+    if device_semaphores is None:
+        device_semaphores = new_device_semaphores()
+
+    hash = None
+    with contextlib.ExitStack() as stack:
+        for semaphore in get_device_semaphores(paths=[src, dst], limit=device_limit,
+                                                registry=device_semaphores):
+            stack.enter_context(semaphore)
+
         print(f"\tProcessing backup for item <{item}> from src ({src}) to dst ({dst})")
         logger.debug(f"Processing backup for item <{item}> from src ({src}) to dst ({dst})")
         src_item = os.path.join(src, item)
-        dst_item = os.path.join(dst, item)
+        # written to a temp name and renamed when complete, outputs of an interrupted run are removed first
+        final_item = os.path.join(dst, item)
+        dst_item = backup_journal.get_partial_path(dst, item)
+        output = get_item_output_path(dst_item, compression=compression, is_dir=os.path.isdir(src_item),
+                                      link_dest=link_dest)
+        final_output = final_item + output[len(dst_item):]
+        previous_outputs = journal.get_recorded_outputs(item) if journal is not None else []
+        for path in set([output, final_output] + previous_outputs):
+            backup_journal.remove_output(path)
         start_time = datetime.now()
-        if os.path.isfile(src_item):
-            shutil.copyfile(src_item, dst_item)
+        if compression == "CHUNK_STORE":
+            logger.debug(f"Store and hash in deduplicated chunk store")
+            scan = scan if scan is not None else scan_item(src_item)
+            file_hashes, bytes_written = chunk_store.store_item(src=src_item, dst=dst_item, scan=scan,
+                                                                hash_func=hash_func,
+                                                                compression_level=compression_level,
+                                                                adaptive_compression=adaptive_compression,
+                                                                metrics=metrics, limiter=limiter)
+            if cache is not None:
+                for path, f in get_scanned_file_paths(scan):
+                    hash_cache.store_hash(cache, path, f[3], f[1], f[2], hash_func, file_hashes[f[0]])
+            if scan["is_dir"]:
+                hash = reduce_file_hashes(list(file_hashes.values()), hash_func=hash_func)
+            else:
+                hash = list(file_hashes.values())[0]
+            done_time = datetime.now()
+            logger.debug(f"Backup <{item}> from src ({src}) to dst ({dst}) done. Took {done_time - start_time}")
+            backup_metrics.record_item(metrics, item=item, phase="compress", bytes_read=scan["size"],
+                                       bytes_written=bytes_written,
+                                       seconds=(done_time - start_time).total_seconds())
+        elif link_dest is not None and compression in [None, "SINGLE_PASS_COPY"]:
+            logger.debug(f"Snapshot with hard links to {link_dest}")
+            scan = scan if scan is not None else scan_item(src_item)
+            hash, bytes_written = backup_with_hard_links(src=src_item, dst=dst_item, scan=scan,
+                                                         link_src=os.path.join(link_dest, item),
+                                                         copy_method=copy_method, hash_func=hash_func, cache=cache,
+                                                         write_behind=write_behind, limiter=limiter)
+            done_time = datetime.now()
+            logger.debug(f"Backup <{item}> from src ({src}) to dst ({dst}) done. Took {done_time - start_time}")
+            backup_metrics.record_item(metrics, item=item, phase="copy", bytes_read=scan["size"],
+                                       bytes_written=bytes_written,
+                                       seconds=(done_time - start_time).total_seconds())
+        elif os.path.isfile(src_item):
+            if copy_method not in [None, "read_write"]:
+                scan = scan if scan is not None else scan_item(src_item)
+                hash = backup_with_copy_engine(src=src_item, dst=dst_item, scan=scan, copy_method=copy_method,
+                                               hash_func=hash_func, cache=cache, limiter=limiter)
+            else:
+                hash = copy_file_and_hash(src_item, dst_item, hash_func=hash_func, write_behind=write_behind,
+                                          limiter=limiter)
+                # mtime is needed to link the file in the next snapshot
+                shutil.copystat(src_item, dst_item)
+            if cache is not None:
+                stat = os.stat(src_item)
+                hash_cache.store_hash(cache, os.path.abspath(src_item), stat.st_ino, stat.st_size,
+                                      stat.st_mtime_ns, hash_func, hash)
             done_time = datetime.now()
             logger.debug(f"Backup file <{item}> from src ({src}) to dst ({dst}) done. Took {done_time - start_time}")
+            if metrics is not None:
+                backup_metrics.record_item(metrics, item=item, phase="copy", bytes_read=os.path.getsize(src_item),
+                                           bytes_written=os.path.getsize(dst_item),
+                                           seconds=(done_time - start_time).total_seconds())
         elif os.path.isdir(src_item):
             if compression == "ZIPFILE":
                 logger.debug(f"Copy and compress with ZIP")
-                backup_folder_with_zipfile_method(src=src_item, dst=dst_item)
+                backup_folder_with_zipfile_method(src=src_item, dst=output)
             elif compression == "shutil.make_archive":
                 logger.debug(f"Copy and compress with shutil.make_archive")
                 shutil.make_archive(dst_item, "zip", src_item)
+            elif compression == "SINGLE_PASS":
+                logger.debug(f"Copy, compress and hash with single pass ZIP")
+                scan = scan if scan is not None else scan_item(src_item)
+                hash = backup_folder_single_pass(src=src_item, dst=output, scan=scan, hash_func=hash_func,
+                                                 cache=cache, compression_level=compression_level,
+                                                 adaptive_compression=adaptive_compression, metrics=metrics,
+                                                 write_behind=write_behind, limiter=limiter)
+            elif compression == "SINGLE_PASS_COPY" and copy_method not in [None, "read_write"]:
+                logger.debug(f"Copy with copy engine ({copy_method}) and NO compression")
+                scan = scan if scan is not None else scan_item(src_item)
+                hash = backup_with_copy_engine(src=src_item, dst=dst_item, scan=scan, copy_method=copy_method,
+                                               hash_func=hash_func, cache=cache, limiter=limiter)
+            elif compression == "SINGLE_PASS_COPY":
+                logger.debug(f"Copy and hash with single pass and NO compression")
+                scan = scan if scan is not None else scan_item(src_item)
+                hash = backup_folder_single_pass(src=src_item, dst=dst_item, scan=scan, compression=False,
+                                                 hash_func=hash_func, cache=cache, write_behind=write_behind,
+                                                 limiter=limiter)
+            elif compression in parallel_compression.codecs:
+                logger.debug(f"Copy, compress and hash with parallel {compression} tar stream")
+                scan = scan if scan is not None else scan_item(src_item)
+                file_hashes = parallel_compression.write_compressed_tar(src=src_item, dst=dst_item, scan=scan,
+                                                                        codec=compression, level=compression_level,
+                                                                        hash_func=hash_func, limiter=limiter)
+                if cache is not None:
+                    for path, f in get_scanned_file_paths(scan):
+                        hash_cache.store_hash(cache, path, f[3], f[1], f[2], hash_func, file_hashes[f[0]])
+                hash = reduce_file_hashes(list(file_hashes.values()), hash_func=hash_func)
             else:
                 logger.debug(f"Copy with NO compression")
                 shutil.copytree(src_item, dst_item)
             done_time = datetime.now()
             logger.debug(f"Backup folder <{item}> from src ({src}) to dst ({dst}) done. Took {done_time - start_time}")
+            if metrics is not None:
+                phase = "copy" if compression in [None, "SINGLE_PASS_COPY"] else "compress"
+                bytes_read = scan["size"] if scan is not None else scan_item(src_item)["size"]
+                backup_metrics.record_item(metrics, item=item, phase=phase, bytes_read=bytes_read,
+                                           bytes_written=get_backup_output_size(output),
+                                           seconds=(done_time - start_time).total_seconds())
         else:
             logger.error(f"src_item ({src_item}) is not file nor folder! PROBLEM!!")
             raise Exception(f"src_item ({src_item}) is not file nor folder! PROBLEM!!")
 
+        committed = backup_journal.commit_output(output, final_output)
+        if journal is not None:
+            scan = scan if scan is not None else scan_item(src_item)
+            journal.record(item, fingerprint=scan["fingerprint"], method=method, hash=hash, outputs=[committed])
+
+    return hash
+
+
+def backup_items_from_src_to_dst(src: str, dst: str, items: list, compression: str = None, scans: dict = None,
+                                 hash_func: str = 'md5', cache=None, max_workers: int = 1, device_limit: int = None,
+                                 compression_level: int = None, metrics: dict = None, copy_method: str = None,
+                                 link_dest: str = None, adaptive_compression: bool = True,
+                                 write_behind: int = None, limiter=None, journal=None, all_items: list = None,
+                                 device_semaphores: dict = None):
+    """
+    Loops given items list and backup them from source to destination. Decide with compression about method.
+
+    Parameters
+    ----------
+    src: str
+        path where items are located
+    dst: str
+        path where backup should be stored
+    items: list
+        list of files/folders to be backuped
+    compression: str
+        indicator which compression method should be used
+    scans: dict
+        results of scan_item per item. Used by the single pass method, items without scan are scanned here
+    hash_func: str
+        method of hash algorithm for the single pass method
+    cache: sqlite3.Connection
+        opened hash cache, hashes built while copying are stored there
+    max_workers: int
+        number of items that are processed in parallel. Items get started in the given order
+    device_limit: int
+        number of parallel jobs per device of src and dst, see get_device_semaphores
+    compression_level: int
+        level of the used compression, default of the method if None
+    metrics: dict
+        metrics of the backup, bytes and duration of every item are recorded there (see backup_metrics)
+    copy_method: str
+        one of copy_engine.copy_methods for files and uncompressed folders, see backup_item_from_src_to_dst
+    link_dest: str
+        path to the previous backup folder for snapshots with hard links, see backup_item_from_src_to_dst
+    adaptive_compression: bool
+        decide per file if it is compressed, see backup_item_from_src_to_dst
+    write_behind: int
+        number of buffers written by a writer thread, see backup_item_from_src_to_dst
+    limiter: rate_limiter.RateLimiter
+        limits shared by all items, see backup_item_from_src_to_dst
+    journal: backup_journal.BackupJournal
+        journal of the backup folder. Items it holds as complete with the same source fingerprint and settings are
+        skipped (resume of an interrupted backup), all others are recorded when they are complete
+    all_items: list
+        names of all items of src (files and folders). Items whose output would clash with one of them are stored
+        uncompressed, see get_colliding_items. items if None
+    device_semaphores: dict
+        semaphores per device shared with other running backups, see new_device_semaphores. A new registry for the
+        items if None
+
+    Returns
+    -------
+    hashes: dict
+        hash per item, only filled for items that were hashed while copying
+    """
+    hashes = {}
+    if scans is None:
+        scans = {}
+    if device_semaphores is None:
+        device_semaphores = new_device_semaphores()
+
+    compressions = {item: compression for item in items}
+    colliding_items = get_colliding_items(src=src, items=all_items if all_items is not None else items,
+                                          compression=compression, link_dest=link_dest)
+    for item in colliding_items.intersection(items):
+        logger.warning(f"Output of <{item}> with {compression} would clash with another item of {src}. "
+                       f"Store it uncompressed.")
+        compressions[item] = "SINGLE_PASS_COPY"
+    methods = {item: get_journal_method(compression=compressions[item], compression_level=compression_level,
+                                        copy_method=copy_method, link_dest=link_dest,
+                                        adaptive_compression=adaptive_compression, hash_func=hash_func)
+               for item in items}
+    if journal is not None:
+        todo = []
+        for item in items:
+            if item not in scans:
+                scans[item] = scan_item(os.path.join(src, item))
+            entry = journal.get_done(item, fingerprint=scans[item]["fingerprint"], method=methods[item])
+            if entry is None:
+                todo.append(item)
+            else:
+                logger.debug(f"Item <{item}> is complete in the journal of {dst}. Skip it.")
+                hashes[item] = entry["hash"]
+        if len(todo) < len(items):
+            print(f"\tResume: {len(items) - len(todo)} of {len(items)} items are already backuped")
+        items = todo
+    backup_metrics.record_files(metrics, sum(len(scans[item]["files"]) for item in items if item in scans))
+
+    item_kwargs = {"src": src, "dst": dst, "hash_func": hash_func, "cache": cache,
+                   "device_limit": device_limit, "compression_level": compression_level, "metrics": metrics,
+                   "copy_method": copy_method, "link_dest": link_dest, "adaptive_compression": adaptive_compression,
+                   "write_behind": write_behind, "limiter": limiter, "journal": journal,
+                   "device_semaphores": device_semaphores}
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            hashes[item] = backup_item_from_src_to_dst(item=item, scan=scans.get(item),
+                                                       compression=compressions[item], method=methods[item],
+                                                       **item_kwargs)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {item: executor.submit(backup_item_from_src_to_dst, item=item, scan=scans.get(item),
+                                             compression=compressions[item], method=methods[item], **item_kwargs)
+                       for item in items}
+            for item, future in futures.items():
+                hashes[item] = future.result()
+
+    return {item: hash for item, hash in hashes.items() if hash is not None}
+
+
+def get_journal_method(compression: str = None, compression_level: int = None, copy_method: str = None,
+                       link_dest: str = None, adaptive_compression: bool = True, hash_func: str = 'md5'):
+    """
+    Returns the settings that decide how an item is stored and hashed as string. An item in the journal of an
+    interrupted backup is only reused if the settings are the same.
+    """
+    return json.dumps({"compression": compression, "compression_level": compression_level,
+                       "copy_method": copy_method, "link_dest": link_dest,
+                       "adaptive_compression": adaptive_compression, "hash_func": hash_func}, sort_keys=True)
+
 
 def get_dir_size(path: str):
     """
@@ -203,26 +1301,10 @@ def get_dir_size(path: str):
     total_size: int
         Size of given Path in bytes
     """
-    total_size = 0
-
-    if os.path.isdir(path):
-        for dirpath, dirnames, filenames in os.walk(path):
-            for i in filenames:
-                # use join to concatenate all the components of path
-                f = os.path.join(dirpath, i)
-
-                # use getsize to generate size in bytes and add it to the total size
-                total_size += os.path.getsize(f)
-
-    elif os.path.isfile(path):
-        total_size = os.path.getsize(path)
-    else:
-        raise Exception("Should not be reached!!")
-
-    return total_size
+    return scan_item(path)["size"]
 
 
-def get_size_and_sort_ascending_order(path: str, items_list: list):
+def get_size_and_sort_ascending_order(path: str, items_list: list, scans: dict = None):
     """
     Calculates size of given directories/files list and sorts them in ascending order.
 
@@ -232,6 +1314,8 @@ def get_size_and_sort_ascending_order(path: str, items_list: list):
         Path to given files/directories
     items_list: list
         list of directories/files
+    scans: dict
+        results of scan_item per item. Sizes are taken from here instead of walking the items again
 
     Returns
     -------
@@ -244,8 +1328,10 @@ def get_size_and_sort_ascending_order(path: str, items_list: list):
     items_w_sizes = []
 
     for item in items_list:
-        item_path = os.path.join(path, item)
-        size = get_dir_size(item_path)
+        if scans is not None and item in scans:
+            size = scans[item]["size"]
+        else:
+            size = get_dir_size(os.path.join(path, item))
         items_w_sizes.append((item, size))
 
     items_w_sizes.sort(key=lambda x: x[1])
@@ -256,9 +1342,11 @@ def get_size_and_sort_ascending_order(path: str, items_list: list):
     return sorted_items, items_w_sizes
 
 
-def build_checksum_of_directory(dir: str, ex_files: list = [], ex_ext: list = [], hash_func: str = 'sha256'):
+def build_checksum_of_directory(dir: str, ex_files: list = [], ex_ext: list = [], hash_func: str = 'sha256',
+                                cache=None):
     """
-    Builds a checksum of the given directory to check for changes. Uses https://pypi.org/project/checksumdir/
+    Builds a checksum of the given directory to check for changes. Same result as dirhash of
+    https://pypi.org/project/checksumdir/
 
     Parameters
     ----------
@@ -270,22 +1358,28 @@ def build_checksum_of_directory(dir: str, ex_files: list = [], ex_ext: list = []
         list of file extensions to be excluded from the hash creation
     hash_func: str
         method of hash algorithm
+    cache: sqlite3.Connection
+        opened hash cache. Only folders with changed fingerprint are looked at and only files with changed inode,
+        size or mtime are read if given (see get_tree_file_hashes)
 
     Returns
     -------
     hash: str
         hash string of given directory
     """
-    allowed_hash_functions = ['md5', 'sha1', 'sha256']  # fast, but "insecure" --> slow but more secure
-
-    if os.path.exists(dir) and hash_func in allowed_hash_functions:
-        hash = dirhash(dir, hash_func, excluded_files=ex_files, excluded_extensions=ex_ext)
-        return hash
+    if os.path.exists(dir) and hash_functions.is_available(hash_func):
+        if cache is not None and not ex_files and not ex_ext:
+            file_hashes = get_tree_file_hashes(scan_item(dir), hash_func=hash_func, cache=cache)
+            return reduce_file_hashes(file_hashes, hash_func=hash_func)
+        paths = [(path, f) for path, f in get_scanned_file_paths(scan_item(dir))
+                 if os.path.basename(path) not in ex_files and os.path.basename(path).split(".")[-1] not in ex_ext]
+        file_hashes = build_hashes_of_scanned_files(paths, hash_func=hash_func, cache=cache)
+        return reduce_file_hashes(file_hashes, hash_func=hash_func)
     else:
         return None
 
 
-def build_hash_of_file(filepath: str, hash_func: str = 'sha256'):
+def build_hash_of_file(filepath: str, hash_func: str = 'sha256', cache=None, signature: tuple = None):
     """
     Returns a hash string of given file with hashlib
 
@@ -294,30 +1388,88 @@ def build_hash_of_file(filepath: str, hash_func: str = 'sha256'):
     filepath: str
         path to file to be hashed
     hash_func: str
-        indicator for hash function to be used. one of ['md5', 'sha1', 'sha256']
+        indicator for hash function to be used, one of hash_functions.get_available_hash_functions()
+    cache: sqlite3.Connection
+        opened hash cache. The file is only read if its inode, size or mtime changed since the cached hash
+    signature: tuple
+        (size, mtime_ns, inode) of the file if already known from a scan, else the file gets stat'ed
 
     Returns
     -------
     hash: str
         hexdigest of created file hash as string
     """
-    allowed_hash_functions = ['md5', 'sha1', 'sha256']  # fast, but "insecure" --> slow but more secure
-    buf_size = 65536
-
-    if os.path.exists(filepath) and os.path.isfile(filepath) and hash_func in allowed_hash_functions:
-        hash = eval("hashlib." + hash_func + "()")
-        with open(filepath, 'rb') as f:
-            while True:
-                data = f.read(buf_size)
-                if not data:
-                    break
-                hash.update(data)
-        return hash.hexdigest()
+    # a scanned file is known to exist, the checks would cost two more stat calls per file
+    if hash_functions.is_available(hash_func) and (signature is not None or os.path.isfile(filepath)):
+        if cache is not None:
+            if signature is None:
+                stat = os.stat(filepath)
+                signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            size, mtime_ns, ino = signature
+            abs_path = os.path.abspath(filepath)
+            cached_hash = hash_cache.get_cached_hash(cache, abs_path, ino, size, mtime_ns, hash_func)
+            if cached_hash is None:
+                cached_hash = build_hash_of_file(filepath=filepath, hash_func=hash_func)
+                hash_cache.store_hash(cache, abs_path, ino, size, mtime_ns, hash_func, cached_hash)
+            return cached_hash
+
+        return hash_functions.hash_file(filepath, hash_func=hash_func)
     else:
         return None
 
 
-def update_info_dict_with_items(inf_dict: dict, src: str, items: list, prefix: str):
+def write_file_manifest(dst: str, scans: dict, file_name: str, hash_func: str = 'md5', cache=None):
+    """
+    Writes the binary file manifest (see file_manifest) of a backup with path (relative to the source), size, mtime
+    and hash of every file of the source. The hashes are taken from the hash cache, only files without valid cache
+    entry are read.
+
+    Parameters
+    ----------
+    dst: str
+        path to destination directory of the backup
+    scans: dict
+        results of scan_item (or get_recorded_scans) per item of the source
+    file_name: str
+        name of the manifest file in dst
+    hash_func: str
+        method of hash algorithm
+    cache: sqlite3.Connection
+        opened hash cache
+
+    Returns
+    -------
+    size: int
+        size of the written manifest in bytes
+    """
+    entries = []
+    for item, scan in scans.items():
+        paths = get_scanned_file_paths(scan)
+        if scan.get("recorded"):
+            hashes = [scan["file_hashes"][f[0]] for path, f in paths]
+        else:
+            cached_hashes = hash_cache.get_cached_hashes(cache, os.path.abspath(scan["path"]), hash_func) \
+                if cache is not None else None
+            hashes = build_hashes_of_scanned_files(paths, hash_func=hash_func, cache=cache,
+                                                   cached_hashes=cached_hashes)
+        for (path, f), hash in zip(paths, hashes):
+            entries.append((os.path.join(item, f[0]) if scan["is_dir"] else item, f[1], f[2], hash))
+    return file_manifest.write_manifest(os.path.join(dst, file_name), entries, hash_func=hash_func)
+
+
+def open_file_manifest(folder_path: str, info_dict: dict = None):
+    """
+    Opens the file manifest of a backup folder for lookups, None for backups without file manifest
+    """
+    info_dict = info_dict if info_dict is not None else load_info_dict_from_backup_folder(folder_path=folder_path)
+    if info_dict is None or info_dict.get("file_manifest") is None:
+        return None
+    return file_manifest.ManifestReader(os.path.join(folder_path, info_dict["file_manifest"]))
+
+
+def update_info_dict_with_items(inf_dict: dict, src: str, items: list, prefix: str, hashes: dict = None,
+                                scans: dict = None, references: dict = None, cache=None, hash_func: str = 'md5',
+                                max_workers: int = None):
     """
     Loops given list of items located in src. Collects some property information and writes everything to a info dict
 
@@ -331,36 +1483,239 @@ def update_info_dict_with_items(inf_dict: dict, src: str, items: list, prefix: s
         list of files/folders located in src
     prefix: str
         indicator for files or folder
+    hashes: dict
+        already known hashes per item (e.g. built while copying). Only missing hashes are calculated here
+    scans: dict
+        results of scan_item per item, used to record the mtime of the items
+    references: dict
+        name of the earlier backup folder per item, for items that were not copied again
+    cache: sqlite3.Connection
+        opened hash cache used for missing hashes
+    hash_func: str
+        method of hash algorithm for missing hashes
+    max_workers: int
+        number of items whose missing hashes are built in parallel, hash_functions.hash_workers if None
 
     Returns
     -------
     inf_dict: dict
         adjusted collection of information about backup process
     """
+    def build_hash(item):
+        if prefix == "file":
+            return build_hash_of_file(filepath=os.path.join(src, item), hash_func=hash_func, cache=cache)
+        elif prefix == "folder":
+            return build_checksum_of_directory(dir=os.path.join(src, item), hash_func=hash_func, cache=cache)
+        return None
+
+    missing = [item for item, size in items if hashes is None or item not in hashes]
+    missing_hashes = {}
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or hash_functions.hash_workers) as executor:
+            missing_hashes = dict(zip(missing, executor.map(build_hash, missing)))
+
     items_info = []
     for item_w_size in items:
         item = item_w_size[0]
         size = item_w_size[1]
         logger.debug(f"Append info_dict for {prefix} <{item}>")
-        if prefix == "file":
-            hash = build_hash_of_file(filepath=os.path.join(src, item), hash_func="md5")
-        elif prefix == "folder":
-            hash = build_checksum_of_directory(dir=os.path.join(src, item), hash_func='md5')
+        if item in missing_hashes:
+            hash = missing_hashes[item]
         else:
-            hash = None
+            hash = hashes[item]
 
         item_info = {
             f"{prefix}_name": item,
             f"{prefix}_size_in_bytes": size,
             f"{prefix}_hash": hash
             }
+        if scans is not None and item in scans:
+            item_info[f"{prefix}_mtime_ns"] = scans[item]["mtime_ns"]
+            item_info[f"{prefix}_fingerprint"] = scans[item]["fingerprint"]
+        if references is not None:
+            item_info[f"{prefix}_backup_reference"] = references.get(item)
         items_info.append(item_info)
 
     inf_dict[f"found_{prefix}s"] = items_info
     return inf_dict
 
 
-def perform_backup(src: str, dst: str):
+def split_changed_and_unchanged_items(dst: str, items: list, prefix: str, scans: dict, reference_dict: dict):
+    """
+    Compares the scanned items with the items of an earlier backup. An item is unchanged if its fingerprint (see
+    build_fingerprints) is the same as recorded in the earlier info dict and the earlier backup of it still exists.
+    Info dicts of older versions without fingerprint are compared by size and mtime.
+
+    Parameters
+    ----------
+    dst: str
+        path to destination directory of the current backup
+    items: list
+        list of names of files/folders to be backuped
+    prefix: str
+        indicator for files or folder
+    scans: dict
+        results of scan_item per item
+    reference_dict: dict
+        info dict of the earlier backup to compare with. Everything counts as changed if None
+
+    Returns
+    -------
+    changed_items: list
+        items that have to be backuped again, in the order of items
+    hashes: dict
+        recorded hash per unchanged item
+    references: dict
+        name of the backup folder that holds the data per unchanged item, None for changed items
+    """
+    changed_items, hashes, references = [], {}, {}
+    recorded_items = {}
+    reference_folder = None
+
+    if reference_dict is not None:
+        reference_folder = os.path.basename(os.path.normpath(reference_dict["destination_path"]))
+        for item_info in reference_dict.get(f"found_{prefix}s", []):
+            recorded_items[item_info[f"{prefix}_name"]] = item_info
+
+    backup_path = os.path.dirname(os.path.normpath(dst))
+    for item in items:
+        references[item] = None
+        item_info = recorded_items.get(item)
+        if item_info is None or f"{prefix}_mtime_ns" not in item_info:
+            changed_items.append(item)
+            continue
+
+        # unchanged items of the earlier backup point to the backup that really holds the data
+        data_folder = item_info.get(f"{prefix}_backup_reference") or reference_folder
+        data_path = os.path.join(backup_path, data_folder)
+        if f"{prefix}_fingerprint" in item_info:
+            unchanged = item_info[f"{prefix}_fingerprint"] == scans[item]["fingerprint"]
+        else:
+            unchanged = item_info[f"{prefix}_size_in_bytes"] == scans[item]["size"] \
+                        and item_info[f"{prefix}_mtime_ns"] == scans[item]["mtime_ns"]
+        if unchanged and os.path.isdir(data_path) and os.path.normpath(data_path) != os.path.normpath(dst):
+            hashes[item] = item_info[f"{prefix}_hash"]
+            references[item] = data_folder
+        else:
+            changed_items.append(item)
+
+    logger.debug(f"{len(changed_items)} of {len(items)} {prefix}s changed since backup {reference_folder}")
+    return changed_items, hashes, references
+
+
+def get_reference_info_dict(backup_path: str, latest_info_dict: dict, strategy: str):
+    """
+    Returns the info dict an incremental or differential backup has to be compared with.
+    Incremental backups and snapshots compare with the latest backup, differential backups with the latest full
+    backup.
+
+    Parameters
+    ----------
+    backup_path: str
+        path to folder where backups get stored
+    latest_info_dict: dict
+        info dict of the latest backup, result of analyze_existing_backups
+    strategy: str
+        one of backup_strategies
+
+    Returns
+    -------
+    reference_dict: dict
+        info dict to compare with, None if a full backup has to be done
+    """
+    if strategy not in backup_strategies:
+        logger.warning(f"Unknown backup strategy <{strategy}>. Do a full backup.")
+        return None
+
+    if strategy == "full" or latest_info_dict is None:
+        return None
+
+    if strategy in ["incremental", "snapshot"]:
+        return latest_info_dict
+
+    full_backup_folder = latest_info_dict.get("full_backup")
+    if full_backup_folder is None:
+        return None
+    full_backup_path = os.path.join(backup_path, full_backup_folder)
+    if not os.path.isdir(full_backup_path):
+        logger.debug(f"Latest full backup does not exist anymore ({full_backup_path})")
+        return None
+    return load_info_dict_from_backup_folder(folder_path=full_backup_path)
+
+
+def get_recorded_scans(src: str, dst: str, reference_dict: dict, dirty_items: set):
+    """
+    Builds the scans of the items that did not change since the reference backup according to the watch journal
+    (see change_watcher) from the info dict and the file manifest of the reference backup, without walking them.
+
+    Parameters
+    ----------
+    src: str
+        path to source directory
+    dst: str
+        path to destination directory of the current backup
+    reference_dict: dict
+        info dict of the reference backup
+    dirty_items: set
+        names of the items that changed since the reference backup started
+
+    Returns
+    -------
+    scans: dict
+        scan per unchanged item with the keys of scan_item (inode 0, no folders) and "recorded": True and
+        "file_hashes" (recorded hash per relative file path). Empty if the reference backup has no file manifest.
+    """
+    reference_folder = os.path.join(os.path.dirname(os.path.normpath(dst)),
+                                    os.path.basename(os.path.normpath(reference_dict["destination_path"])))
+    manifest = open_file_manifest(reference_folder, info_dict=reference_dict)
+    if manifest is None or manifest.hash_func != get_hash_func(reference_dict):
+        return {}
+
+    scans = {}
+    for prefix in ["file", "folder"]:
+        for item_info in reference_dict.get(f"found_{prefix}s", []):
+            item = item_info[f"{prefix}_name"]
+            if item in dirty_items or f"{prefix}_fingerprint" not in item_info:
+                continue
+            if prefix == "folder":
+                entries = [(os.path.relpath(path, item), size, mtime_ns, hash)
+                           for path, size, mtime_ns, hash in manifest.iter_prefix(item + os.sep)]
+            else:
+                recorded = manifest.lookup(item)
+                entries = [(item, *recorded)] if recorded is not None else []
+            if prefix == "file" and len(entries) == 0:
+                continue
+            scans[item] = {
+                "path": os.path.join(src, item),
+                "is_dir": prefix == "folder",
+                "size": item_info[f"{prefix}_size_in_bytes"],
+                "mtime_ns": item_info[f"{prefix}_mtime_ns"],
+                "dirs": [],
+                "files": [(rel_path, size, mtime_ns, 0) for rel_path, size, mtime_ns, hash in entries],
+                "fingerprint": item_info[f"{prefix}_fingerprint"],
+                "dir_fingerprints": {"": item_info[f"{prefix}_fingerprint"]},
+                "recorded": True,
+                "file_hashes": {rel_path: hash for rel_path, size, mtime_ns, hash in entries}
+            }
+    logger.debug(f"{len(scans)} items taken from the manifest of {reference_folder} without scanning")
+    return scans
+
+
+def rescan_recorded_items(src: str, scans: dict, items: list):
+    """
+    Replaces recorded scans (see get_recorded_scans) of the given items by real scans, e.g. for items that have to
+    be backuped because the data of the reference backup is missing
+    """
+    for item in items:
+        if scans[item].get("recorded"):
+            scans[item] = scan_item(os.path.join(src, item))
+
+
+def perform_backup(src: str, dst: str, strategy: str = "full", reference_dict: dict = None, cache=None,
+                   max_workers: int = 1, device_limit: int = None, compression: str = "SINGLE_PASS",
+                   compression_level: int = None, metrics_prometheus: str = None, metrics_jsonl: str = None,
+                   copy_method: str = None, adaptive_compression: bool = True, write_behind: int = None,
+                   limiter=None, dirty_items: set = None, hash_func: str = 'md5', device_semaphores: dict = None):
     """
     Performs a backup from src directory to destination directory. Collection of function calls
 
@@ -370,15 +1725,93 @@ def perform_backup(src: str, dst: str):
         path to source directory of backup
     dst: str
         path to destination directory of backup
+    strategy: str
+        one of backup_strategies. "snapshot" hard links unchanged files of uncompressed items to the backup of
+        reference_dict, other strategies only use it for the info dict. A ValueError is raised for snapshots with
+        compression.
+    reference_dict: dict
+        info dict of an earlier backup. Unchanged items are not copied again but referenced to that backup.
+        Everything gets copied if None (full backup)
+    cache: sqlite3.Connection
+        opened hash cache. Hashes built while copying are stored, entries of deleted source files are evicted
+    max_workers: int
+        number of top-level items that are processed in parallel
+    device_limit: int
+        number of parallel jobs per device of src and dst
+    compression: str
+        compression method for folders, see backup_item_from_src_to_dst
+    compression_level: int
+        level of the compression, default of the method if None
+    metrics_prometheus: str
+        path to a Prometheus textfile the metrics of the backup are written to, no export if None
+    metrics_jsonl: str
+        path to a JSON-lines file the metrics of the backup are appended to, no export if None
+    copy_method: str
+        one of copy_engine.copy_methods for files and uncompressed folders, copy through python if None
+    adaptive_compression: bool
+        decide per file if it is compressed (zip and chunk store), else every file is compressed
+    write_behind: int
+        number of buffers written by a writer thread per file, for slow destinations (see streaming_io.stream_file)
+    limiter: rate_limiter.RateLimiter
+        limits of read and written bytes and file operations per second, not limited if None. The seconds waited
+        for every limit are recorded as "throttling" in the metrics
+    dirty_items: set
+        items that changed since the reference backup according to the watch journal (see change_watcher). All
+        other items of the reference backup are not scanned. Every item is scanned if None
+    hash_func: str
+        hash algorithm of the backup, one of hash_functions.get_available_hash_functions(). Recorded as "hash_func"
+        in the info dict. A reference backup with another algorithm can not be used, the backup is a full one.
+    device_semaphores: dict
+        semaphores per device shared with other running backups, see new_device_semaphores. A new registry for
+        this backup if None
+
+    Returns
+    -------
+    info_dict: dict
+        information about the backup as written to the backup_information file. Its "metrics" hold the time per
+        phase and bytes, MB/s and compression ratio per item, the same values as the exports.
     """
+    backup_start = time.perf_counter()
+    metrics = backup_metrics.new_metrics()
+    if device_semaphores is None:
+        device_semaphores = new_device_semaphores()
+    # fails before anything is written if the algorithm is unknown or its package is missing
+    hash_functions.get_constructor(hash_func)
+    # items of an interrupted run of this backup folder are not backuped again
+    journal = backup_journal.open_journal(dst)
+
+    # recorded hashes of unchanged items have to be of the same algorithm as the new ones
+    if reference_dict is not None and get_hash_func(reference_dict) != hash_func:
+        logger.warning(f"Reference backup uses hash {get_hash_func(reference_dict)}, not {hash_func}. "
+                       f"Do a full backup.")
+        reference_dict = None
+
+    # snapshots are complete trees, unchanged files are hard linked instead of referenced
+    if strategy == "snapshot" and compression != "SINGLE_PASS_COPY":
+        raise ValueError(f"Snapshots are only possible without compression, not with {compression}")
+    link_dest = None
+    if strategy == "snapshot" and reference_dict is not None:
+        link_dest = os.path.join(os.path.dirname(os.path.normpath(dst)),
+                                 os.path.basename(os.path.normpath(reference_dict["destination_path"])))
     dir_content = os.listdir(src)
     files, folders = [], []
     info_dict = {
         "start_time": datetime.now().strftime('%Y%m%d_%H%M%S'),
         "end_time": "",
         "source_path": src,
-        "destination_path": dst
+        "destination_path": dst,
+        "strategy": strategy if reference_dict is not None else "full",
+        "reference_backup": None,
+        "full_backup": os.path.basename(os.path.normpath(dst)),
+        "hash_func": hash_func,
+        "compression": compression
     }
+    if reference_dict is not None and link_dest is None:
+        info_dict["reference_backup"] = os.path.basename(os.path.normpath(reference_dict["destination_path"]))
+        info_dict["full_backup"] = reference_dict.get("full_backup")
+    elif link_dest is not None:
+        info_dict["reference_backup"] = os.path.basename(link_dest)
+        reference_dict = None
 
     for content in dir_content:
         if os.path.isfile(os.path.join(src, content)):
@@ -388,30 +1821,112 @@ def perform_backup(src: str, dst: str):
     logger.debug(f"Found {len(files)} files in total in src: {files}")
     logger.debug(f"Found {len(folders)} folders in total in src: {folders}")
 
-    if len(files) > 0:
-        logger.debug("Start building info_dict for files and then backup them")
-        files_sorted, files_with_sizes = get_size_and_sort_ascending_order(path=src, items_list=files)
-        info_dict = update_info_dict_with_items(inf_dict=info_dict, src=src, items=files_with_sizes, prefix="file")
+    # walk every item only once, sizes and file lists are reused for hashing and archiving
+    with backup_metrics.measure_phase(metrics, "scan"):
+        scans = {}
+        if dirty_items is not None and reference_dict is not None:
+            scans = get_recorded_scans(src=src, dst=dst, reference_dict=reference_dict, dirty_items=dirty_items)
+            info_dict["watched_items"] = {"recorded": len(scans), "scanned": len(files + folders) - len(scans)}
+        scans = {content: scans.get(content) or scan_item(os.path.join(src, content)) for content in files + folders}
 
-        backup_items_from_src_to_dst(src=src, dst=dst, items=files_sorted)
+    if len(files) > 0:
+        logger.debug("Start backup of files and build info_dict for them")
+        with backup_metrics.measure_phase(metrics, "size"):
+            files_sorted, files_with_sizes = get_size_and_sort_ascending_order(path=src, items_list=files,
+                                                                               scans=scans)
+        with backup_metrics.measure_phase(metrics, "compare"):
+            files_changed, hashes, references = split_changed_and_unchanged_items(dst=dst, items=files_sorted,
+                                                                                  prefix="file", scans=scans,
+                                                                                  reference_dict=reference_dict)
+            rescan_recorded_items(src=src, scans=scans, items=files_changed)
+        # files are only copied, except for the chunk store where everything is deduplicated
+        file_compression = compression if compression == "CHUNK_STORE" else None
+        hashes.update(backup_items_from_src_to_dst(src=src, dst=dst, items=files_changed, scans=scans, cache=cache,
+                                                   max_workers=max_workers, device_limit=device_limit,
+                                                   compression=file_compression,
+                                                   compression_level=compression_level, metrics=metrics,
+                                                   copy_method=copy_method, link_dest=link_dest,
+                                                   adaptive_compression=adaptive_compression,
+                                                   write_behind=write_behind, limiter=limiter, journal=journal,
+                                                   hash_func=hash_func, all_items=files + folders,
+                                                   device_semaphores=device_semaphores))
+        with backup_metrics.measure_phase(metrics, "hash"):
+            info_dict = update_info_dict_with_items(inf_dict=info_dict, src=src, items=files_with_sizes,
+                                                    prefix="file", hashes=hashes, scans=scans, references=references,
+                                                    cache=cache, hash_func=hash_func)
 
     if len(folders) > 0:
-        logger.debug("Start building info_dict for folders and then backup them")
-        folders_sorted, folders_with_sizes = get_size_and_sort_ascending_order(path=src, items_list=folders)
-        info_dict = update_info_dict_with_items(inf_dict=info_dict, src=src, items=folders_with_sizes, prefix="folder")
-
+        logger.debug("Start backup of folders and build info_dict for them")
+        with backup_metrics.measure_phase(metrics, "size"):
+            folders_sorted, folders_with_sizes = get_size_and_sort_ascending_order(path=src, items_list=folders,
+                                                                                   scans=scans)
         # backup_items_from_src_to_dst(src=src, dst=dst, items=folders_sorted, compression="ZIPFILE")
-        backup_items_from_src_to_dst(src=src, dst=dst, items=folders_sorted, compression="shutil.make_archive")
+        # backup_items_from_src_to_dst(src=src, dst=dst, items=folders_sorted, compression="shutil.make_archive")
+        with backup_metrics.measure_phase(metrics, "compare"):
+            folders_changed, hashes, references = split_changed_and_unchanged_items(dst=dst, items=folders_sorted,
+                                                                                    prefix="folder", scans=scans,
+                                                                                    reference_dict=reference_dict)
+            rescan_recorded_items(src=src, scans=scans, items=folders_changed)
+        hashes.update(backup_items_from_src_to_dst(src=src, dst=dst, items=folders_changed,
+                                                   compression=compression, scans=scans, cache=cache,
+                                                   max_workers=max_workers, device_limit=device_limit,
+                                                   compression_level=compression_level, metrics=metrics,
+                                                   copy_method=copy_method, link_dest=link_dest,
+                                                   adaptive_compression=adaptive_compression,
+                                                   write_behind=write_behind, limiter=limiter, journal=journal,
+                                                   hash_func=hash_func, all_items=files + folders,
+                                                   device_semaphores=device_semaphores))
+        with backup_metrics.measure_phase(metrics, "hash"):
+            info_dict = update_info_dict_with_items(inf_dict=info_dict, src=src, items=folders_with_sizes,
+                                                    prefix="folder", hashes=hashes, scans=scans,
+                                                    references=references, cache=cache, hash_func=hash_func)
+
+    if cache is not None:
+        with backup_metrics.measure_phase(metrics, "write_manifest"):
+            info_dict["file_manifest"] = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}{file_manifest.manifest_ending}"
+            write_file_manifest(dst=dst, scans=scans, file_name=info_dict["file_manifest"], hash_func=hash_func,
+                                cache=cache)
+        with backup_metrics.measure_phase(metrics, "hash"):
+            seen_paths = {path for scan in scans.values() for path, f in get_scanned_file_paths(scan)}
+            hash_cache.evict_deleted_files(cache, os.path.abspath(src), seen_paths)
 
     # write information to dst folder
     logger.debug("Start writing backup info_dict to disk")
     info_dict["end_time"] = datetime.now().strftime('%Y%m%d_%H%M%S')
-    file_content_txt = json.dumps(info_dict, indent=4)
+    if limiter is not None:
+        metrics["throttling"] = limiter.get_stats()
+    # the metrics are finalized once and the info file holds them, so the write of the info file itself is not in
+    # the phases. The exports below get the same metrics as the info file.
+    info_dict["metrics"] = backup_metrics.finalize_metrics(metrics, seconds=time.perf_counter() - backup_start)
     file_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_backup_information.txt"
-    with open(os.path.join(dst, file_name), "w") as file:
+    info_dict["info_file"] = file_name
+    file_content_txt = json.dumps(info_dict, indent=4)
+    # the info file marks the backup as complete, so it is written to a temp file and renamed
+    with open(os.path.join(dst, file_name + ".tmp"), "w") as file:
         file.write(file_content_txt)
+    os.replace(os.path.join(dst, file_name + ".tmp"), os.path.join(dst, file_name))
+    journal.finish()
     logger.debug(f"Backup info_dict written to {file_name}")
 
+    if metrics_prometheus is not None or metrics_jsonl is not None:
+        if metrics_prometheus is not None:
+            backup_metrics.write_prometheus_textfile(metrics, path=metrics_prometheus,
+                                                     labels={"source": src, "destination": os.path.dirname(dst)})
+        if metrics_jsonl is not None:
+            backup_metrics.append_jsonl(metrics, path=metrics_jsonl,
+                                        info={key: info_dict[key] for key in ["start_time", "end_time",
+                                                                              "source_path", "destination_path",
+                                                                              "strategy"]})
+
+    return info_dict
+
+
+def get_hash_func(info_dict: dict):
+    """
+    Returns the hash algorithm of a backup, backups of older versions without "hash_func" used md5
+    """
+    return info_dict.get("hash_func") or hash_functions.default_hash_func
+
 
 def load_info_dict_from_backup_folder(folder_path: str):
     """
@@ -427,38 +1942,47 @@ def load_info_dict_from_backup_folder(folder_path: str):
     dict: dict
         loaded dictionary from folder path
     """
-
-    folder_cont = os.listdir(folder_path)
-    backup_file_name = ""
-    logger.debug(f"Loop path content to find backup_information file.")
-    for entry in folder_cont:
-        entry_path = os.path.join(folder_path, entry)
-        if os.path.isfile(entry_path) and "backup_information" in entry:
-            backup_file_name = entry
-
-    if backup_file_name == "":
-        logger.error("File could not be found. Return None")
-        return None
+    # the catalog knows the file name, the folder only has to be searched for backups without catalog
+    info_file_path = backup_catalog.get_info_file_path(backup_path=os.path.dirname(os.path.normpath(folder_path)),
+                                                       folder=os.path.basename(os.path.normpath(folder_path)))
+    if info_file_path is None or not os.path.isfile(info_file_path):
+        folder_cont = os.listdir(folder_path)
+        backup_file_name = ""
+        logger.debug(f"Loop path content to find backup_information file.")
+        for entry in folder_cont:
+            entry_path = os.path.join(folder_path, entry)
+            if os.path.isfile(entry_path) and "backup_information" in entry:
+                backup_file_name = entry
+
+        if backup_file_name == "":
+            logger.error("File could not be found. Return None")
+            return None
+        info_file_path = os.path.join(folder_path, backup_file_name)
 
     # Load file
-    with open(os.path.join(folder_path, backup_file_name), 'r', encoding='utf-8') as f:
+    with open(info_file_path, 'r', encoding='utf-8') as f:
         dict = json.load(f)
     logger.debug(f"Content of latest backup info file: {dict}")
 
     return dict
 
 
-def analyze_existing_backups(backup_path: str, max_num_backups: int = 3):
+def analyze_existing_backups(backup_path: str, max_num_backups: int = 3, retention: dict = None,
+                             background: bool = True):
     """
-    Analyzes the given path for backups and delete existing backups if more than given number exists and loads the
-    information dictionary about the latest backup.
+    Analyzes the given path for backups with the backup catalog, deletes the backups that are not kept by the
+    retention policy and loads the information dictionary about the latest backup.
 
     Parameters
     ----------
     backup_path: str
         path to folder where backups get stored
     max_num_backups: int
-        Limit of existing backups
+        Limit of existing backups (including the new one), used as keep_last if retention does not set it
+    retention: dict
+        retention policy, see backup_catalog.select_backups_to_delete
+    background: bool
+        delete old backups in a background thread while the new backup runs (see backup_catalog.wait_for_pruning)
 
     Returns
     -------
@@ -468,31 +1992,22 @@ def analyze_existing_backups(backup_path: str, max_num_backups: int = 3):
     latest_backup_dict = None
 
     if os.path.exists(backup_path) and os.path.isdir(backup_path):
-        folder_content = os.listdir(backup_path)
-        if len(folder_content) > 0:
-            backup_folders = []
-            for f in folder_content:
-                f_path = os.path.join(backup_path, f)
-                logger.debug(f"Checking file/folder {f}")
-                if os.path.isdir(f_path) and "backup" in f:
-                    backup_folders.append(f)
-
-            sorted_backup_folders = sorted(backup_folders, reverse=True)
-            logger.debug(f"Found {len(sorted_backup_folders)} folders.")
-            logger.debug(f"backup_folders: {sorted_backup_folders}")
-
-            # delete backups if too many exist
-            while len(sorted_backup_folders) >= max_num_backups:
-                folder_to_delete = sorted_backup_folders.pop()
-                logger.debug(f"folder_to_delete: {folder_to_delete}")
-                shutil.rmtree(os.path.join(backup_path, folder_to_delete))
-
-            # load latest info dict
-            if len(sorted_backup_folders) > 0:
-                still_existing_backups = sorted(sorted_backup_folders, reverse=True)
-                backup_folder_path = os.path.join(backup_path, still_existing_backups[0])
-                logger.debug(f"Latest backup folder path: {backup_folder_path}")
-                latest_backup_dict = load_info_dict_from_backup_folder(folder_path=backup_folder_path)
+        catalog = backup_catalog.load_catalog(backup_path)
+        logger.debug(f"Found {len(catalog['backups'])} backups in catalog: {sorted(catalog['backups'])}")
+
+        # delete backups that are not kept, backups that still hold data of kept backups are kept
+        retention = {"keep_last": max_num_backups, **{key: value for key, value in (retention or {}).items()
+                                                      if value is not None}}
+        folders_to_delete = backup_catalog.select_backups_to_delete(catalog, retention=retention)
+        logger.debug(f"folders_to_delete: {folders_to_delete}")
+        backup_catalog.delete_backups(backup_path, folders_to_delete, background=background)
+
+        # load latest info dict
+        latest_entry = backup_catalog.get_latest_backup(catalog)
+        if latest_entry is not None and latest_entry["folder"] not in folders_to_delete:
+            backup_folder_path = os.path.join(backup_path, latest_entry["folder"])
+            logger.debug(f"Latest backup folder path: {backup_folder_path}")
+            latest_backup_dict = load_info_dict_from_backup_folder(folder_path=backup_folder_path)
 
     else:
         print("Could not load info about latest backup. Either no backup exists or given path is invalid.")
@@ -501,16 +2016,178 @@ def analyze_existing_backups(backup_path: str, max_num_backups: int = 3):
     return latest_backup_dict
 
 
-def check_for_shutdown(instr):
+def get_backup_items(folder_path: str, items: list = None):
+    """
+    Returns the recorded items of a backup together with the backup folder that really holds their data
+
+    Parameters
+    ----------
+    folder_path: str
+        path to the backup folder
+    items: list
+        names of the items to return, all recorded items if None
+
+    Returns
+    -------
+    backup_items: list
+        tuples of (prefix, item info of the info dict, path to the folder with the data of the item)
+    """
+    info_dict = load_info_dict_from_backup_folder(folder_path=folder_path)
+    if info_dict is None:
+        raise FileNotFoundError(f"No backup information found in {folder_path}")
+
+    backup_path = os.path.dirname(os.path.normpath(folder_path))
+    backup_items = []
+    for prefix in ["file", "folder"]:
+        for item_info in info_dict.get(f"found_{prefix}s", []):
+            if items is not None and item_info[f"{prefix}_name"] not in items:
+                continue
+            reference = item_info.get(f"{prefix}_backup_reference")
+            data_folder = os.path.join(backup_path, reference) if reference is not None else folder_path
+            backup_items.append((prefix, item_info, data_folder))
+    return backup_items
+
+
+def verify_backup_item(prefix: str, item_info: dict, data_folder: str, hash_func: str = 'md5', workers: int = None,
+                       manifest: file_manifest.ManifestReader = None):
+    """
+    Reads the stored data of one item again and compares its hash with the hash recorded in the info dict.
+    If the item does not match and the file manifest of the backup is given, the files that differ are logged.
+
+    Returns
+    -------
+    status: str
+        "ok", "mismatch", "missing", "no hash" or "error: <message>"
+    """
+    item = item_info[f"{prefix}_name"]
+    recorded_hash = item_info.get(f"{prefix}_hash")
+    path, kind = restore_engine.find_stored_item(data_folder, item)
+    if path is None:
+        return "missing"
+    if recorded_hash is None:
+        return "no hash"
+    try:
+        file_hashes = restore_engine.hash_stored_item(path, kind, hash_func=hash_func, workers=workers)
+    except Exception as e:
+        logger.error(f"Reading of {path} failed: {e}")
+        return f"error: {e}"
+
+    if prefix == "file":
+        hash = list(file_hashes.values())[0] if len(file_hashes) == 1 else None
+    else:
+        hash = reduce_file_hashes(list(file_hashes.values()), hash_func=hash_func)
+    if hash == recorded_hash:
+        return "ok"
+
+    if manifest is not None and prefix == "folder":
+        stored = {os.path.join(item, os.path.normpath(rel_path)): hash for rel_path, hash in file_hashes.items()}
+        recorded = {path: hash for path, size, mtime_ns, hash in manifest.iter_prefix(os.path.join(item, ""))}
+        differing_files = sorted(path for path in set(stored) | set(recorded) if stored.get(path) != recorded.get(path))
+        logger.error(f"Files of <{item}> that differ from the file manifest: {differing_files}")
+    return "mismatch"
+
+
+def verify_backup(folder_path: str, items: list = None, max_workers: int = None, hash_func: str = None):
+    """
+    Verifies a backup: every item is read again from the backup (or the backup it references), its files are hashed
+    in parallel and compared with the hashes recorded in the info dict. Items are verified in parallel as well.
+
+    Parameters
+    ----------
+    folder_path: str
+        path to the backup folder to verify
+    items: list
+        names of the items to verify, all items if None
+    max_workers: int
+        number of items verified in parallel and number of files hashed in parallel per item, cpus if None
+    hash_func: str
+        method of hash algorithm used by the backup, taken from its info dict if None
+
+    Returns
+    -------
+    results: dict
+        status per item, see verify_backup_item
+    """
+    max_workers = max_workers or max_parallel_rows
+    if hash_func is None:
+        info_dict = load_info_dict_from_backup_folder(folder_path=folder_path)
+        hash_func = get_hash_func(info_dict) if info_dict is not None else hash_functions.default_hash_func
+    backup_items = get_backup_items(folder_path=folder_path, items=items)
+    manifest = open_file_manifest(folder_path=folder_path)
+    logger.debug(f"Verify {len(backup_items)} items of backup {folder_path}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {item_info[f"{prefix}_name"]: executor.submit(verify_backup_item, prefix, item_info, data_folder,
+                                                                hash_func, max_workers, manifest)
+                   for prefix, item_info, data_folder in backup_items}
+        results = {item: future.result() for item, future in futures.items()}
+
+    for item, status in results.items():
+        if status == "ok":
+            logger.debug(f"Verify <{item}>: {status}")
+        else:
+            logger.error(f"Verify <{item}>: {status}")
+            print(f"\tVerify <{item}>: {status}")
+    return results
+
+
+def restore_backup(folder_path: str, target: str, items: list = None, max_workers: int = None,
+                   copy_method: str = "auto"):
+    """
+    Restores items of a backup to target. Items are restored in parallel, files inside an item as well (except for
+    tar archives, which can only be read in order).
+
+    Parameters
+    ----------
+    folder_path: str
+        path to the backup folder to restore from
+    target: str
+        folder the items are restored into, created if not existing. Existing items are not overwritten
+    items: list
+        names of the items to restore, all items if None
+    max_workers: int
+        number of items restored in parallel and number of files restored in parallel per item, cpus if None
+    copy_method: str
+        one of copy_engine.copy_methods for uncompressed items
+
+    Returns
+    -------
+    restored_items: list
+        names of the restored items
+    """
+    max_workers = max_workers or max_parallel_rows
+    backup_items = get_backup_items(folder_path=folder_path, items=items)
+    os.makedirs(target, exist_ok=True)
+
+    def restore_item(prefix, item_info, data_folder):
+        item = item_info[f"{prefix}_name"]
+        target_item = os.path.join(target, item)
+        if os.path.exists(target_item):
+            raise FileExistsError(f"{target_item} already exists. Restore would overwrite it.")
+        path, kind = restore_engine.find_stored_item(data_folder, item)
+        if path is None:
+            raise FileNotFoundError(f"No data of item <{item}> found in {data_folder}")
+        print(f"\tRestore <{item}> from {path} to {target_item}")
+        restore_engine.restore_stored_item(path, kind, target_item, copy_method=copy_method, workers=max_workers)
+        return item
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(restore_item, *backup_item) for backup_item in backup_items]
+        restored_items = [future.result() for future in futures]
+    logger.debug(f"Restored {len(restored_items)} items of {folder_path} to {target}")
+    return restored_items
+
+
+def check_for_shutdown(instr, waittime: int = 120):
     logger.debug(f"Start shutdown method now")
     shutdown_list = []
-    for idx, row in instr.iterrows():
+    for row in instr:
         shut = bool(row["shutdown"])
         shutdown_list.append(shut)
 
     if all(shutdown_list):
         logger.debug(f"All entries in backup instructions show shutdown. Will perform shutdown now.")
-        wait_for_shutdown(waittime=120)
+        wait_for_shutdown(waittime=waittime)
     else:
         logger.debug(f"NOT all entries in backup instructions show shutdown. Will end script.")
         print(f"\n\nNOT all entries in backup instructions show shutdown. Will end script.")
@@ -542,40 +2219,415 @@ def wait_for_shutdown(waittime: int):
         print("  Continue processing...")
 
 
-def main():
-    main_start_time = datetime.now()
-    logger.debug("Start of main function of backup script")
-    backup_instr_pd = read_backup_instructions(path=instructions_foldername, file=instructions_filename)
+def get_row_value(row, header: str, default=None):
+    """
+    Returns the value of an optional column of the backup instructions or default if the column is missing or empty
+    """
+    if row.get(header) is None:
+        return default
+    return row[header]
+
+
+def run_backup_instruction(idx: int, row, device_semaphores: dict = None):
+    """
+    Performs the backup of one row of the backup instructions
+
+    Parameters
+    ----------
+    idx: int
+        index of the row in the backup instructions
+    row: dict
+        row of the backup instructions
+    device_semaphores: dict
+        semaphores per device shared with the other rows that run at the same time, see new_device_semaphores
+    """
+    for header in list(row):
+        logger.debug(f"Processing idx: {idx} with values: Header: {header}; Value: {row[header]}")
+
+    activation = bool(row["activate"])
+    if activation is True:
+        logger.debug(f"Value for activation: {activation}. Do the backup")
+        print(f"\n\nPerform backup instructions for row {idx} now.\n")
+
+        # checked before anything is written to the destination
+        compression = compression_methods.get(str(get_row_value(row, "compression", "zip")).lower())
+        if compression is None:
+            logger.error(f"Unknown compression <{row['compression']}>. Use one of {list(compression_methods)}")
+            print(f"Unknown compression <{row['compression']}>. No backup possible.")
+            return
+        if compression in parallel_compression.codecs \
+                and compression not in parallel_compression.get_available_codecs():
+            logger.error(f"Compression <{compression}> needs a package that is not installed. Use one of "
+                         f"{parallel_compression.get_available_codecs()} or install it")
+            print(f"Compression <{compression}> is not available. No backup possible.")
+            return
+        if row["strategy"] == "snapshot" and compression != "SINGLE_PASS_COPY":
+            logger.error(f"Strategy snapshot is only possible with compression none, not <{row['compression']}>")
+            print("Strategy snapshot needs compression none. No backup possible.")
+            return
+        if compression == "CHUNK_STORE" and not chunk_store.is_available():
+            logger.error("Compression <chunks> needs numpy, which is not installed. Install numpy or use another "
+                         "compression")
+            print("Compression <chunks> is not available. No backup possible.")
+            return
+
+        retention = {rule: get_row_value(row, rule) for rule in backup_catalog.default_retention}
+        latest_info_dict = analyze_existing_backups(backup_path=row["destination"], max_num_backups=3,
+                                                    retention=retention)
+
+        reference_dict = get_reference_info_dict(backup_path=row["destination"],
+                                                 latest_info_dict=latest_info_dict, strategy=row["strategy"])
+
+        source, destination = check_and_setup_directories(index=idx, src=row["source"], dst=row["destination"])
+
+        if source is None or destination is None:
+            backup_catalog.wait_for_pruning(row["destination"])
+            return
+        else:
+            compression_level = get_row_value(row, "compression_level")
+
+            backup_folder = os.path.basename(os.path.normpath(destination))
+            backup_catalog.update_entry(row["destination"], backup_folder, backup_catalog.new_entry(backup_folder))
+            limiter = rate_limiter.create_limiter(max_read_mb_s=get_row_value(row, "max_read_mb_s"),
+                                                  max_write_mb_s=get_row_value(row, "max_write_mb_s"),
+                                                  max_file_ops=get_row_value(row, "max_file_ops"))
+            nice = get_row_value(row, "nice")
+            dirty_items = None
+            if reference_dict is not None:
+                # only items that changed since the reference backup are scanned if a watcher runs for this row
+                since = datetime.strptime(reference_dict["start_time"], '%Y%m%d_%H%M%S').timestamp()
+                dirty_items = change_watcher.get_dirty_items(row["destination"], row["source"], since=since)
+            cache = hash_cache.open_hash_cache(row["destination"])
+            try:
+                # the backup runs in its own thread if its priority is lowered, its worker threads inherit it
+                info_dict = rate_limiter.run_with_priority(lambda: perform_backup(
+                    src=source, dst=destination, strategy=row["strategy"],
+                    reference_dict=reference_dict, cache=cache,
+                    max_workers=int(get_row_value(row, "parallel_items", 1)),
+                    device_limit=int(get_row_value(row, "max_jobs_per_device", max_jobs_per_device)),
+                    compression=compression,
+                    compression_level=None if compression_level is None else int(compression_level),
+                    metrics_prometheus=get_row_value(row, "metrics_prometheus"),
+                    metrics_jsonl=get_row_value(row, "metrics_jsonl"),
+                    copy_method=get_row_value(row, "copy_method"),
+                    adaptive_compression=bool(get_row_value(row, "adaptive_compression", True)),
+                    write_behind=int(get_row_value(row, "write_behind", streaming_io.write_behind_buffers)),
+                    limiter=limiter, dirty_items=dirty_items,
+                    hash_func=get_row_value(row, "hash_func", hash_functions.default_hash_func),
+                    device_semaphores=device_semaphores),
+                    nice=None if nice is None else int(nice), io_class=get_row_value(row, "io_class"))
+                backup_catalog.update_entry(row["destination"], backup_folder, backup_catalog.new_entry(
+                    backup_folder, status="complete", info_dict=info_dict, info_file=info_dict["info_file"]))
+            finally:
+                hash_cache.close_hash_cache(cache)
+                # chunks may only be collected when no backup is deleted or written anymore and are only orphaned
+                # if a backup was deleted
+                pruned = backup_catalog.wait_for_pruning(row["destination"])
+                if compression == "CHUNK_STORE" and pruned["deleted"]:
+                    chunk_store.collect_garbage(backup_path=row["destination"])
+
+    else:
+        logger.debug(f"Value for activation: {activation}. Skip this row from backup instructions.")
+
+
+def plan_backup_instruction(idx: int, row, now: datetime = None):
+    """
+    Dry run of one row of the backup instructions: finds what the backup would read and estimates its duration and
+    output size from the throughput of the latest backups of the destination (see backup_planner). Nothing is
+    written, no backup is deleted. Items are only scanned (metadata), unchanged items of a running watcher (see
+    change_watcher) not even that.
+
+    Parameters
+    ----------
+    idx: int
+        index of the row in the backup instructions
+    row: dict
+        row of the backup instructions
+    now: datetime
+        start time of the backup, used for the rate limits by time of day. Now if None
 
-    if backup_instr_pd is None:
+    Returns
+    -------
+    plan: dict
+        "index", "source", "destination", "strategy", "compression", "items", "changed_items", "bytes_to_read",
+        "files_to_read", "expected_output_bytes", "seconds", "limited_by" and "throughput" (see
+        backup_planner.get_throughput). None if the row is not active or its source does not exist.
+    """
+    if not bool(row["activate"]) or not os.path.isdir(row["source"]):
         return None
+    src, backup_path = row["source"], row["destination"]
+    compression = compression_methods.get(str(get_row_value(row, "compression", "zip")).lower())
+    hash_func = get_row_value(row, "hash_func", hash_functions.default_hash_func)
+
+    catalog = {"backups": {}}
+    if os.path.isdir(backup_path):
+        # load_catalog would write a missing catalog
+        catalog = backup_catalog.load_catalog(backup_path) \
+            if os.path.isfile(os.path.join(backup_path, backup_catalog.catalog_filename)) \
+            else backup_catalog.rebuild_catalog(backup_path)
+    latest_info_dict = None
+    latest_entry = backup_catalog.get_latest_backup(catalog)
+    if latest_entry is not None:
+        latest_info_dict = load_info_dict_from_backup_folder(folder_path=os.path.join(backup_path,
+                                                                                      latest_entry["folder"]))
+    reference_dict = get_reference_info_dict(backup_path=backup_path, latest_info_dict=latest_info_dict,
+                                             strategy=row["strategy"])
+    if reference_dict is not None and get_hash_func(reference_dict) != hash_func:
+        reference_dict = None
+
+    items = os.listdir(src)
+    unchanged = set()
+    if reference_dict is not None:
+        since = datetime.strptime(reference_dict["start_time"], '%Y%m%d_%H%M%S').timestamp()
+        # no sync request, the plan writes nothing. The journal may miss the changes of the last seconds.
+        dirty_items = change_watcher.get_dirty_items(backup_path, src, since=since, sync=False)
+        if dirty_items is not None:
+            recorded = {item_info[f"{prefix}_name"] for prefix in ["file", "folder"]
+                        for item_info in reference_dict.get(f"found_{prefix}s", [])}
+            unchanged = {item for item in items if item in recorded and item not in dirty_items}
+    scans = {item: scan_item(os.path.join(src, item)) for item in items if item not in unchanged}
+
+    # a folder name that is not used by any backup, only the folders next to it are looked at
+    dst = os.path.join(backup_path, ".plan")
+    changed = []
+    for prefix, is_prefix in [("file", os.path.isfile), ("folder", os.path.isdir)]:
+        prefix_items = [item for item in scans if is_prefix(os.path.join(src, item))]
+        changed += split_changed_and_unchanged_items(dst=dst, items=prefix_items, prefix=prefix, scans=scans,
+                                                     reference_dict=reference_dict)[0]
+    bytes_to_read = sum(scans[item]["size"] for item in changed)
+    files_to_read = sum(len(scans[item]["files"]) for item in changed)
+
+    throughput = backup_planner.get_throughput(backup_planner.get_history(backup_path, catalog, compression))
+    read_limit = rate_limiter.get_rate(rate_limiter.parse_schedule(get_row_value(row, "max_read_mb_s"), scale=1e6),
+                                       now=now)
+    plan = {"index": idx, "source": src, "destination": backup_path,
+            "strategy": row["strategy"] if reference_dict is not None else "full", "compression": compression,
+            "items": len(items), "changed_items": len(changed), "bytes_to_read": bytes_to_read,
+            "files_to_read": files_to_read}
+    plan.update(backup_planner.estimate(bytes_to_read, files_to_read, throughput, max_read_bytes_per_s=read_limit))
+    plan["throughput"] = throughput
+    logger.debug(f"Plan of row {idx}: {plan}")
+    return plan
+
+
+def plan_backup_instructions(backup_instr: list, window: str = None, max_workers: int = None):
+    """
+    Plans all active rows of the backup instructions (see plan_backup_instruction) and orders them for the backup
+    window (see backup_planner.schedule_rows)
+
+    Parameters
+    ----------
+    backup_instr: list
+        backup instructions, result of read_backup_instructions
+    window: str
+        backup window "HH:MM-HH:MM", the backups start now if None
+    max_workers: int
+        number of rows that are processed in parallel, max_parallel_rows if None
+
+    Returns
+    -------
+    plans: list
+        plan per active row in the order the rows should be started
+    """
+    start, end = backup_planner.parse_window(window) if window else (datetime.now(), None)
+    plans = [plan for plan in (plan_backup_instruction(idx, row, now=start) for idx, row in enumerate(backup_instr))
+             if plan is not None]
+    return backup_planner.schedule_rows(plans, start=start, workers=max_workers or max_parallel_rows, end=end)
+
+
+def print_plans(plans: list, window: str = None):
+    """
+    Prints the planned rows as table
+
+    Parameters
+    ----------
+    plans: list
+        result of plan_backup_instructions
+    window: str
+        backup window the rows were planned for, None if there is none
+    """
+    print(f"\n{'row':>4} {'items':>11} {'read MB':>10} {'files':>9} {'output MB':>10} {'duration':>10} "
+          f"{'start':>15} {'eta':>15} {'fits':>5}  source -> destination")
+    for plan in plans:
+        print(f"{plan['index']:>4} {plan['changed_items']:>5} / {plan['items']:<3} "
+              f"{plan['bytes_to_read'] / 1e6:>10.1f} {plan['files_to_read']:>9} "
+              f"{plan['expected_output_bytes'] / 1e6:>10.1f} "
+              f"{str(timedelta(seconds=round(plan['seconds']))):>10} {plan['start']:>15} {plan['eta']:>15} "
+              f"{'' if plan['fits'] is None else plan['fits']!s:>5}  {plan['source']} -> {plan['destination']}")
+    late = [plan["index"] for plan in plans if plan["fits"] is False]
+    if late:
+        print(f"\nRows {late} are expected to end after the backup window")
+    if window is not None:
+        print(f"\nThe window {window} only orders the rows: backups are not deferred to its start and not stopped at "
+              f"its end, an overrun is only reported.")
+
+
+def run_backup_instructions(backup_instr: list, max_workers: int = None, order: list = None):
+    """
+    Performs the backups of all rows of the backup instructions. Rows with the same destination share their backup
+    folders and are processed one after another, rows with different destinations are processed in parallel.
+
+    Parameters
+    ----------
+    backup_instr: list
+        backup instructions, result of read_backup_instructions
+    max_workers: int
+        number of rows that are processed in parallel, max_parallel_rows if None
+    order: list
+        indices of the rows in the order they should be started (see plan_backup_instructions), rows that are
+        missing follow in the order of the instructions. Order of the instructions if None
+    """
+    if max_workers is None:
+        max_workers = max_parallel_rows
+
+    order = list(order or [])
+    order += [idx for idx in range(len(backup_instr)) if idx not in order]
+    rows_per_destination = {}
+    for idx in order:
+        row = backup_instr[idx]
+        rows_per_destination.setdefault(os.path.normpath(row["destination"]), []).append((idx, row))
+
+    # jobs of all rows on the same device count together, the semaphores live as long as this call
+    device_semaphores = new_device_semaphores()
+
+    def run_rows(rows):
+        for idx, row in rows:
+            run_backup_instruction(idx=idx, row=row, device_semaphores=device_semaphores)
+
+    if max_workers <= 1 or len(rows_per_destination) <= 1:
+        for rows in rows_per_destination.values():
+            run_rows(rows)
     else:
-        for idx, row in backup_instr_pd.iterrows():
-            for header in list(backup_instr_pd.columns):
-                logger.debug(f"Processing idx: {idx} with values: Header: {header}; Value: {row[header]}")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_rows, rows) for rows in rows_per_destination.values()]
+            for future in futures:
+                future.result()
 
-            activation = bool(row["activate"])
-            if activation is True:
-                logger.debug(f"Value for activation: {activation}. Do the backup")
-                print(f"\n\nPerform backup instructions for row {idx} now.\n")
 
-                latest_info_dict = analyze_existing_backups(backup_path=row["destination"], max_num_backups=3)
+def parse_arguments(argv: list = None):
+    """
+    Returns the parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Tool for creating backups of directories")
+    parser.add_argument("command", nargs="?", default="backup",
+                        choices=["backup", "verify", "restore", "watch", "plan"],
+                        help="backup: run the backup instructions (default). verify: check a backup against its "
+                             "recorded hashes. restore: restore items of a backup. watch: record the changes of the "
+                             "sources of the backup instructions until stopped, so backups only scan changed items. "
+                             "plan: dry run, estimate bytes, files, output size and duration of every row")
+    parser.add_argument("--backup-folder", help="backup folder to verify or restore from")
+    parser.add_argument("--target", help="folder to restore into")
+    parser.add_argument("--items", nargs="+", default=None, help="names of the items to verify/restore, all if not set")
+    parser.add_argument("--workers", type=int, default=None, help="parallel items and files, number of cpus if not set")
+    parser.add_argument("--copy-method", default="auto", help="copy method for restoring uncompressed items")
+    parser.add_argument("--instructions", default=os.path.join(instructions_foldername, instructions_filename),
+                        help="path to csv file with the backup instructions")
+    parser.add_argument("--log-dir", default=log_foldername, help="folder for the log files")
+    parser.add_argument("--polling", action="store_true", help="watch by polling instead of inotify")
+    parser.add_argument("--poll-interval", type=float, default=change_watcher.poll_interval,
+                        help="seconds between two scans of the polling watcher")
+    parser.add_argument("--window", default=None,
+                        help="backup window HH:MM-HH:MM (e.g. 22:00-06:00). plan checks which rows fit, backup "
+                             "starts the rows now in the planned order and reports an overrun of the window. Rows "
+                             "are neither deferred to the start nor stopped at the end of the window.")
+    parser.add_argument("--plan-output", default=None, help="json file the plan is written to")
+    parser.add_argument("--shutdown-wait", type=int, default=120,
+                        help="seconds to wait before the shutdown after the backups")
+    args = parser.parse_args(argv)
+    if args.command in ["verify", "restore"] and args.backup_folder is None:
+        parser.error(f"{args.command} needs --backup-folder")
+    if args.command == "restore" and args.target is None:
+        parser.error("restore needs --target")
+    return args
+
+
+def watch_backup_sources(backup_instr: list, polling: bool = False,
+                         poll_interval: float = change_watcher.poll_interval, stop: threading.Event = None):
+    """
+    Watches the sources of all active rows of the backup instructions (see change_watcher) until stop is set or
+    the user presses Ctrl+C
 
-                source, destination = check_and_setup_directories(index=idx, src=row["source"], dst=row["destination"])
+    Parameters
+    ----------
+    backup_instr: list
+        backup instructions, result of read_backup_instructions
+    polling: bool
+        use the polling watcher even if inotify is available
+    poll_interval: float
+        seconds between two scans of the polling watcher
+    stop: threading.Event
+        event to stop the watchers, a new one if None
+    """
+    stop = stop if stop is not None else threading.Event()
+    threads = []
+    for row in backup_instr:
+        if not bool(row["activate"]) or not os.path.isdir(row["source"]):
+            continue
+        thread = threading.Thread(target=change_watcher.watch, name=f"watch {row['source']}",
+                                  kwargs={"source": row["source"], "destination": row["destination"], "stop": stop,
+                                          "polling": polling, "interval": poll_interval})
+        thread.start()
+        threads.append(thread)
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1.0)
+    except KeyboardInterrupt:
+        print("Stop watching...")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def main(argv: list = None):
+    args = parse_arguments(argv)
+    setup_logging(basepath=args.log_dir)
+    if args.command == "verify":
+        results = verify_backup(folder_path=args.backup_folder, items=args.items, max_workers=args.workers)
+        num_ok = list(results.values()).count("ok")
+        print(f"\nVerified {len(results)} items: {num_ok} ok, {len(results) - num_ok} failed")
+        return 0 if num_ok == len(results) else 1
+    if args.command == "restore":
+        restored_items = restore_backup(folder_path=args.backup_folder, target=args.target, items=args.items,
+                                        max_workers=args.workers, copy_method=args.copy_method)
+        print(f"\nRestored {len(restored_items)} items to {args.target}")
+        return 0
 
-                if source is None or destination is None:
-                    continue
-                else:
-                    perform_backup(src=source, dst=destination)
+    main_start_time = datetime.now()
+    logger.debug("Start of main function of backup script")
+    backup_instr = read_backup_instructions(path=os.path.dirname(args.instructions),
+                                            file=os.path.basename(args.instructions))
 
-            else:
-                logger.debug(f"Value for activation: {activation}. Skip this row from backup instructions.")
+    if backup_instr is None:
+        return None
+    elif args.command == "watch":
+        watch_backup_sources(backup_instr=backup_instr, polling=args.polling, poll_interval=args.poll_interval)
+        return 0
+    elif args.command == "plan":
+        plans = plan_backup_instructions(backup_instr=backup_instr, window=args.window)
+        print_plans(plans, window=args.window)
+        if args.plan_output is not None:
+            with open(args.plan_output, "w", encoding="utf-8") as f:
+                json.dump(plans, f, indent=4)
+        return 0 if all(plan["fits"] is not False for plan in plans) else 1
+    else:
+        order, window_end = None, None
+        if args.window is not None:
+            _, window_end = backup_planner.parse_window(args.window)
+            plans = plan_backup_instructions(backup_instr=backup_instr, window=args.window)
+            print_plans(plans, window=args.window)
+            order = [plan["index"] for plan in plans]
+        run_backup_instructions(backup_instr=backup_instr, order=order)
+        if window_end is not None and datetime.now() > window_end:
+            logger.warning(f"Backups ended after the backup window {args.window}")
+            print(f"\nBackups ended after the backup window {args.window} (ended at {window_end:%H:%M})")
 
     end_time = datetime.now()
     logger.debug(f"Backup script is finished. Took {end_time - main_start_time}")
     print(f"\nBackup script is finished. Took {end_time - main_start_time}")
-    check_for_shutdown(instr=backup_instr_pd)
+    check_for_shutdown(instr=backup_instr, waittime=args.shutdown_wait)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
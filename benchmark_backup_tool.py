@@ -0,0 +1,290 @@
+"""
+Benchmark of the backup pipeline. Generates reproducible synthetic source trees, times the single stages of the
+backup and writes the results as JSON, so the numbers of different versions can be compared.
+
+Usage: python benchmark_backup_tool.py [--scale 1.0] [--repeat 3] [--output benchmark_results.json]
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+import subprocess
+from datetime import datetime
+
+import backup_tool
+import streaming_io
+import hash_functions
+
+_words = ("backup tool folder file archive hash size source destination compression chunk stream "
+          "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor").split()
+
+# name: (number of top-level folders, files per folder, file size in bytes, nesting depth, compressible)
+profiles = {
+    "many_small_files": (10, 500, 2 * 1024, 1, True),
+    "few_huge_files": (2, 1, 64 * 1024 * 1024, 1, False),
+    "deep_nesting": (4, 5, 8 * 1024, 25, True),
+    "incompressible": (5, 10, 1024 * 1024, 1, False),
+    "compressible": (5, 10, 1024 * 1024, 1, True)
+}
+
+compression_methods = ["ZIPFILE", "shutil.make_archive", "SINGLE_PASS", "SINGLE_PASS_COPY", "gz", "CHUNK_STORE"]
+
+
+def _generate_content(rng: random.Random, size: int, compressible: bool):
+    if not compressible:
+        return rng.randbytes(size)
+    text = " ".join(rng.choice(_words) for _ in range(size // 5 + 1)).encode("utf-8")
+    return text[:size]
+
+
+def generate_tree(path: str, profile: str, seed: int = 23, scale: float = 1.0):
+    """
+    Creates a reproducible source tree for a benchmark profile
+
+    Parameters
+    ----------
+    path: str
+        folder where the tree is created
+    profile: str
+        name of one of profiles
+    seed: int
+        seed of the random generator, same seed gives the same tree
+    scale: float
+        factor for number of files and file sizes
+
+    Returns
+    -------
+    stats: dict
+        number of files and bytes of the created tree
+    """
+    num_folders, files_per_folder, file_size, depth, compressible = profiles[profile]
+    files_per_folder = max(int(files_per_folder * scale), 1)
+    file_size = max(int(file_size * scale), 1)
+    rng = random.Random(seed)
+    stats = {"num_files": 0, "num_bytes": 0}
+
+    os.makedirs(path, exist_ok=True)
+    for folder_idx in range(num_folders):
+        folder = os.path.join(path, f"folder_{folder_idx:03d}")
+        for level in range(depth):
+            os.makedirs(folder, exist_ok=True)
+            for file_idx in range(files_per_folder):
+                size = rng.randint(file_size // 2, file_size) if file_size > 1 else 1
+                with open(os.path.join(folder, f"file_{file_idx:05d}.dat"), "wb") as f:
+                    f.write(_generate_content(rng, size, compressible))
+                stats["num_files"] += 1
+                stats["num_bytes"] += size
+            folder = os.path.join(folder, f"level_{level + 1:02d}")
+
+    # some files on top level as well
+    for file_idx in range(3):
+        size = max(file_size // 4, 1)
+        with open(os.path.join(path, f"top_file_{file_idx}.dat"), "wb") as f:
+            f.write(_generate_content(rng, size, compressible))
+        stats["num_files"] += 1
+        stats["num_bytes"] += size
+    return stats
+
+
+def time_function(func, repeat: int, setup=None):
+    """
+    Calls func repeat times and returns the timings in seconds. setup is called before every run and not timed.
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    return {"min_s": min(timings), "median_s": statistics.median(timings), "runs": timings}
+
+
+def _reset_folder(path: str):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+
+def benchmark_profile(work_dir: str, profile: str, repeat: int, scale: float, seed: int):
+    """
+    Generates the tree of a profile and times all stages of the backup on it
+
+    Returns
+    -------
+    result: dict
+        tree statistics and timings per stage
+    """
+    src = os.path.join(work_dir, profile, "src")
+    dst_root = os.path.join(work_dir, profile, "dst")
+    dst = os.path.join(dst_root, "backup")
+    stats = generate_tree(src, profile, seed=seed, scale=scale)
+    items = sorted(os.listdir(src))
+    folders = [item for item in items if os.path.isdir(os.path.join(src, item))]
+    result = {"tree": stats, "timings": {}}
+    timings = result["timings"]
+
+    timings["perform_backup"] = time_function(lambda: backup_tool.perform_backup(src=src, dst=dst), repeat,
+                                              setup=lambda: _reset_folder(dst_root) or _reset_folder(dst))
+    timings["scan_item"] = time_function(lambda: [backup_tool.scan_item(os.path.join(src, i)) for i in items],
+                                         repeat)
+    timings["get_size_and_sort_ascending_order"] = time_function(
+        lambda: backup_tool.get_size_and_sort_ascending_order(path=src, items_list=folders), repeat)
+    folders_sorted, folders_with_sizes = backup_tool.get_size_and_sort_ascending_order(path=src, items_list=folders)
+    timings["update_info_dict_with_items"] = time_function(
+        lambda: backup_tool.update_info_dict_with_items(inf_dict={}, src=src, items=folders_with_sizes,
+                                                        prefix="folder"), repeat)
+
+    for hash_func in hash_functions.get_available_hash_functions():
+        timings[f"hash_{hash_func}"] = time_function(
+            lambda: [backup_tool.build_checksum_of_directory(dir=os.path.join(src, folder), hash_func=hash_func)
+                     for folder in folders], repeat)
+        timings[f"hash_{hash_func}"]["mb_per_s"] = stats["num_bytes"] / 1e6 / timings[f"hash_{hash_func}"]["min_s"]
+
+    for method in compression_methods:
+        timings[f"compression_{method}"] = time_function(
+            lambda: backup_tool.backup_items_from_src_to_dst(src=src, dst=dst, items=folders_sorted,
+                                                             compression=method), repeat,
+            setup=lambda: _reset_folder(dst_root) or _reset_folder(dst))
+        archive_bytes = sum(os.path.getsize(os.path.join(r, f)) for r, d, fs in os.walk(dst_root) for f in fs)
+        timings[f"compression_{method}"]["output_bytes"] = archive_bytes
+        timings[f"compression_{method}"]["mb_per_s"] = stats["num_bytes"] / 1e6 / timings[f"compression_{method}"][
+            "min_s"]
+        # trees of tiny files are limited by the per-file overhead, not by the bandwidth
+        timings[f"compression_{method}"]["files_per_s"] = stats["num_files"] / timings[f"compression_{method}"][
+            "min_s"]
+
+    shutil.rmtree(os.path.join(work_dir, profile))
+    return result
+
+
+def benchmark_startup(repeat: int):
+    """
+    Times the cold start of the tool: a new interpreter that only imports backup_tool. The bare interpreter start
+    is measured as well, so the import time of the tool is the difference.
+
+    Returns
+    -------
+    result: dict
+        timings of the interpreter alone and with the import
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code: str):
+        subprocess.run([sys.executable, "-c", code], cwd=folder, check=True)
+
+    result = {"interpreter": time_function(lambda: run("pass"), repeat),
+              "import_backup_tool": time_function(lambda: run("import backup_tool"), repeat)}
+    result["import_overhead_s"] = result["import_backup_tool"]["min_s"] - result["interpreter"]["min_s"]
+    return result
+
+
+class ThrottledWriter:
+    """
+    Stand-in for a slow destination like a network share: wraps a file object and adds a latency to every write and
+    limits the bandwidth, to test the pipeline locally.
+    """
+
+    def __init__(self, fileobj, latency_s: float = 0.002, bytes_per_s: float = 100e6):
+        self.fileobj = fileobj
+        self.latency_s = latency_s
+        self.bytes_per_s = bytes_per_s
+
+    def write(self, data):
+        time.sleep(self.latency_s + len(data) / self.bytes_per_s)
+        return self.fileobj.write(data)
+
+
+def benchmark_pipeline(work_dir: str, repeat: int, scale: float, seed: int, latency_ms: float,
+                       bandwidth_mb_s: float):
+    """
+    Times streaming a tree of files to a simulated slow destination (ThrottledWriter, a latency per
+    write and a bandwidth limit like a network share), once writing in the calling thread and once with
+    write-behind, where reading and hashing overlap with the writes.
+
+    Returns
+    -------
+    result: dict
+        settings of the simulated destination and timings per mode
+    """
+    src = os.path.join(work_dir, "pipeline", "src")
+    stats = generate_tree(src, "few_huge_files", seed=seed, scale=scale)
+    paths = [os.path.join(root, f) for root, dirs, files in os.walk(src) for f in sorted(files)]
+    result = {"tree": stats, "latency_ms": latency_ms, "bandwidth_mb_s": bandwidth_mb_s, "timings": {}}
+
+    def stream_all(write_behind):
+        with open(os.devnull, "wb") as f_null:
+            writer = ThrottledWriter(f_null, latency_s=latency_ms / 1000,
+                                                  bytes_per_s=bandwidth_mb_s * 1e6)
+            for path in paths:
+                streaming_io.stream_file(path, writer.write, write_behind=write_behind)
+
+    for mode, write_behind in [("synchronous", 0), ("write_behind", streaming_io.pool_buffers // 2)]:
+        result["timings"][mode] = time_function(lambda: stream_all(write_behind), repeat)
+        result["timings"][mode]["mb_per_s"] = stats["num_bytes"] / 1e6 / result["timings"][mode]["min_s"]
+    shutil.rmtree(os.path.join(work_dir, "pipeline"))
+    return result
+
+
+def get_environment():
+    """
+    Returns information about the machine and the version of the code
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.now().strftime('%Y%m%d_%H%M%S'),
+        "git_commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the backup pipeline")
+    parser.add_argument("--profiles", nargs="+", default=list(profiles), choices=list(profiles))
+    parser.add_argument("--scale", type=float, default=1.0, help="factor for number of files and file sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=23)
+    parser.add_argument("--work-dir", default=None, help="folder for the generated trees, temp folder if not set")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--dst-latency-ms", type=float, default=2.0,
+                        help="latency per write of the simulated slow destination of the pipeline benchmark")
+    parser.add_argument("--dst-bandwidth", type=float, default=200.0,
+                        help="bandwidth in MB/s of the simulated slow destination of the pipeline benchmark")
+    args = parser.parse_args()
+
+    results = {"environment": get_environment(), "settings": vars(args), "profiles": {}}
+    print("Benchmark startup")
+    results["startup"] = benchmark_startup(repeat=max(args.repeat, 5))
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for profile in args.profiles:
+            print(f"Benchmark profile <{profile}>")
+            results["profiles"][profile] = benchmark_profile(work_dir, profile, repeat=args.repeat,
+                                                             scale=args.scale, seed=args.seed)
+        print("Benchmark pipeline with slow destination")
+        results["pipeline"] = benchmark_pipeline(work_dir, repeat=args.repeat, scale=args.scale, seed=args.seed,
+                                                 latency_ms=args.dst_latency_ms,
+                                                 bandwidth_mb_s=args.dst_bandwidth)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""
+Continuous watch of the sources of the backup instructions. A long running watcher records which top-level items of
+a source changed and when, in a dirty journal (watch_<id>.json) in the destination of the row. The next backup only
+scans the items that changed since its reference backup, all other items are taken from the file manifest of the
+reference backup, so finding the changes costs O(changes) instead of O(tree).
+
+On Linux the watcher uses inotify (through ctypes, no extra package), on other systems or if the inotify watch limit
+is reached it polls the items with os.scandir. The journal is only used if the watcher ran without gap since before
+the reference backup started and if it recorded all changes up to the start of the backup (see get_dirty_items).
+"""
+
+import os
+import time
+import json
+import errno
+import ctypes
+import select
+import struct
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger()
+
+journal_prefix = "watch_"
+flush_interval = 10  # seconds between two writes of the journal
+poll_interval = 60  # seconds between two scans of the polling watcher
+sync_ending = ".sync"  # next to the journal, holds the time of the latest sync request of a backup
+sync_check_interval = 0.2  # seconds between two checks for a sync request
+sync_timeout = 120  # seconds a backup waits for the watcher to sync, everything is scanned after that
+max_paths_per_item = 100  # changed paths recorded per item, only for the log
+
+# inotify constants from linux/inotify.h
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+             | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+_event = struct.Struct("iIII")
+
+
+def get_journal_path(destination: str, source: str):
+    """
+    Returns the path of the dirty journal of a source in the destination of its row
+    """
+    source_id = hashlib.blake2b(os.path.abspath(source).encode("utf-8", "surrogateescape"),
+                                digest_size=8).hexdigest()
+    return os.path.join(destination, f"{journal_prefix}{source_id}.json")
+
+
+class DirtyJournal:
+    """
+    Time of the last change per top-level item of a source. Written atomically every flush_interval seconds, the
+    write time is the heartbeat that shows the watcher is still running. "synced" is the time up to which all changes
+    are recorded, it is set when the watcher answers a sync request (see get_dirty_items).
+    """
+
+    def __init__(self, path: str, source: str, interval: float):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {"source": os.path.abspath(source), "since": time.time(), "heartbeat": None, "synced": None,
+                      "interval": interval, "method": None, "unwatched": [], "items": {}}
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.state["items"] = json.load(f).get("items", {})
+
+    def mark(self, item: str, rel_path: str = ""):
+        with self.lock:
+            info = self.state["items"].setdefault(item, {"last_change": 0, "paths": []})
+            info["last_change"] = time.time()
+            if rel_path and rel_path not in info["paths"] and len(info["paths"]) < max_paths_per_item:
+                info["paths"].append(rel_path)
+
+    def mark_unwatched(self, item: str):
+        """
+        Marks an item as not fully watched (e.g. watch limit reached), it always counts as changed
+        """
+        with self.lock:
+            if item not in self.state["unwatched"]:
+                self.state["unwatched"].append(item)
+
+    def restart(self):
+        """
+        Events may have been lost (e.g. queue overflow) or the watcher just started, the journal is only valid for
+        backups started from now on
+        """
+        with self.lock:
+            self.state["since"] = time.time()
+
+    def get_sync_request(self):
+        """
+        Returns the time of a sync request that is not answered yet, None if there is none
+        """
+        try:
+            with open(self.path + sync_ending, "r", encoding="utf-8") as f:
+                requested = float(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        if self.state["synced"] is not None and self.state["synced"] >= requested:
+            return None
+        return requested
+
+    def sync(self, synced: float):
+        """
+        All changes before synced are recorded, writes the journal at once
+        """
+        with self.lock:
+            self.state["synced"] = synced
+        self.save()
+
+    def save(self):
+        with self.lock:
+            self.state["heartbeat"] = time.time()
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.path)
+
+
+def _load_journal(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _request_sync(path: str):
+    """
+    Asks the watcher of a journal to record all changes up to now. Returns the time of the request.
+    """
+    requested = time.time()
+    tmp_path = f"{path}{sync_ending}.{os.getpid()}_{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(repr(requested))
+    os.replace(tmp_path, path + sync_ending)
+    return requested
+
+
+def get_dirty_items(destination: str, source: str, since: float, sync: bool = True):
+    """
+    Returns the top-level items of a source that changed since the given time, according to the dirty journal.
+
+    The journal is only written every flush_interval seconds and the polling watcher only scans every interval
+    seconds, so the journal on disk may miss the latest changes. With sync, the watcher is asked to record all changes
+    up to now (inotify: read all queued events, polling: scan at once) and the journal is only used once the watcher
+    answered.
+
+    Parameters
+    ----------
+    destination: str
+        destination of the row, holds the journal
+    source: str
+        source of the row
+    since: float
+        unix time, usually the start of the reference backup
+    sync: bool
+        wait up to sync_timeout seconds for the watcher to record all changes up to now. Without sync the journal
+        may miss the changes of the last seconds, only for estimates (see plan_backup_instruction).
+
+    Returns
+    -------
+    dirty_items: set
+        names of the changed items. None if there is no valid journal: no watcher, watcher started after since, not
+        running anymore (heartbeat too old) or it did not answer the sync request. Then every item has to be scanned.
+    """
+    path = get_journal_path(destination, source)
+    if not os.path.isfile(path):
+        return None
+    state = _load_journal(path)
+    max_age = 2 * max(state["interval"], flush_interval) + flush_interval
+    if state["since"] > since:
+        logger.debug(f"Watch journal of {source} starts after the reference backup. Scan everything.")
+        return None
+    if state["heartbeat"] is None or time.time() - state["heartbeat"] > max_age:
+        logger.debug(f"Watcher of {source} is not running. Scan everything.")
+        return None
+    if sync:
+        requested = _request_sync(path)
+        end = requested + sync_timeout
+        while state["synced"] is None or state["synced"] < requested:
+            if time.time() > end:
+                logger.warning(f"Watcher of {source} did not record the latest changes within {sync_timeout} s. "
+                               f"Scan everything.")
+                return None
+            time.sleep(sync_check_interval / 2)
+            state = _load_journal(path)
+        if state["since"] > since:
+            # events were lost while syncing
+            logger.debug(f"Watch journal of {source} restarted after the reference backup. Scan everything.")
+            return None
+    dirty_items = {item for item, info in state["items"].items() if info["last_change"] >= since}
+    dirty_items.update(state["unwatched"])
+    logger.debug(f"Watch journal of {source}: {len(dirty_items)} items changed since {since}")
+    return dirty_items
+
+
+def _get_top_level_item(rel_path: str):
+    return rel_path.split(os.sep, 1)[0]
+
+
+class InotifyWatcher:
+    """
+    Watches all folders below a source with inotify
+    """
+
+    def __init__(self, source: str, journal: DirtyJournal):
+        self.source = os.path.abspath(source)
+        self.journal = journal
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # watch descriptor --> relative folder path
+        try:
+            self._add_tree("")
+        except OSError:
+            os.close(self.fd)
+            raise
+        # changes are only seen from now on, not while the watches were added
+        journal.restart()
+
+    def _add_watch(self, rel_dir: str):
+        path = os.path.join(self.source, rel_dir) if rel_dir else self.source
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in [errno.ENOENT, errno.ENOTDIR]:
+                # deleted again before it could be watched
+                return
+            raise OSError(error, f"inotify_add_watch failed for {path}")
+        self.watches[wd] = rel_dir
+
+    def _add_tree(self, rel_dir: str):
+        pending = [rel_dir]
+        while pending:
+            rel_dir = pending.pop()
+            self._add_watch(rel_dir)
+            try:
+                with os.scandir(os.path.join(self.source, rel_dir)) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(os.path.join(rel_dir, entry.name) if rel_dir else entry.name)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning(f"inotify queue of {self.source} overflowed, events are lost")
+            self.journal.restart()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        rel_dir = self.watches.get(wd)
+        if rel_dir is None:
+            return
+        rel_path = os.path.join(rel_dir, name) if rel_dir and name else (name or rel_dir)
+        if rel_path == "":
+            return
+        self.journal.mark(_get_top_level_item(rel_path), rel_path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            try:
+                self._add_tree(rel_path)
+            except OSError as e:
+                logger.warning(f"Can not watch {rel_path} of {self.source} ({e}), item is always backuped")
+                self.journal.mark_unwatched(_get_top_level_item(rel_path))
+
+    def _read_events(self, timeout: float):
+        """
+        Handles the queued events, waits up to timeout seconds for the first one. Returns False if there was none.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        data = os.read(self.fd, 64 * 1024)
+        position = 0
+        while position < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, position)
+            position += _event.size
+            name = os.fsdecode(data[position:position + length].rstrip(b"\0"))
+            position += length
+            self._handle(wd, mask, name)
+        return True
+
+    def run(self, stop: threading.Event):
+        last_flush = 0
+        try:
+            while not stop.is_set():
+                self._read_events(sync_check_interval)
+                if self.journal.get_sync_request() is not None:
+                    # every change before this point is already queued by the kernel
+                    synced = time.time()
+                    while self._read_events(0):
+                        pass
+                    self.journal.sync(synced)
+                    last_flush = time.time()
+                elif time.time() - last_flush >= flush_interval:
+                    self.journal.save()
+                    last_flush = time.time()
+        finally:
+            os.close(self.fd)
+            self.journal.save()
+
+
+def _get_item_signature(path: str):
+    """
+    Returns a hash over name, size and mtime of all files and folders of an item
+    """
+    signature = hashlib.blake2b(digest_size=16)
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        try:
+            stat = os.stat(current, follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        signature.update(f"{current}/{stat.st_size}/{stat.st_mtime_ns}\n".encode("utf-8", "surrogateescape"))
+        if os.path.isdir(current) and not os.path.islink(current):
+            try:
+                with os.scandir(current) as it:
+                    pending.extend(sorted(entry.path for entry in it))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+    return signature.hexdigest()
+
+
+class PollingWatcher:
+    """
+    Portable fallback: compares a signature of every top-level item every interval seconds
+    """
+
+    def __init__(self, source: str, journal: DirtyJournal, interval: float = poll_interval):
+        self.source = os.path.abspath(source)
+        self.journal = journal
+        self.interval = interval
+        self.signatures = self._scan()
+        # changes are only seen from now on, not while the first signatures were built
+        journal.restart()
+
+    def _scan(self):
+        return {item: _get_item_signature(os.path.join(self.source, item)) for item in os.listdir(self.source)}
+
+    def run(self, stop: threading.Event):
+        try:
+            self.journal.save()
+            next_scan = time.time() + self.interval
+            while not stop.wait(min(sync_check_interval, self.interval)):
+                requested = self.journal.get_sync_request() is not None
+                if not requested and time.time() < next_scan:
+                    continue
+                scan_start = time.time()
+                signatures = self._scan()
+                for item in set(signatures) | set(self.signatures):
+                    if signatures.get(item) != self.signatures.get(item):
+                        self.journal.mark(item)
+                self.signatures = signatures
+                # changes before the start of the scan are recorded
+                self.journal.sync(scan_start)
+                next_scan = time.time() + self.interval
+        finally:
+            self.journal.save()
+
+
+def watch(source: str, destination: str, stop: threading.Event, polling: bool = False,
+          interval: float = poll_interval):
+    """
+    Watches a source and keeps its dirty journal in the destination up to date until stop is set
+
+    Parameters
+    ----------
+    source: str
+        folder to watch (source of a row of the backup instructions)
+    destination: str
+        destination of the row, the journal is written there
+    stop: threading.Event
+        the watcher returns when it is set
+    polling: bool
+        use the polling watcher even if inotify is available
+    interval: float
+        seconds between two scans of the polling watcher
+    """
+    os.makedirs(destination, exist_ok=True)
+    journal_path = get_journal_path(destination, source)
+    watcher = None
+    if not polling and hasattr(os, "uname") and os.uname().sysname == "Linux":
+        journal = DirtyJournal(journal_path, source, interval=flush_interval)
+        try:
+            watcher = InotifyWatcher(source, journal)
+            journal.state["method"] = "inotify"
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify not possible for {source} ({e}). Fall back to polling.")
+    if watcher is None:
+        journal = DirtyJournal(journal_path, source, interval=interval)
+        watcher = PollingWatcher(source, journal, interval=interval)
+        journal.state["method"] = "polling"
+    logger.info(f"Watching {source} with {journal.state['method']}, journal {journal_path}")
+    print(f"Watching {source} with {journal.state['method']}")
+    watcher.run(stop)
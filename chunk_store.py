@@ -0,0 +1,323 @@
+"""
+Deduplicated chunk store for backups. Files are split with a content-defined chunker (gear rolling hash), every chunk
+is stored only once by its sha256 in the folder "chunks" of the destination. A backup of an item is only a small
+manifest "<item>.chunks.json" that lists the chunks of all its files.
+"""
+
+import os
+import json
+import zlib
+import random
+import hashlib
+import logging
+import threading
+import concurrent.futures
+
+import backup_metrics
+import compression_policy
+import hash_functions
+
+logger = logging.getLogger()
+
+chunk_store_foldername = "chunks"
+manifest_ending = ".chunks.json"
+min_chunk_size = 256 * 1024
+avg_chunk_bits = 20  # boundary if the top 20 bits of the gear hash are zero --> about 1 MiB per chunk
+max_chunk_size = 4 * 1024 * 1024
+read_size = 8 * 1024 * 1024
+
+# fixed random table, changing the seed changes all chunk boundaries
+_random = random.Random(23)
+_gear = [_random.getrandbits(32) for _ in range(256)]
+_boundary_mask = ((1 << avg_chunk_bits) - 1) << (32 - avg_chunk_bits)
+
+# numpy is imported on first use, so importing the module stays fast. False if numpy is not installed.
+np = None
+_gear_np = None
+
+
+def is_available():
+    """
+    Returns True if numpy is installed. The chunker needs numpy, a pure python gear hash only reaches about 1 MB/s.
+    """
+    global np, _gear_np
+    if np is None:
+        try:
+            import numpy
+            _gear_np = numpy.array(_gear, dtype=numpy.uint32)
+            np = numpy
+        except ImportError:
+            np = False
+    return np is not False
+
+
+def _load_numpy():
+    """
+    Imports numpy and creates the numpy gear table once. Raises an ImportError if numpy is not installed.
+    """
+    if not is_available():
+        raise ImportError("The chunk store needs numpy, install it with 'pip install numpy'")
+
+
+def _find_candidates_numpy(data: bytes):
+    """
+    Returns all positions (end of chunk, exclusive) where the gear hash of the 32 bytes before matches the mask
+    """
+    values = _gear_np[np.frombuffer(data, dtype=np.uint8)]
+    # h_i = sum(gear[b_(i-k)] << k) for k < 32, built by doubling the window 5 times
+    for step in (1, 2, 4, 8, 16):
+        shifted = np.zeros_like(values)
+        shifted[step:] = values[:-step] << np.uint32(step)
+        values = values + shifted
+    return (np.flatnonzero((values & np.uint32(_boundary_mask)) == 0) + 1).tolist()
+
+
+def _split_chunks(data: bytes, final: bool):
+    """
+    Splits data into content-defined chunks. Returns the found chunk ends and the rest of data that does not form a
+    complete chunk yet (empty if final)
+    """
+    _load_numpy()
+    ends = []
+    start = 0
+    candidates = _find_candidates_numpy(data)
+    idx = 0
+    while True:
+        while idx < len(candidates) and candidates[idx] - start < min_chunk_size:
+            idx += 1
+        if idx < len(candidates) and candidates[idx] - start <= max_chunk_size:
+            start = candidates[idx]
+        elif len(data) - start >= max_chunk_size:
+            start = start + max_chunk_size
+        else:
+            break
+        ends.append(start)
+
+    if final and start < len(data):
+        ends.append(len(data))
+        start = len(data)
+    return ends, data[start:]
+
+
+def get_chunk_path(store_path: str, chunk_id: str):
+    return os.path.join(store_path, chunk_id[:2], chunk_id[2:4], chunk_id)
+
+
+def store_chunk(store_path: str, data: bytes, compression_level: int = 6):
+    """
+    Stores a chunk if it is not already in the store
+
+    Parameters
+    ----------
+    store_path: str
+        path to the chunk store
+    data: bytes
+        uncompressed content of the chunk
+    compression_level: int
+        zlib level for the stored chunk
+
+    Returns
+    -------
+    chunk_id: str
+        sha256 of the uncompressed chunk
+    bytes_written: int
+        compressed size of the stored chunk, 0 if the chunk already existed (deduplicated)
+    """
+    chunk_id = hashlib.sha256(data).hexdigest()
+    chunk_path = get_chunk_path(store_path, chunk_id)
+    if os.path.exists(chunk_path):
+        return chunk_id, 0
+
+    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+    tmp_path = f"{chunk_path}.{os.getpid()}_{threading.get_ident()}.tmp"
+    compressed = zlib.compress(data, compression_level)
+    with open(tmp_path, "wb") as f:
+        f.write(compressed)
+    os.replace(tmp_path, chunk_path)
+    return chunk_id, len(compressed)
+
+
+def store_file(store_path: str, filepath: str, hash_func: str = 'md5', compression_level: int = 6, limiter=None):
+    """
+    Splits a file into chunks and stores them. The file is read only once, its hash is built from the same bytes.
+
+    Parameters
+    ----------
+    store_path: str
+        path to the chunk store
+    filepath: str
+        path to file to be stored
+    hash_func: str
+        method of hash algorithm for the file hash
+    compression_level: int
+        zlib level for new chunks
+    limiter: rate_limiter.RateLimiter
+        limits of the read bytes, written chunk bytes and file operations, not limited if None
+
+    Returns
+    -------
+    chunk_ids: list
+        ids of the chunks of the file in order
+    hash: str
+        hexdigest of the whole file
+    bytes_written: int
+        compressed size of the chunks that were not in the store before
+    """
+    hash = hash_functions.new_hash(hash_func)
+    chunk_ids, bytes_written = [], 0
+    rest = b""
+    if limiter is not None:
+        limiter.file_op()
+    with open(filepath, "rb") as f:
+        while True:
+            data = f.read(read_size)
+            if limiter is not None:
+                limiter.read(len(data))
+            hash.update(data)
+            buffer = rest + data
+            ends, rest = _split_chunks(buffer, final=not data)
+            start = 0
+            for end in ends:
+                chunk_id, written = store_chunk(store_path, buffer[start:end], compression_level=compression_level)
+                chunk_ids.append(chunk_id)
+                bytes_written += written
+                if limiter is not None and written > 0:
+                    limiter.file_op()
+                    limiter.write(written)
+                start = end
+            if not data:
+                break
+    return chunk_ids, hash.hexdigest(), bytes_written
+
+
+def store_item(src: str, dst: str, scan: dict, hash_func: str = 'md5', compression_level: int = None,
+               adaptive_compression: bool = False, metrics: dict = None, limiter=None):
+    """
+    Stores a file or folder in the chunk store next to the backup folder and writes the manifest of the item.
+    With adaptive compression, chunks of files that do not compress (see compression_policy) are stored with zlib
+    level 0, which only wraps the data and costs no CPU.
+
+    Parameters
+    ----------
+    src: str
+        path to file/folder to be backuped
+    dst: str
+        path of the item in the backup folder, the manifest is written to dst + manifest_ending
+    scan: dict
+        result of scan_item for src
+    hash_func: str
+        method of hash algorithm for the file hashes
+    compression_level: int
+        zlib level for new chunks, 6 if None
+    adaptive_compression: bool
+        decide per file with compression_policy
+    metrics: dict
+        metrics of the backup, the compression decisions are recorded there
+    limiter: rate_limiter.RateLimiter
+        limits of the read and written bytes and the file operations, not limited if None
+
+    Returns
+    -------
+    file_hashes: dict
+        hexdigest per relative file path
+    bytes_written: int
+        bytes written to the destination (new chunks and manifest)
+    """
+    store_path = os.path.join(os.path.dirname(os.path.normpath(os.path.dirname(dst))), chunk_store_foldername)
+    compression_level = 6 if compression_level is None else compression_level
+    manifest = {"type": "folder" if scan["is_dir"] else "file", "dirs": scan["dirs"], "files": []}
+    file_hashes = {}
+    size_total, bytes_written = 0, 0
+
+    for rel_path, size, mtime_ns, ino in scan["files"]:
+        filepath = os.path.join(src, rel_path) if scan["is_dir"] else src
+        compress, level, reason = True, compression_level, "always"
+        if adaptive_compression:
+            compress, level, reason = compression_policy.decide(filepath, size, level=compression_level)
+        chunk_ids, file_hashes[rel_path], written = store_file(store_path, filepath, hash_func=hash_func,
+                                                               compression_level=level, limiter=limiter)
+        backup_metrics.record_compression(metrics, extension=compression_policy.get_extension(filepath),
+                                          compressed=compress, reason=reason, bytes_read=size, bytes_written=written)
+        manifest["files"].append([rel_path, size, mtime_ns, chunk_ids])
+        size_total += size
+        bytes_written += written
+
+    with open(dst + manifest_ending, "w") as f:
+        json.dump(manifest, f)
+    logger.debug(f"Stored {size_total} bytes of {src} in chunk store, wrote {bytes_written} bytes of new chunks")
+    return file_hashes, bytes_written + os.path.getsize(dst + manifest_ending)
+
+
+def restore_item(manifest_path: str, dst: str, workers: int = 1):
+    """
+    Restores a file or folder from its manifest
+
+    Parameters
+    ----------
+    manifest_path: str
+        path to "<item>.chunks.json" in a backup folder
+    dst: str
+        path where the file/folder should be restored to
+    workers: int
+        number of files restored in parallel
+    """
+    backup_folder = os.path.dirname(os.path.abspath(manifest_path))
+    store_path = os.path.join(os.path.dirname(backup_folder), chunk_store_foldername)
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if manifest["type"] == "folder":
+        os.makedirs(dst, exist_ok=True)
+        for rel_dir in manifest["dirs"]:
+            os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+
+    def restore_file(entry):
+        rel_path, size, mtime_ns, chunk_ids = entry
+        target = os.path.join(dst, rel_path) if manifest["type"] == "folder" else dst
+        with open(target, "wb") as f:
+            for chunk_id in chunk_ids:
+                with open(get_chunk_path(store_path, chunk_id), "rb") as f_chunk:
+                    f.write(zlib.decompress(f_chunk.read()))
+        os.utime(target, ns=(mtime_ns, mtime_ns))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(restore_file, manifest["files"]))
+
+
+def collect_garbage(backup_path: str):
+    """
+    Deletes all chunks that are not used by any manifest of the remaining backup folders
+
+    Parameters
+    ----------
+    backup_path: str
+        path to folder where backups get stored
+
+    Returns
+    -------
+    num_deleted: int
+        number of deleted chunks
+    """
+    store_path = os.path.join(backup_path, chunk_store_foldername)
+    if not os.path.isdir(store_path):
+        return 0
+
+    used_chunks = set()
+    for folder in os.listdir(backup_path):
+        folder_path = os.path.join(backup_path, folder)
+        if folder == chunk_store_foldername or not os.path.isdir(folder_path):
+            continue
+        for entry in os.listdir(folder_path):
+            if entry.endswith(manifest_ending):
+                with open(os.path.join(folder_path, entry), "r", encoding="utf-8") as f:
+                    for file_entry in json.load(f)["files"]:
+                        used_chunks.update(file_entry[3])
+
+    num_deleted = 0
+    for root, dirs, files in os.walk(store_path):
+        for file in files:
+            if file not in used_chunks:
+                os.remove(os.path.join(root, file))
+                num_deleted += 1
+    logger.debug(f"Deleted {num_deleted} unused chunks from {store_path}")
+    return num_deleted
@@ -0,0 +1,85 @@
+"""
+Decides per file whether compressing it is worth the CPU time. Files with extensions of already compressed formats
+(images, videos, archives, office documents) are stored, all other files are judged by how well a sample of their
+first block compresses with the fastest zlib level.
+"""
+
+import os
+import zlib
+import logging
+
+logger = logging.getLogger()
+
+stored_extensions = {
+    # images
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "heif", "avif", "jp2", "jxl",
+    # audio and video
+    "mp3", "aac", "m4a", "ogg", "opus", "flac", "wma", "mp4", "m4v", "mkv", "avi", "mov", "wmv", "webm", "flv",
+    # archives and compressed data
+    "zip", "gz", "tgz", "bz2", "xz", "txz", "zst", "lz4", "7z", "rar", "cab", "jar", "apk", "whl", "deb", "rpm",
+    "dmg", "br",
+    # documents that are zip archives or compressed internally
+    "docx", "xlsx", "pptx", "odt", "ods", "odp", "epub", "pdf"
+}
+sample_size = 64 * 1024
+min_sample_size = 4 * 1024  # smaller files are always compressed, a sample says little and the CPU time is small
+max_sample_ratio = 0.95  # store files whose sample does not get smaller than this
+fast_sample_ratio = 0.8  # use fast_level for files that compress only a little
+fast_level = 1
+
+
+def get_extension(path: str):
+    """
+    Returns the lower case extension of a file without dot, "" if it has none
+    """
+    return os.path.splitext(path)[1].lower().lstrip(".")
+
+
+def get_sample_ratio(path: str, sample: bytes = None):
+    """
+    Compresses the first sample_size bytes of a file with zlib level 1 and returns compressed / original size.
+    The file is not read if its content is given as sample.
+    """
+    if sample is None:
+        with open(path, "rb") as f:
+            sample = f.read(sample_size)
+    sample = sample[:sample_size]
+    if len(sample) == 0:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def decide(path: str, size: int, level: int = None, sample: bytes = None):
+    """
+    Decides how a file should be written to a compressed backup
+
+    Parameters
+    ----------
+    path: str
+        path to the file
+    size: int
+        size of the file in bytes
+    level: int
+        compression level requested by the backup instructions, None for the default of the method
+    sample: bytes
+        content (or first block) of the file if it is already in memory, else the sample is read from path
+
+    Returns
+    -------
+    compress: bool
+        False if the file should be stored without compression
+    level: int
+        compression level to use, 0 if not compressed
+    reason: str
+        "extension", "small", "incompressible", "low_ratio" or "compressible"
+    """
+    if get_extension(path) in stored_extensions:
+        return False, 0, "extension"
+    if size < min_sample_size:
+        return True, level, "small"
+    ratio = get_sample_ratio(path, sample=sample)
+    if ratio > max_sample_ratio:
+        return False, 0, "incompressible"
+    if ratio > fast_sample_ratio and (level is None or level > fast_level):
+        return True, fast_level, "low_ratio"
+    return True, level, "compressible"
@@ -0,0 +1,192 @@
+"""
+Copy engine for uncompressed backups that keeps the data in the kernel. Tries in this order (method "auto"):
+reflink clone (FICLONE, btrfs/XFS: instant and blocks are shared), os.copy_file_range (in-kernel or server-side copy),
+os.sendfile and at last a normal read/write copy. Holes of sparse files are kept.
+"""
+
+import os
+import errno
+import shutil
+import logging
+
+logger = logging.getLogger()
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+copy_methods = ["auto", "reflink", "copy_file_range", "sendfile", "read_write"]
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+_fallback_errors = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                    errno.ENOTSUP, errno.EPERM)
+copy_chunk_size = 64 * 1024 * 1024  # bytes per copy_file_range / sendfile call
+
+
+def _reflink(src_fd: int, dst_fd: int):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflink needs fcntl")
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _get_data_segments(fd: int, size: int):
+    """
+    Returns list of (offset, length) of the data parts of a file. Holes of sparse files are skipped if the
+    filesystem supports SEEK_DATA/SEEK_HOLE, else the whole file is one segment.
+    """
+    if not hasattr(os, "SEEK_DATA") or size == 0:
+        return [(0, size)]
+    segments = []
+    offset = 0
+    try:
+        while offset < size:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+            segments.append((data_start, min(data_end, size) - data_start))
+            offset = data_end
+    except OSError as e:
+        if e.errno == errno.ENXIO:  # no data after offset, rest of the file is a hole
+            return segments
+        return [(0, size)]
+    return segments
+
+
+def _limit(limiter, num_bytes: int):
+    if limiter is not None:
+        limiter.read(num_bytes)
+        limiter.write(num_bytes)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, segments: list, limiter=None):
+    for offset, length in segments:
+        copied = 0
+        while copied < length:
+            n = os.copy_file_range(src_fd, dst_fd, min(length - copied, copy_chunk_size),
+                                   offset + copied, offset + copied)
+            if n == 0:
+                raise OSError(errno.EINVAL, "copy_file_range copied 0 bytes")
+            _limit(limiter, n)
+            copied += n
+
+
+def _sendfile(src_fd: int, dst_fd: int, segments: list, limiter=None):
+    for offset, length in segments:
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        copied = 0
+        while copied < length:
+            n = os.sendfile(dst_fd, src_fd, offset + copied, min(length - copied, copy_chunk_size))
+            if n == 0:
+                raise OSError(errno.EINVAL, "sendfile copied 0 bytes")
+            _limit(limiter, n)
+            copied += n
+
+
+def _read_write(src_fd: int, dst_fd: int, segments: list, limiter=None):
+    for offset, length in segments:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        copied = 0
+        while copied < length:
+            data = os.read(src_fd, min(length - copied, 1024 * 1024))
+            if not data:
+                break
+            os.write(dst_fd, data)
+            _limit(limiter, len(data))
+            copied += len(data)
+
+
+def copy_file(src: str, dst: str, method: str = "auto", limiter=None):
+    """
+    Copies a file with the fastest available method and copies its metadata (like shutil.copy2)
+
+    Parameters
+    ----------
+    src: str
+        path to source file
+    dst: str
+        path to target file
+    method: str
+        one of copy_methods. Every method falls back to the next one of "auto" if it is not supported
+    limiter: rate_limiter.RateLimiter
+        limits of the copied bytes and the file operations, not limited if None. Reflinks copy no data
+
+    Returns
+    -------
+    used_method: str
+        method that finally copied the file
+    """
+    if method not in copy_methods:
+        raise ValueError(f"Unknown copy method <{method}>. Use one of {copy_methods}")
+    order = copy_methods[copy_methods.index(method):] if method != "auto" else copy_methods[1:]
+    used_method = None
+    if limiter is not None:
+        limiter.file_op()
+
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        src_fd, dst_fd = f_src.fileno(), f_dst.fileno()
+        size = os.fstat(src_fd).st_size
+        segments = None
+        for candidate in order:
+            try:
+                if candidate == "reflink":
+                    _reflink(src_fd, dst_fd)
+                else:
+                    if segments is None:
+                        segments = _get_data_segments(src_fd, size)
+                    if candidate == "copy_file_range":
+                        if not hasattr(os, "copy_file_range"):
+                            continue
+                        _copy_file_range(src_fd, dst_fd, segments, limiter=limiter)
+                    elif candidate == "sendfile":
+                        if not hasattr(os, "sendfile"):
+                            continue
+                        _sendfile(src_fd, dst_fd, segments, limiter=limiter)
+                    else:
+                        _read_write(src_fd, dst_fd, segments, limiter=limiter)
+                    # the end of the file may be a hole that was not written
+                    os.ftruncate(dst_fd, size)
+                used_method = candidate
+                break
+            except OSError as e:
+                if candidate == "read_write" or e.errno not in _fallback_errors:
+                    raise
+                logger.debug(f"Copy method {candidate} not possible for {src} ({e}). Try next one.")
+                os.ftruncate(dst_fd, 0)
+
+    shutil.copystat(src, dst)
+    return used_method
+
+
+def copy_tree(src: str, dst: str, scan: dict, method: str = "auto", limiter=None):
+    """
+    Copies all folders and files found by scan_item from src to dst with copy_file
+
+    Parameters
+    ----------
+    src: str
+        path to source folder
+    dst: str
+        path to target folder, is created
+    scan: dict
+        result of scan_item for src
+    method: str
+        one of copy_methods
+    limiter: rate_limiter.RateLimiter
+        limits of the copied bytes and the file operations, not limited if None
+
+    Returns
+    -------
+    used_methods: dict
+        number of files per used copy method
+    """
+    used_methods = {}
+    os.makedirs(dst)
+    for rel_dir in scan["dirs"]:
+        os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+    for rel_path, size, mtime_ns, ino in scan["files"]:
+        used = copy_file(os.path.join(src, rel_path), os.path.join(dst, rel_path), method=method, limiter=limiter)
+        used_methods[used] = used_methods.get(used, 0) + 1
+    for rel_dir in reversed(scan["dirs"]):
+        shutil.copystat(os.path.join(src, rel_dir), os.path.join(dst, rel_dir))
+    logger.debug(f"Copied {src} to {dst} with methods {used_methods}")
+    return used_methods
@@ -0,0 +1,225 @@
+"""
+Compact binary manifest with one entry (path, size, mtime_ns, hash) per backuped file. The entries are sorted by path
+and stored in blocks of block_entries entries. Every block is columnar (all sizes, all mtimes, all hashes, all paths)
+and compressed with zlib. An index with the first path and the offset of every block is stored at the end of the file,
+so a lookup only reads the index and one block (binary search) and iterating only holds one block in memory.
+
+Layout (little endian):
+    header: magic, version, flags, length and name of the hash function, digest size, number of entries,
+            number of blocks, offset of the index
+    blocks: zlib(sizes u64[n] | mtimes i64[n] | hashes digest_size[n] | path lengths u32[n] | paths)
+    index:  per block: offset u64, stored length u32, entries u32, length of first path u16, first path
+"""
+
+import os
+import zlib
+import struct
+import bisect
+import logging
+
+import hash_functions
+
+logger = logging.getLogger()
+
+manifest_ending = "_file_manifest.btm"
+magic = b"BTMF"
+version = 1
+flag_compressed = 1
+block_entries = 1024
+_header = struct.Struct("<4sHHB")
+_header_rest = struct.Struct("<BQIQ")
+_index_entry = struct.Struct("<QIIH")
+
+
+class ManifestWriter:
+    """
+    Writes a manifest. Entries have to be added sorted by path (see write_manifest for unsorted entries).
+    """
+
+    def __init__(self, path: str, hash_func: str = 'md5', compress: bool = True):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.hash_func = hash_func
+        self.digest_size = hash_functions.get_digest_size(hash_func)
+        self.compress = compress
+        self.block = []
+        self.index = []
+        self.count = 0
+        self.last_path = None
+        self.f = open(self.tmp_path, "wb")
+        name = hash_func.encode("ascii")
+        self.f.write(_header.pack(magic, version, flag_compressed if compress else 0, len(name)) + name)
+        self.header_rest_offset = self.f.tell()
+        self.f.write(_header_rest.pack(self.digest_size, 0, 0, 0))
+
+    def add(self, path: str, size: int, mtime_ns: int, hash: str):
+        encoded_path = os.fsencode(path)
+        if self.last_path is not None and encoded_path <= self.last_path:
+            raise ValueError(f"Manifest entries have to be sorted and unique, <{path}> is not")
+        self.last_path = encoded_path
+        digest = bytes.fromhex(hash) if hash is not None else bytes(self.digest_size)
+        self.block.append((encoded_path, size, mtime_ns, digest))
+        self.count += 1
+        if len(self.block) >= block_entries:
+            self._write_block()
+
+    def _write_block(self):
+        n = len(self.block)
+        paths = [entry[0] for entry in self.block]
+        data = b"".join([struct.pack(f"<{n}Q", *[entry[1] for entry in self.block]),
+                         struct.pack(f"<{n}q", *[entry[2] for entry in self.block]),
+                         b"".join(entry[3] for entry in self.block),
+                         struct.pack(f"<{n}I", *[len(path) for path in paths]),
+                         b"".join(paths)])
+        if self.compress:
+            data = zlib.compress(data, 6)
+        self.index.append((self.f.tell(), len(data), n, paths[0]))
+        self.f.write(data)
+        self.block = []
+
+    def close(self):
+        if self.block:
+            self._write_block()
+        index_offset = self.f.tell()
+        for offset, length, n, first_path in self.index:
+            self.f.write(_index_entry.pack(offset, length, n, len(first_path)) + first_path)
+        self.f.seek(self.header_rest_offset)
+        self.f.write(_header_rest.pack(self.digest_size, self.count, len(self.index), index_offset))
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmp_path)
+
+
+class ManifestReader:
+    """
+    Reads a manifest. Opening only reads header and index, lookup() reads one block, iterating streams all blocks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            file_magic, file_version, self.flags, name_length = _header.unpack(f.read(_header.size))
+            if file_magic != magic or file_version != version:
+                raise ValueError(f"{path} is not a file manifest of version {version}")
+            self.hash_func = f.read(name_length).decode("ascii")
+            self.digest_size, self.count, num_blocks, index_offset = _header_rest.unpack(f.read(_header_rest.size))
+            f.seek(index_offset)
+            index_data = f.read()
+        self.index = []
+        position = 0
+        for _ in range(num_blocks):
+            offset, length, n, path_length = _index_entry.unpack_from(index_data, position)
+            position += _index_entry.size
+            self.index.append((offset, length, n, index_data[position:position + path_length]))
+            position += path_length
+        self.first_paths = [entry[3] for entry in self.index]
+        self._cached_block = (None, None)
+
+    def __len__(self):
+        return self.count
+
+    def _read_block(self, block_idx: int):
+        """
+        Returns the uncompressed data and the paths of a block, the other columns are decoded when needed
+        """
+        # read once, the reader is shared by the verify threads and another thread may replace the cached block
+        cached_idx, cached_block = self._cached_block
+        if cached_idx == block_idx:
+            return cached_block
+        offset, length, n, first_path = self.index[block_idx]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if self.flags & flag_compressed:
+            data = zlib.decompress(data)
+        lengths_start = (16 + self.digest_size) * n
+        paths, position = [], lengths_start + 4 * n
+        for path_length in struct.unpack_from(f"<{n}I", data, lengths_start):
+            paths.append(data[position:position + path_length])
+            position += path_length
+        block = (data, n, paths)
+        self._cached_block = (block_idx, block)
+        return block
+
+    def _get_hash(self, data: bytes, n: int, idx: int):
+        # files without hash are stored with a digest of zeros
+        start = 16 * n + idx * self.digest_size
+        digest = data[start:start + self.digest_size]
+        return digest.hex() if digest.count(0) != self.digest_size else None
+
+    def _iter_block(self, block_idx: int):
+        data, n, paths = self._read_block(block_idx)
+        sizes = struct.unpack_from(f"<{n}Q", data, 0)
+        mtimes = struct.unpack_from(f"<{n}q", data, 8 * n)
+        for idx in range(n):
+            yield paths[idx], sizes[idx], mtimes[idx], self._get_hash(data, n, idx)
+
+    def lookup(self, path: str):
+        """
+        Returns (size, mtime_ns, hash) of the file with the given path, None if it is not in the manifest
+        """
+        encoded_path = os.fsencode(path)
+        block_idx = bisect.bisect_right(self.first_paths, encoded_path) - 1
+        if block_idx < 0:
+            return None
+        data, n, paths = self._read_block(block_idx)
+        idx = bisect.bisect_left(paths, encoded_path)
+        if idx == len(paths) or paths[idx] != encoded_path:
+            return None
+        size, = struct.unpack_from("<Q", data, 8 * idx)
+        mtime_ns, = struct.unpack_from("<q", data, 8 * n + 8 * idx)
+        return size, mtime_ns, self._get_hash(data, n, idx)
+
+    def iter_prefix(self, prefix: str):
+        """
+        Yields (path, size, mtime_ns, hash) of all files whose path starts with prefix, in order
+        """
+        encoded_prefix = os.fsencode(prefix)
+        start_block = max(bisect.bisect_right(self.first_paths, encoded_prefix) - 1, 0)
+        for block_idx in range(start_block, len(self.index)):
+            for path, size, mtime_ns, hash in self._iter_block(block_idx):
+                if path.startswith(encoded_prefix):
+                    yield os.fsdecode(path), size, mtime_ns, hash
+                elif path > encoded_prefix:
+                    return
+
+    def __iter__(self):
+        for block_idx in range(len(self.index)):
+            for path, size, mtime_ns, hash in self._iter_block(block_idx):
+                yield os.fsdecode(path), size, mtime_ns, hash
+
+
+def write_manifest(path: str, entries: list, hash_func: str = 'md5', compress: bool = True):
+    """
+    Sorts the entries and writes them as manifest
+
+    Parameters
+    ----------
+    path: str
+        path to the manifest file, written to a temp file first and renamed
+    entries: list
+        tuples of (path, size, mtime_ns, hash) per file, hash is a hexdigest or None
+    hash_func: str
+        method of the hash algorithm of the hashes
+    compress: bool
+        compress the blocks with zlib
+
+    Returns
+    -------
+    size: int
+        size of the written manifest in bytes
+    """
+    with ManifestWriter(path, hash_func=hash_func, compress=compress) as writer:
+        for entry in sorted(entries, key=lambda e: os.fsencode(e[0])):
+            writer.add(*entry)
+    logger.debug(f"File manifest with {len(entries)} entries written to {path}")
+    return os.path.getsize(path)
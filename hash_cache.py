@@ -0,0 +1,200 @@
+"""
+Persistent cache of file hashes. A hash is only valid as long as inode, size and mtime of the file did not change.
+The cache is a SQLite file that is stored next to the backups in the destination folder.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger()
+
+hash_cache_filename = "hash_cache.sqlite"
+_lock = threading.Lock()
+
+
+def open_hash_cache(folder_path: str):
+    """
+    Opens (and creates if needed) the hash cache in the given folder
+
+    Parameters
+    ----------
+    folder_path: str
+        path to folder where the cache file is stored, usually the destination of the backups
+
+    Returns
+    -------
+    cache: sqlite3.Connection
+        connection to the cache database
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    cache_path = os.path.join(folder_path, hash_cache_filename)
+    logger.debug(f"Open hash cache {cache_path}")
+    cache = sqlite3.connect(cache_path, check_same_thread=False)
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute("PRAGMA synchronous=NORMAL")
+    cache.execute("""CREATE TABLE IF NOT EXISTS file_hashes (
+                         path TEXT NOT NULL,
+                         hash_func TEXT NOT NULL,
+                         inode INTEGER NOT NULL,
+                         size INTEGER NOT NULL,
+                         mtime_ns INTEGER NOT NULL,
+                         hash TEXT NOT NULL,
+                         PRIMARY KEY (path, hash_func))""")
+    # file hashes per folder of a scanned tree, valid as long as the fingerprint of the folder is the same
+    cache.execute("""CREATE TABLE IF NOT EXISTS tree_hashes (
+                         root TEXT NOT NULL,
+                         rel_dir TEXT NOT NULL,
+                         hash_func TEXT NOT NULL,
+                         fingerprint TEXT NOT NULL,
+                         hashes TEXT NOT NULL,
+                         PRIMARY KEY (root, rel_dir, hash_func))""")
+    cache.commit()
+    return cache
+
+
+def close_hash_cache(cache: sqlite3.Connection):
+    """
+    Writes all pending changes to disk and closes the cache
+    """
+    with _lock:
+        cache.commit()
+        cache.close()
+
+
+def get_cached_hash(cache: sqlite3.Connection, path: str, inode: int, size: int, mtime_ns: int, hash_func: str):
+    """
+    Returns the cached hash of given file if its stat signature is still the same
+
+    Parameters
+    ----------
+    cache: sqlite3.Connection
+        opened hash cache
+    path: str
+        absolute path to file
+    inode: int
+        inode of the file
+    size: int
+        size of the file in bytes
+    mtime_ns: int
+        modification time of the file in nanoseconds
+    hash_func: str
+        name of the hash algorithm
+
+    Returns
+    -------
+    hash: str
+        cached hexdigest, None if unknown or outdated
+    """
+    with _lock:
+        row = cache.execute("SELECT inode, size, mtime_ns, hash FROM file_hashes WHERE path = ? AND hash_func = ?",
+                            (path, hash_func)).fetchone()
+    if row is None or tuple(row[:3]) != (inode, size, mtime_ns):
+        return None
+    return row[3]
+
+
+def get_cached_hashes(cache: sqlite3.Connection, root: str, hash_func: str):
+    """
+    Returns all cached hashes of a file or of all files below a folder with one query
+
+    Parameters
+    ----------
+    cache: sqlite3.Connection
+        opened hash cache
+    root: str
+        absolute path to file or folder
+    hash_func: str
+        name of the hash algorithm
+
+    Returns
+    -------
+    cached_hashes: dict
+        tuple of (inode, size, mtime_ns, hash) per absolute file path
+    """
+    prefix = os.path.join(root, "")
+    with _lock:
+        rows = cache.execute("SELECT path, inode, size, mtime_ns, hash FROM file_hashes "
+                             "WHERE hash_func = ? AND (path = ? OR substr(path, 1, ?) = ?)",
+                             (hash_func, root, len(prefix), prefix)).fetchall()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def store_hash(cache: sqlite3.Connection, path: str, inode: int, size: int, mtime_ns: int, hash_func: str,
+               hash: str):
+    """
+    Stores the hash of given file together with its stat signature. Parameters like get_cached_hash
+    """
+    with _lock:
+        cache.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                      (path, hash_func, inode, size, mtime_ns, hash))
+
+
+def get_tree_hashes(cache: sqlite3.Connection, root: str, hash_func: str):
+    """
+    Returns the stored file hashes of all folders of a tree
+
+    Parameters
+    ----------
+    cache: sqlite3.Connection
+        opened hash cache
+    root: str
+        absolute path to the scanned folder
+    hash_func: str
+        name of the hash algorithm
+
+    Returns
+    -------
+    tree_hashes: dict
+        tuple of (fingerprint, list of file hashes) per relative folder path
+    """
+    with _lock:
+        rows = cache.execute("SELECT rel_dir, fingerprint, hashes FROM tree_hashes WHERE root = ? AND hash_func = ?",
+                             (root, hash_func)).fetchall()
+    return {rel_dir: (fingerprint, json.loads(hashes)) for rel_dir, fingerprint, hashes in rows}
+
+
+def store_tree_hashes(cache: sqlite3.Connection, root: str, hash_func: str, tree_hashes: dict):
+    """
+    Replaces the stored file hashes of all folders of a tree. Parameters like get_tree_hashes
+    """
+    with _lock:
+        cache.execute("DELETE FROM tree_hashes WHERE root = ? AND hash_func = ?", (root, hash_func))
+        cache.executemany("INSERT INTO tree_hashes VALUES (?, ?, ?, ?, ?)",
+                          [(root, rel_dir, hash_func, fingerprint, json.dumps(hashes))
+                           for rel_dir, (fingerprint, hashes) in tree_hashes.items()])
+
+
+def evict_deleted_files(cache: sqlite3.Connection, root: str, seen_paths: set):
+    """
+    Removes all entries below root whose files were not seen in the current scan
+
+    Parameters
+    ----------
+    cache: sqlite3.Connection
+        opened hash cache
+    root: str
+        absolute path to scanned source folder
+    seen_paths: set
+        absolute paths of all files that exist below root
+
+    Returns
+    -------
+    num_evicted: int
+        number of removed entries
+    """
+    prefix = os.path.join(root, "")
+    with _lock:
+        cached_paths = [row[0] for row in cache.execute(
+            "SELECT DISTINCT path FROM file_hashes WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))]
+        deleted_paths = [(path,) for path in cached_paths if path not in seen_paths]
+        cache.executemany("DELETE FROM file_hashes WHERE path = ?", deleted_paths)
+        cached_roots = [row[0] for row in cache.execute(
+            "SELECT DISTINCT root FROM tree_hashes WHERE substr(root, 1, ?) = ?", (len(prefix), prefix))]
+        cache.executemany("DELETE FROM tree_hashes WHERE root = ?",
+                          [(path,) for path in cached_roots if not os.path.isdir(path)])
+        cache.commit()
+    logger.debug(f"Evicted {len(deleted_paths)} deleted files below {root} from hash cache")
+    return len(deleted_paths)
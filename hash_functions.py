@@ -0,0 +1,128 @@
+"""
+Hash algorithms of the backups. Every backup records the algorithm of its hashes ("hash_func" in the info dict, the
+name in the header of the file manifest), so backups made with another algorithm stay verifiable. The algorithms of
+hashlib are always available, blake3 and the xxHash family need the optional packages blake3 / xxhash. xxHash is not
+cryptographic: it detects changes and bit rot, but not deliberate tampering.
+"""
+
+import hashlib
+import logging
+import threading
+import importlib
+import importlib.util
+
+logger = logging.getLogger()
+
+default_hash_func = "md5"  # algorithm of backups of older versions, their info dicts do not record one
+hash_buffer_size = 1024 * 1024  # bytes read per call when a file is hashed
+hash_workers = 4  # files hashed at the same time
+
+hashlib_functions = ["md5", "sha1", "sha256", "sha512", "blake2b", "blake2s", "sha3_256"]
+optional_functions = {
+    # name: (package, constructor)
+    "blake3": ("blake3", "blake3"),
+    "xxh64": ("xxhash", "xxh64"),
+    "xxh3_64": ("xxhash", "xxh3_64"),
+    "xxh3_128": ("xxhash", "xxh3_128")
+}
+
+_constructors = {}
+_available_functions = None
+_lock = threading.Lock()
+
+
+def get_available_hash_functions():
+    """
+    Returns the names of all hash algorithms that can be used, the optional ones only if their package is installed
+    """
+    global _available_functions
+    if _available_functions is None:
+        # looked up once, find_spec costs more than hashing a small file. The optional packages are only imported
+        # when a hash is created the first time
+        _available_functions = hashlib_functions + [name for name, (package, _) in optional_functions.items()
+                                                    if importlib.util.find_spec(package) is not None]
+    return list(_available_functions)
+
+
+def is_available(hash_func: str):
+    """
+    Returns True if the hash algorithm can be used, see get_available_hash_functions
+    """
+    if _available_functions is None:
+        get_available_hash_functions()
+    return hash_func in _available_functions
+
+
+def get_constructor(hash_func: str):
+    """
+    Returns the constructor of a hash algorithm, looked up once per algorithm
+
+    Parameters
+    ----------
+    hash_func: str
+        name of the algorithm, one of get_available_hash_functions()
+
+    Returns
+    -------
+    constructor: callable
+        creates a new hash object (update, digest, hexdigest), optionally with initial data
+    """
+    constructor = _constructors.get(hash_func)
+    if constructor is not None:
+        return constructor
+    with _lock:
+        if hash_func in hashlib_functions:
+            constructor = getattr(hashlib, hash_func)
+        elif hash_func in optional_functions and is_available(hash_func):
+            package, name = optional_functions[hash_func]
+            constructor = getattr(importlib.import_module(package), name)
+        else:
+            raise ValueError(f"Hash algorithm <{hash_func}> is not available. Use one of "
+                             f"{get_available_hash_functions()}")
+        _constructors[hash_func] = constructor
+    return constructor
+
+
+def new_hash(hash_func: str, data: bytes = None):
+    """
+    Returns a new hash object of the given algorithm, fed with data if given
+    """
+    constructor = get_constructor(hash_func)
+    return constructor() if data is None else constructor(data)
+
+
+def get_digest_size(hash_func: str):
+    """
+    Returns the size of the digest of an algorithm in bytes
+    """
+    return len(new_hash(hash_func).digest())
+
+
+def hash_file(path: str, hash_func: str = default_hash_func, buffer_size: int = None):
+    """
+    Hashes a file with one reused buffer
+
+    Parameters
+    ----------
+    path: str
+        path to the file
+    hash_func: str
+        name of the algorithm
+    buffer_size: int
+        bytes read per call, hash_buffer_size if None
+
+    Returns
+    -------
+    hash: str
+        hexdigest of the file content
+    """
+    hash = new_hash(hash_func)
+    buffer = bytearray(buffer_size or hash_buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hash.update(view[:n])
+    return hash.hexdigest()
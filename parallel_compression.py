@@ -0,0 +1,203 @@
+"""
+Multi-core compression of folders. The folder is written as tar stream, the stream is cut into chunks and every chunk
+is compressed on its own in a thread pool. The compressed chunks are written in order as concatenated members
+(gzip, xz, zstd and lz4 all allow that), so the result is a normal archive that can be read with tar.
+"""
+
+import os
+import io
+import gzip
+import lzma
+import logging
+import tarfile
+import importlib.util
+import concurrent.futures
+from collections import deque
+
+import hash_functions
+
+logger = logging.getLogger()
+
+chunk_size = 4 * 1024 * 1024  # uncompressed bytes per compression job
+default_levels = {"gz": 6, "xz": 6, "zstd": 3, "lz4": 0}
+
+
+def _compress_gz(data: bytes, level: int):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compress_xz(data: bytes, level: int):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+
+def _compress_zstd(data: bytes, level: int):
+    import zstandard
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _compress_lz4(data: bytes, level: int):
+    import lz4.frame
+    return lz4.frame.compress(data, compression_level=level)
+
+
+codecs = {
+    "gz": _compress_gz,
+    "xz": _compress_xz,
+    "zstd": _compress_zstd,
+    "lz4": _compress_lz4
+}
+
+
+def get_available_codecs():
+    """
+    Returns the names of all codecs that can be used, zstd and lz4 need the optional packages zstandard and lz4
+    """
+    available = ["gz", "xz"]
+    # only look for the optional packages, they are imported when a chunk gets compressed
+    if importlib.util.find_spec("zstandard") is not None:
+        available.append("zstd")
+    if importlib.util.find_spec("lz4") is not None:
+        available.append("lz4")
+    return available
+
+
+class ParallelCompressedWriter(io.RawIOBase):
+    """
+    Write-only file object that compresses everything written to it chunk by chunk in a thread pool and writes the
+    compressed chunks in the original order to the target file. At most 2 * workers chunks are in memory.
+    """
+
+    def __init__(self, fileobj, codec: str, level: int = None, workers: int = None, limiter=None):
+        if codec not in get_available_codecs():
+            raise ValueError(f"Compression codec <{codec}> is not available. Use one of {get_available_codecs()}")
+        self.fileobj = fileobj
+        self.compress = codecs[codec]
+        self.level = default_levels[codec] if level is None else level
+        self.workers = workers or os.cpu_count() or 1
+        self.limiter = limiter
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+        while len(self.buffer) >= chunk_size:
+            self._submit(bytes(self.buffer[:chunk_size]))
+            del self.buffer[:chunk_size]
+        return len(data)
+
+    def _submit(self, data: bytes):
+        self.pending.append(self.executor.submit(self.compress, data, self.level))
+        # backpressure: wait for the oldest chunk if too many are in flight
+        while len(self.pending) >= 2 * self.workers:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        compressed = self.pending.popleft().result()
+        if self.limiter is not None:
+            self.limiter.write(len(compressed))
+        self.fileobj.write(compressed)
+        self.bytes_out += len(compressed)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or self.bytes_in == 0:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self._write_oldest()
+        finally:
+            self.executor.shutdown(wait=True)
+            super().close()
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Read-only file object that feeds every read block into a hash. Used to hash files while tarfile reads them.
+    """
+
+    def __init__(self, fileobj, hash_func: str, limiter=None):
+        self.fileobj = fileobj
+        self.hash = hash_functions.new_hash(hash_func)
+        self.limiter = limiter
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if self.limiter is not None:
+            self.limiter.read(len(data))
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def write_compressed_tar(src: str, dst: str, scan: dict, codec: str = "gz", level: int = None, workers: int = None,
+                         hash_func: str = 'md5', limiter=None):
+    """
+    Writes the folder src with all files found by the scan as tar archive compressed with multiple cores.
+    The archive has the same layout as the zip archives (paths relative to src). Every file is read only once.
+
+    Parameters
+    ----------
+    src: str
+        path to directory to be compressed
+    dst: str
+        path to archive without ending, '.tar.<codec>' is added
+    scan: dict
+        result of scan_item for src
+    codec: str
+        one of get_available_codecs()
+    level: int
+        compression level of the codec, default_levels if None
+    workers: int
+        number of compression threads, number of cpus if None
+    hash_func: str
+        method of hash algorithm
+    limiter: rate_limiter.RateLimiter
+        limits of the read bytes, written compressed bytes and file operations, not limited if None
+
+    Returns
+    -------
+    file_hashes: dict
+        hexdigest per relative file path
+    """
+    dst = f"{dst}.tar.{codec}"
+    file_hashes = {}
+
+    with open(dst, "wb") as f_dst:
+        writer = ParallelCompressedWriter(f_dst, codec=codec, level=level, workers=workers, limiter=limiter)
+        buffered = io.BufferedWriter(writer, buffer_size=chunk_size)
+        # linked files are stored with their content, like in the zip archives and the copies
+        with tarfile.open(fileobj=buffered, mode="w|", format=tarfile.PAX_FORMAT, dereference=True) as tar:
+            for rel_dir in scan["dirs"]:
+                tar.add(os.path.join(src, rel_dir), arcname=rel_dir, recursive=False)
+            for rel_path, size, mtime_ns, ino in scan["files"]:
+                src_file = os.path.join(src, rel_path)
+                tar_info = tar.gettarinfo(src_file, arcname=rel_path)
+                if not tar_info.isreg():
+                    # e.g. a named pipe, stored without data
+                    tar.addfile(tar_info)
+                    file_hashes[rel_path] = hash_functions.new_hash(hash_func).hexdigest()
+                    continue
+                if limiter is not None:
+                    limiter.file_op()
+                with open(src_file, "rb") as f_src:
+                    reader = HashingReader(f_src, hash_func=hash_func, limiter=limiter)
+                    tar.addfile(tar_info, reader)
+                file_hashes[rel_path] = reader.hexdigest()
+        buffered.close()
+
+    logger.debug(f"Compressed {writer.bytes_in} bytes to {writer.bytes_out} bytes with {codec} into {dst}")
+    return file_hashes
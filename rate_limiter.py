@@ -0,0 +1,239 @@
+"""
+Throttling of backups, so they do not starve other workloads on the same disks. A RateLimiter holds token buckets
+for read bytes, written bytes and file operations per second. All threads of a backup share the buckets, so the
+limits hold for the parallel items together. Every limit can change with the time of day (e.g. slow during business
+hours, unlimited at night). The CPU and I/O priority of the backup threads can be lowered with nice and ioprio.
+
+Schedule syntax of a limit: comma separated rules "HH:MM-HH:MM=value" and one optional plain value used outside of
+all windows, e.g. "08:00-18:00=20,200". Windows may wrap midnight ("22:00-06:00=0"). 0 or empty means unlimited.
+"""
+
+import os
+import time
+import ctypes
+import logging
+import platform
+import threading
+from datetime import datetime
+
+logger = logging.getLogger()
+
+burst_seconds = 1.0  # tokens of at most this many seconds of the rate are saved up while idle
+io_classes = {"realtime": 1, "best_effort": 2, "idle": 3}
+_ioprio_set_syscalls = {"x86_64": 251, "amd64": 251, "aarch64": 30, "arm64": 30, "i386": 289, "i686": 289,
+                        "armv7l": 314, "ppc64le": 273, "s390x": 282, "riscv64": 30}
+_ioprio_who_process = 1
+_ioprio_class_shift = 13
+
+
+def _parse_time(value: str):
+    hours, minutes = value.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_schedule(value, scale: float = 1.0):
+    """
+    Parses a limit of the backup instructions
+
+    Parameters
+    ----------
+    value: str, int, float or None
+        plain number or schedule (see module description)
+    scale: float
+        factor for all values, e.g. 1e6 for limits given in MB/s
+
+    Returns
+    -------
+    schedule: list
+        list of (start minute, end minute, rate) with a rule (None, None, rate) for the time outside of all windows.
+        A rate of 0 means unlimited. Empty list if there is no limit at all.
+    """
+    if value is None or str(value).strip() == "":
+        return []
+    schedule = []
+    for rule in str(value).split(","):
+        rule = rule.strip()
+        if rule == "":
+            continue
+        if "=" in rule:
+            window, rate = rule.split("=", 1)
+            start, end = window.split("-")
+            schedule.append((_parse_time(start), _parse_time(end), float(rate) * scale))
+        else:
+            schedule.append((None, None, float(rule) * scale))
+    if all(rate == 0 for start, end, rate in schedule):
+        return []
+    return schedule
+
+
+def get_rate(schedule: list, now: datetime = None):
+    """
+    Returns the rate of a schedule at the given time (now if None), 0 if unlimited
+    """
+    if len(schedule) == 0:
+        return 0
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    default = 0
+    for start, end, rate in schedule:
+        if start is None:
+            default = rate
+        elif start <= minute < end or (end <= start and (minute >= start or minute < end)):
+            return rate
+    return default
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. consume() takes the tokens at once and sleeps until the bucket is no longer in debt,
+    so big amounts (e.g. one 64 MiB copy call) are allowed and paid afterwards. The rate is taken from the schedule
+    on every call, so a change of the time window applies immediately.
+    """
+
+    def __init__(self, schedule: list, name: str = ""):
+        self.schedule = schedule
+        self.name = name
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.waited_s = 0.0
+
+    def consume(self, amount: float):
+        """
+        Takes amount tokens, blocks while the bucket is in debt. Returns the seconds waited.
+        """
+        rate = get_rate(self.schedule)
+        if rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last) * rate, rate * burst_seconds)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / rate if self.tokens < 0 else 0.0
+            self.waited_s += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """
+    Limits of one backup (one row of the backup instructions): read bytes, written bytes and file operations
+    (files opened or created) per second
+    """
+
+    def __init__(self, read_bytes: list = None, write_bytes: list = None, file_ops: list = None):
+        self.buckets = {"read_bytes": TokenBucket(read_bytes or [], "read_bytes"),
+                        "write_bytes": TokenBucket(write_bytes or [], "write_bytes"),
+                        "file_ops": TokenBucket(file_ops or [], "file_ops")}
+
+    def read(self, num_bytes: int):
+        return self.buckets["read_bytes"].consume(num_bytes)
+
+    def write(self, num_bytes: int):
+        return self.buckets["write_bytes"].consume(num_bytes)
+
+    def file_op(self, num_ops: int = 1):
+        return self.buckets["file_ops"].consume(num_ops)
+
+    def limit_write(self, write):
+        """
+        Returns a write function that takes write_bytes tokens for every block before it calls write
+        """
+        def limited_write(data):
+            self.write(len(data))
+            return write(data)
+        return limited_write
+
+    def get_stats(self):
+        """
+        Returns the seconds the backup waited per limit
+        """
+        return {name: round(bucket.waited_s, 6) for name, bucket in self.buckets.items()}
+
+
+def create_limiter(max_read_mb_s=None, max_write_mb_s=None, max_file_ops=None):
+    """
+    Creates the rate limiter of a backup from the values of the backup instructions
+
+    Parameters
+    ----------
+    max_read_mb_s: str, int, float or None
+        limit or schedule of the read bytes in MB/s
+    max_write_mb_s: str, int, float or None
+        limit or schedule of the written bytes in MB/s
+    max_file_ops: str, int, float or None
+        limit or schedule of the files opened or created per second
+
+    Returns
+    -------
+    limiter: RateLimiter
+        None if nothing is limited
+    """
+    read_bytes = parse_schedule(max_read_mb_s, scale=1e6)
+    write_bytes = parse_schedule(max_write_mb_s, scale=1e6)
+    file_ops = parse_schedule(max_file_ops)
+    if not read_bytes and not write_bytes and not file_ops:
+        return None
+    logger.debug(f"Rate limits: read {read_bytes} B/s, write {write_bytes} B/s, file ops {file_ops} 1/s")
+    return RateLimiter(read_bytes=read_bytes, write_bytes=write_bytes, file_ops=file_ops)
+
+
+def set_thread_priority(nice: int = None, io_class: str = None, io_level: int = 4):
+    """
+    Lowers the CPU and I/O priority of the calling thread. On Linux both are per thread and inherited by threads
+    started afterwards, so calling it at the start of a backup covers all its worker threads. Not supported
+    settings are logged and skipped.
+
+    Parameters
+    ----------
+    nice: int
+        nice increment (e.g. 10), unchanged if None
+    io_class: str
+        one of io_classes, unchanged if None. "idle" only gets disk time when no other process needs it
+    io_level: int
+        priority 0 (highest) - 7 within the best_effort and realtime classes
+    """
+    tid = threading.get_native_id()
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, tid) + int(nice))
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Could not set nice {nice}: {e}")
+    if io_class is not None:
+        if io_class not in io_classes:
+            raise ValueError(f"Unknown io class <{io_class}>. Use one of {list(io_classes)}")
+        syscall = _ioprio_set_syscalls.get(platform.machine().lower())
+        if platform.system() != "Linux" or syscall is None:
+            logger.warning(f"ioprio is not supported on {platform.system()} {platform.machine()}")
+            return
+        libc = ctypes.CDLL(None, use_errno=True)
+        priority = (io_classes[io_class] << _ioprio_class_shift) | (0 if io_class == "idle" else int(io_level))
+        if libc.syscall(syscall, _ioprio_who_process, tid, priority) != 0:
+            logger.warning(f"Could not set io class {io_class}: {os.strerror(ctypes.get_errno())}")
+
+
+def run_with_priority(func, nice: int = None, io_class: str = None, io_level: int = 4):
+    """
+    Calls func in a new thread with lowered priority (see set_thread_priority) and returns its result. The priority
+    ends with the thread, so it does not stay on a reused thread of the caller. func is called directly if neither
+    nice nor io_class is given.
+    """
+    if nice is None and io_class is None:
+        return func()
+    result = {}
+
+    def run():
+        try:
+            set_thread_priority(nice=nice, io_class=io_class, io_level=io_level)
+            result["value"] = func()
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, name=f"{threading.current_thread().name} (low priority)")
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
@@ -0,0 +1,253 @@
+"""
+Reading of backuped items for verify and restore. Finds how an item was stored in a backup folder (plain copy, zip,
+parallel compressed tar or chunk store manifest), hashes its files again and restores it. Copied trees, zip archives
+and chunk store items are processed file by file in a thread pool, tar streams can only be read in order.
+"""
+
+import os
+import io
+import json
+import zlib
+import gzip
+import lzma
+import shutil
+import hashlib
+import logging
+import tarfile
+import zipfile
+import concurrent.futures
+from datetime import datetime
+
+import chunk_store
+import copy_engine
+import hash_functions
+import streaming_io
+import parallel_compression
+
+logger = logging.getLogger()
+
+read_size = 1024 * 1024  # bytes per read from zip members and tar streams
+
+
+def _get_workers(workers: int):
+    return workers or os.cpu_count() or 1
+
+
+def find_stored_item(folder_path: str, item: str):
+    """
+    Looks for the stored data of an item in a backup folder
+
+    Parameters
+    ----------
+    folder_path: str
+        path to the backup folder that holds the data of the item
+    item: str
+        name of the backuped file/folder
+
+    Returns
+    -------
+    path: str
+        path to the stored data, None if nothing was found
+    kind: str
+        one of "chunks", "file", "tree", "zip", "tar", None if nothing was found
+    """
+    path = os.path.join(folder_path, item)
+    # the plain name first: items whose output would clash with another item are stored with it
+    # (see get_colliding_items of backup_tool)
+    if os.path.isfile(path):
+        return path, "file"
+    if os.path.isdir(path):
+        return path, "tree"
+    if os.path.isfile(path + chunk_store.manifest_ending):
+        return path + chunk_store.manifest_ending, "chunks"
+    if os.path.isfile(path + ".zip"):
+        return path + ".zip", "zip"
+    for codec in parallel_compression.codecs:
+        if os.path.isfile(f"{path}.tar.{codec}"):
+            return f"{path}.tar.{codec}", "tar"
+    return None, None
+
+
+def _walk_tree(path: str):
+    """
+    Returns the relative paths of all folders and files below path
+    """
+    dirs, files = [], []
+    for root, dir_names, file_names in os.walk(path):
+        rel_root = os.path.relpath(root, path)
+        for name in dir_names:
+            dirs.append(os.path.normpath(os.path.join(rel_root, name)))
+        for name in file_names:
+            files.append(os.path.normpath(os.path.join(rel_root, name)))
+    return dirs, files
+
+
+def _hash_stream(f, hash_func: str):
+    hash = hash_functions.new_hash(hash_func)
+    while True:
+        data = f.read(read_size)
+        if not data:
+            break
+        hash.update(data)
+    return hash.hexdigest()
+
+
+def _open_tar(path: str):
+    """
+    Opens a tar archive written by parallel_compression for reading in stream mode. Returns (tar, raw file).
+    """
+    codec = path.rsplit(".", 1)[-1]
+    f = open(path, "rb")
+    if codec == "zstd":
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    elif codec == "lz4":
+        import lz4.frame
+        stream = lz4.frame.LZ4FrameFile(f, mode="rb")
+    elif codec == "xz":
+        stream = lzma.LZMAFile(f, mode="rb")
+    else:
+        # GzipFile reads all concatenated members, tarfile's own gz stream stops after the first one
+        stream = gzip.GzipFile(fileobj=f, mode="rb")
+    return tarfile.open(fileobj=io.BufferedReader(stream, buffer_size=read_size), mode="r|"), f
+
+
+def _hash_chunks(store_path: str, chunk_ids: list, hash_func: str):
+    """
+    Hashes a file of the chunk store and checks every chunk against its id (sha256 of the content)
+    """
+    hash = hash_functions.new_hash(hash_func)
+    for chunk_id in chunk_ids:
+        with open(chunk_store.get_chunk_path(store_path, chunk_id), "rb") as f_chunk:
+            data = zlib.decompress(f_chunk.read())
+        if hashlib.sha256(data).hexdigest() != chunk_id:
+            raise ValueError(f"Chunk {chunk_id} in {store_path} is corrupt")
+        hash.update(data)
+    return hash.hexdigest()
+
+
+def hash_stored_item(path: str, kind: str, hash_func: str = 'md5', workers: int = None):
+    """
+    Reads the stored data of an item and hashes every file in it
+
+    Parameters
+    ----------
+    path: str
+        path to the stored data, result of find_stored_item
+    kind: str
+        kind of the stored data, result of find_stored_item
+    hash_func: str
+        method of hash algorithm, the one used by the backup
+    workers: int
+        number of files hashed in parallel, number of cpus if None
+
+    Returns
+    -------
+    file_hashes: dict
+        hexdigest per relative file path. Stored files have their file name as only key
+    """
+    workers = _get_workers(workers)
+
+    if kind == "file":
+        return {os.path.basename(path): streaming_io.stream_file(path, lambda data: None, hash_func=hash_func)[0]}
+
+    if kind == "tree":
+        dirs, files = _walk_tree(path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = executor.map(lambda rel_path: streaming_io.stream_file(os.path.join(path, rel_path),
+                                                                            lambda data: None,
+                                                                            hash_func=hash_func)[0], files)
+            return dict(zip(files, hashes))
+
+    if kind == "zip":
+        # reading a member also checks its CRC, zipfile raises BadZipFile if the data is corrupt
+        with zipfile.ZipFile(path, mode="r") as zip_file:
+            members = [info.filename for info in zip_file.infolist() if not info.is_dir()]
+
+            def hash_member(name):
+                with zip_file.open(name) as member:
+                    return _hash_stream(member, hash_func)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                return dict(zip(members, executor.map(hash_member, members)))
+
+    if kind == "tar":
+        file_hashes = {}
+        tar, f = _open_tar(path)
+        with f, tar:
+            for member in tar:
+                if member.isreg():
+                    file_hashes[member.name] = _hash_stream(tar.extractfile(member), hash_func)
+        return file_hashes
+
+    if kind == "chunks":
+        store_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(path))),
+                                  chunk_store.chunk_store_foldername)
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        files = manifest["files"]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = executor.map(lambda entry: _hash_chunks(store_path, entry[3], hash_func), files)
+            return {entry[0]: hash for entry, hash in zip(files, hashes)}
+
+    raise ValueError(f"Unknown kind of stored item <{kind}>")
+
+
+def restore_stored_item(path: str, kind: str, target: str, copy_method: str = "auto", workers: int = None):
+    """
+    Restores the stored data of an item to target
+
+    Parameters
+    ----------
+    path: str
+        path to the stored data, result of find_stored_item
+    kind: str
+        kind of the stored data, result of find_stored_item
+    target: str
+        path of the restored file/folder, must not exist
+    copy_method: str
+        one of copy_engine.copy_methods for plain copied files and trees
+    workers: int
+        number of files restored in parallel, number of cpus if None
+    """
+    workers = _get_workers(workers)
+
+    if kind == "file":
+        copy_engine.copy_file(path, target, method=copy_method)
+    elif kind == "tree":
+        dirs, files = _walk_tree(path)
+        os.makedirs(target)
+        for rel_dir in dirs:
+            os.makedirs(os.path.join(target, rel_dir), exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda rel_path: copy_engine.copy_file(os.path.join(path, rel_path),
+                                                                     os.path.join(target, rel_path),
+                                                                     method=copy_method), files))
+        for rel_dir in reversed(dirs):
+            shutil.copystat(os.path.join(path, rel_dir), os.path.join(target, rel_dir))
+    elif kind == "zip":
+        os.makedirs(target)
+        with zipfile.ZipFile(path, mode="r") as zip_file:
+            members = zip_file.infolist()
+            # create all folders first, parallel extracts would race for the same parent folder
+            for info in members:
+                os.makedirs(os.path.join(target, os.path.dirname(info.filename.rstrip("/"))), exist_ok=True)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda info: zip_file.extract(info, target), members))
+            # zip only stores the local time with 2 s resolution
+            for info in members:
+                mtime = datetime(*info.date_time).timestamp()
+                os.utime(os.path.join(target, info.filename), (mtime, mtime))
+    elif kind == "tar":
+        os.makedirs(target)
+        tar, f = _open_tar(path)
+        with f, tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(target, filter="data")
+            else:
+                tar.extractall(target)
+    elif kind == "chunks":
+        chunk_store.restore_item(path, target, workers=workers)
+    else:
+        raise ValueError(f"Unknown kind of stored item <{kind}>")
+    logger.debug(f"Restored {path} ({kind}) to {target}")
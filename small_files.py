@@ -0,0 +1,163 @@
+"""
+Fast path for trees with millions of tiny files (source code, mail spools), where the per-file overhead and not the
+bandwidth is the limit. The files of a scan are already known with size, mtime and inode (scan_item uses the stat
+results of os.scandir), so a small file costs only open, fstat, one read and close. Consecutive small files are
+grouped into batches of up to batch_files files and batch_bytes bytes. A batch is one work unit of a reader thread,
+which reads and hashes all its files (and can do more CPU work on them, e.g. the compression decision), so thread
+switches and queue operations are paid per batch and not per file. Up to read_workers batches are read ahead while
+the caller packs the previous batch, e.g. as zip members written from memory (the central directory of the zip
+archive is the index of the packed files).
+"""
+
+import os
+import logging
+import collections
+import concurrent.futures
+
+import hash_functions
+
+logger = logging.getLogger()
+
+small_file_size = 256 * 1024  # files up to this size are read with one call
+batch_files = 256
+batch_bytes = 8 * 1024 * 1024
+read_workers = 4  # batches read at the same time, the peak memory is about (read_workers + 1) * batch_bytes
+_rest_size = 1024 * 1024
+
+
+def group_files(files: list, max_size: int = small_file_size):
+    """
+    Splits the file tuples of a scan into runs of consecutive small and big files, the order is kept
+
+    Parameters
+    ----------
+    files: list
+        tuples (relative_path, size, mtime_ns, inode) of scan_item
+    max_size: int
+        files up to this size count as small
+
+    Returns
+    -------
+    groups: list
+        list of (is_small, files)
+    """
+    groups = []
+    for f in files:
+        is_small = f[1] <= max_size
+        if groups and groups[-1][0] == is_small:
+            groups[-1][1].append(f)
+        else:
+            groups.append((is_small, [f]))
+    return groups
+
+
+def _split_batches(paths: list, sizes: list):
+    batches, batch, batch_size = [], [], 0
+    for path, size in zip(paths, sizes):
+        if batch and (len(batch) >= batch_files or batch_size + size > batch_bytes):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(path)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def read_file(path: str):
+    """
+    Reads a whole file with as few syscalls as possible
+
+    Returns
+    -------
+    data: bytes
+        content of the file
+    stat: os.stat_result
+        fstat of the opened file
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        stat = os.fstat(fd)
+        # one byte more than expected, so a file that grew since the fstat is noticed
+        data = os.read(fd, stat.st_size + 1)
+        if len(data) != stat.st_size:
+            parts = [data]
+            while True:
+                part = os.read(fd, _rest_size)
+                if not part:
+                    break
+                parts.append(part)
+            data = b"".join(parts)
+    finally:
+        os.close(fd)
+    return data, stat
+
+
+def _read_batch(paths: list, hash_func: str, keep_data: bool, process, limiter):
+    results = []
+    for path in paths:
+        if limiter is not None:
+            limiter.file_op()
+        data, stat = read_file(path)
+        if limiter is not None:
+            limiter.read(len(data))
+        results.append((data if keep_data else None, hash_functions.new_hash(hash_func, data).hexdigest(), stat,
+                        process(path, data) if process is not None else None))
+    return results
+
+
+def read_small_files(paths: list, sizes: list, hash_func: str = 'md5', keep_data: bool = True, process=None,
+                     workers: int = None, limiter=None):
+    """
+    Reads and hashes many small files in batches by a pool of reader threads
+
+    Parameters
+    ----------
+    paths: list
+        paths of the files
+    sizes: list
+        expected size of every file (from the scan), used to limit the bytes per batch
+    hash_func: str
+        method of hash algorithm
+    keep_data: bool
+        yield the content of the files, else only the hashes are built
+    process: callable
+        called with (path, content) of every file in the reader thread, its result is yielded as well
+    workers: int
+        batches read at the same time, read_workers if None
+    limiter: rate_limiter.RateLimiter
+        limits of the read bytes and the file operations, not limited if None
+
+    Yields
+    ------
+    data: bytes
+        content of the file, None if keep_data is False
+    hash: str
+        hexdigest of the content
+    stat: os.stat_result
+        fstat of the file at the time it was read
+    result:
+        result of process, None without process
+    """
+    workers = workers or read_workers
+    batches = iter(_split_batches(paths, sizes))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="small files") as executor:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(executor.submit(_read_batch, batch, hash_func, keep_data, process, limiter))
+            if len(pending) >= workers:
+                break
+        while pending:
+            results = pending.popleft().result()
+            batch = next(batches, None)
+            if batch is not None:
+                pending.append(executor.submit(_read_batch, batch, hash_func, keep_data, process, limiter))
+            yield from results
+
+
+def hash_small_files(paths: list, sizes: list, hash_func: str = 'md5', workers: int = None):
+    """
+    Returns the hexdigests of many small files in the order of paths, see read_small_files
+    """
+    return [hash for _, hash, _, _ in read_small_files(paths, sizes, hash_func=hash_func, keep_data=False,
+                                                    workers=workers)]
@@ -0,0 +1,251 @@
+"""
+Streaming of file content with bounded memory. All reads use large buffers from one shared pool, so the peak memory
+of all streams together is buffer_size * pool_buffers, no matter how big the files are. Big files are read by a
+reader thread while the calling thread hashes and writes the previous buffer (read-ahead with backpressure). For slow
+destinations the writes can be done by a writer thread as well (write-behind), then reading, hashing and writing of
+a file overlap.
+"""
+
+import os
+import queue
+import logging
+import threading
+
+import hash_functions
+
+logger = logging.getLogger()
+
+buffer_size = 8 * 1024 * 1024
+pool_buffers = 8
+pipeline_min_size = 64 * 1024 * 1024  # smaller files are read in the calling thread
+read_ahead_buffers = pool_buffers // 2
+write_behind_buffers = 0  # write in the calling thread, set > 0 for slow destinations
+progress_interval = 1024 * 1024 * 1024  # log progress of big files every GiB
+
+
+class BufferPool:
+    """
+    Fixed number of reusable bytearrays, created when they are needed the first time. get() blocks until a buffer is
+    free, which is the backpressure of the pipeline: a reader can not be more than the free buffers ahead of the
+    writer.
+    """
+
+    def __init__(self, num_buffers: int, size: int):
+        self.size = size
+        self.num_buffers = num_buffers
+        self.created = 0
+        self.lock = threading.Lock()
+        self.free = queue.Queue()
+
+    def get(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.num_buffers:
+                self.created += 1
+                return bytearray(self.size)
+        return self.free.get()
+
+    def put(self, buffer: bytearray):
+        self.free.put(buffer)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the shared buffer pool, created on first use with the current buffer_size and pool_buffers
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BufferPool(pool_buffers, buffer_size)
+        return _pool
+
+
+def _log_progress(path: str, done: int, total: int):
+    logger.debug(f"Streaming {path}: {done / 1e9:.1f} of {total / 1e9:.1f} GB done")
+
+
+def _read_sync(f, pool: BufferPool, limiter=None):
+    """
+    Yields (buffer, bytes read) of a file, read in the calling thread. The consumer gives the buffers back to the pool.
+    """
+    while True:
+        buffer = pool.get()
+        n = f.readinto(buffer)
+        if not n:
+            pool.put(buffer)
+            return
+        if limiter is not None:
+            limiter.read(n)
+        yield buffer, n
+
+
+def _read_ahead(f, pool: BufferPool, depth: int, name: str, limiter=None):
+    """
+    Yields (buffer, bytes read) of a file that is read by a reader thread up to depth buffers ahead of the consumer
+    """
+    filled = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            while not stop.is_set():
+                buffer = pool.get()
+                n = f.readinto(buffer)
+                if n and limiter is not None:
+                    limiter.read(n)
+                filled.put((buffer, n))
+                if not n:
+                    return
+        except BaseException as e:
+            errors.append(e)
+            filled.put((None, 0))
+
+    thread = threading.Thread(target=reader, name=f"reader {name}", daemon=True)
+    thread.start()
+    try:
+        while True:
+            buffer, n = filled.get()
+            if buffer is None:
+                raise errors[0]
+            if not n:
+                pool.put(buffer)
+                return
+            yield buffer, n
+    finally:
+        stop.set()
+        # give back buffers the reader already filled if the consumer stopped early
+        while thread.is_alive() or not filled.empty():
+            try:
+                buffer, n = filled.get(timeout=0.1)
+                if buffer is not None:
+                    pool.put(buffer)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+class WriteBehind:
+    """
+    Writes buffers in a writer thread, so the caller can read and hash the next buffer while a slow destination (e.g.
+    a network share) is still writing. At most depth buffers wait for the writer, put() blocks if the queue is full.
+    Written buffers go back to the pool. The first write error is raised by put() or close().
+    """
+
+    def __init__(self, write, pool: BufferPool, depth: int, name: str = ""):
+        self.write = write
+        self.pool = pool
+        self.pending = queue.Queue(maxsize=max(depth, 1))
+        self.errors = []
+        self.thread = threading.Thread(target=self._writer, name=f"writer {name}", daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            buffer, n = self.pending.get()
+            if buffer is None:
+                return
+            try:
+                if not self.errors:
+                    self.write(memoryview(buffer)[:n])
+            except BaseException as e:
+                self.errors.append(e)
+            finally:
+                self.pool.put(buffer)
+
+    def put(self, buffer: bytearray, n: int):
+        if self.errors:
+            self.pool.put(buffer)
+            raise self.errors[0]
+        self.pending.put((buffer, n))
+
+    def close(self):
+        """
+        Waits until all buffers are written
+        """
+        self.pending.put((None, 0))
+        self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def stream_file(path: str, write, hash_func: str = 'md5', progress=None, read_ahead: int = None,
+                write_behind: int = None, limiter=None):
+    """
+    Reads a file once and passes every block to write and to the hash. Files from pipeline_min_size on are read
+    ahead in a reader thread, so reading and compressing/writing overlap. With write_behind the blocks are written by
+    a writer thread, so reading/hashing and writing to a slow destination overlap for every file.
+
+    Parameters
+    ----------
+    path: str
+        path to file to be read
+    write: callable
+        called with a memoryview of every block, e.g. write method of a file or zip member
+    hash_func: str
+        method of hash algorithm
+    progress: callable
+        called with (path, bytes done, total bytes) every progress_interval bytes. Logs at debug level if None
+    read_ahead: int
+        number of buffers the reader thread may be ahead, read_ahead_buffers if None. 0 reads in the calling thread
+    write_behind: int
+        number of buffers that may wait for the writer thread, write_behind_buffers if None. 0 writes in the calling
+        thread
+    limiter: rate_limiter.RateLimiter
+        limits of the read and written bytes and the file operations, not limited if None
+
+    Returns
+    -------
+    hash: str
+        hexdigest of the file content
+    size: int
+        number of bytes read
+    """
+    pool = get_pool()
+    hash = hash_functions.new_hash(hash_func)
+    progress = progress or _log_progress
+    read_ahead = read_ahead_buffers if read_ahead is None else read_ahead
+    write_behind = write_behind_buffers if write_behind is None else write_behind
+    total = os.path.getsize(path)
+    done = 0
+    next_progress = progress_interval
+    name = os.path.basename(path)
+    if limiter is not None:
+        limiter.file_op()
+        write = limiter.limit_write(write)
+
+    with open(path, "rb", buffering=0) as f:
+        if total >= pipeline_min_size and read_ahead > 0:
+            blocks = _read_ahead(f, pool, read_ahead, name, limiter=limiter)
+        else:
+            blocks = _read_sync(f, pool, limiter=limiter)
+        writer = WriteBehind(write, pool, write_behind, name) if write_behind > 0 else None
+        try:
+            for buffer, n in blocks:
+                hash.update(memoryview(buffer)[:n])
+                if writer is not None:
+                    # the writer gives the buffer back to the pool
+                    writer.put(buffer, n)
+                else:
+                    try:
+                        write(memoryview(buffer)[:n])
+                    finally:
+                        pool.put(buffer)
+                done += n
+                if done >= next_progress:
+                    progress(path, done, total)
+                    next_progress += progress_interval
+        finally:
+            blocks.close()
+            if writer is not None:
+                writer.close()
+
+    return hash.hexdigest(), done
+
@@ -0,0 +1,44 @@
+"""
+Shared fixtures of the tests. The modules of the backup tool are top-level scripts, the repository root is added to
+the import path.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    """
+    Small source folder with top-level files and folders, compressible and random content
+    """
+    src = tmp_path / "src"
+    write_file(str(src / "top.txt"), b"top level file\n" * 100)
+    write_file(str(src / "docs" / "a.txt"), b"alpha " * 5000)
+    write_file(str(src / "docs" / "sub" / "b.bin"), os.urandom(200 * 1024))
+    write_file(str(src / "docs" / "empty.txt"), b"")
+    write_file(str(src / "code" / "main.py"), b"print('hello')\n" * 50)
+    return str(src)
+
+
+def read_tree(path: str):
+    """
+    Returns the content of every file below path by relative path
+    """
+    tree = {}
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            with open(file_path, "rb") as f:
+                tree[os.path.relpath(file_path, path)] = f.read()
+    return tree
@@ -0,0 +1,127 @@
+"""
+Retention policies and pruning of backup_catalog
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+import backup_tool
+import backup_catalog
+from conftest import write_file
+
+
+def get_catalog(days: list, now: datetime, references: dict = None):
+    backups = {}
+    for day in days:
+        folder = f"backup_{day:03d}"
+        entry = backup_catalog.new_entry(folder, status="complete")
+        entry["start_time"] = (now - timedelta(days=day)).strftime(backup_catalog.time_format)
+        entry["references"] = (references or {}).get(folder, [])
+        backups[folder] = entry
+    return {"backups": backups}
+
+
+def test_keep_last_and_daily():
+    now = datetime(2026, 10, 18, 20, 0)
+    catalog = get_catalog(range(1, 11), now)
+
+    to_delete = backup_catalog.select_backups_to_delete(catalog, retention={"keep_last": 3}, now=now)
+    # the new backup counts as the newest one
+    assert sorted(to_delete) == [f"backup_{day:03d}" for day in range(3, 11)]
+
+    to_delete = backup_catalog.select_backups_to_delete(catalog, retention={"keep_last": 1, "keep_daily": 5},
+                                                        now=now)
+    assert sorted(to_delete) == [f"backup_{day:03d}" for day in range(5, 11)]
+
+
+def test_referenced_backups_are_kept():
+    now = datetime(2026, 10, 18, 20, 0)
+    catalog = get_catalog(range(1, 11), now, references={"backup_001": ["backup_009"]})
+    catalog["backups"]["backup_012"] = backup_catalog.new_entry("backup_012", status="incomplete")
+    catalog["backups"]["backup_012"]["start_time"] = (now - timedelta(days=12)).strftime(backup_catalog.time_format)
+
+    to_delete = backup_catalog.select_backups_to_delete(catalog, retention={"keep_last": 2}, now=now)
+
+    assert "backup_009" not in to_delete
+    assert "backup_001" not in to_delete
+    assert "backup_002" in to_delete
+    assert "backup_012" in to_delete
+
+
+def test_pruning_keeps_the_data_of_incremental_backups(tmp_path, source_tree):
+    backup_path = str(tmp_path / "backups")
+    info_dict = None
+    for day in range(1, 4):
+        dst = os.path.join(backup_path, f"2026_10_0{day}_backup_idx_0")
+        os.makedirs(dst)
+        if day > 1:
+            write_file(os.path.join(source_tree, "code", "main.py"), b"version %d\n" % day)
+        info_dict = backup_tool.perform_backup(src=source_tree, dst=dst, strategy="incremental",
+                                               reference_dict=info_dict)
+
+    backup_tool.analyze_existing_backups(backup_path, max_num_backups=2, background=False)
+
+    # the second backup only held "code", which changed again. The first one holds the unchanged items.
+    assert sorted(entry for entry in os.listdir(backup_path) if "backup_idx" in entry) == \
+        ["2026_10_01_backup_idx_0", "2026_10_03_backup_idx_0"]
+    catalog = backup_catalog.load_catalog(backup_path)
+    assert sorted(catalog["backups"]) == ["2026_10_01_backup_idx_0", "2026_10_03_backup_idx_0"]
+    latest = os.path.join(backup_path, "2026_10_03_backup_idx_0")
+    assert set(backup_tool.verify_backup(latest).values()) == {"ok"}
+
+
+def make_backups(backup_path: str, folders: list):
+    for folder in folders:
+        write_file(os.path.join(backup_path, folder, "data.txt"), b"data")
+        backup_catalog.update_entry(backup_path, folder, backup_catalog.new_entry(folder, status="complete"))
+
+
+def test_failed_deletion_is_logged_and_retried(tmp_path, monkeypatch, caplog):
+    backup_path = str(tmp_path / "backups")
+    make_backups(backup_path, ["backup_1", "backup_2"])
+    delete_tree = backup_catalog._delete_tree
+
+    def failing_delete_tree(path, *args, **kwargs):
+        if path.endswith("backup_1"):
+            raise PermissionError("busy")
+        delete_tree(path, *args, **kwargs)
+
+    monkeypatch.setattr(backup_catalog, "_delete_tree", failing_delete_tree)
+    backup_catalog.delete_backups(backup_path, ["backup_1", "backup_2"])
+    result = backup_catalog.wait_for_pruning(backup_path)
+
+    assert result == {"deleted": ["backup_2"], "failed": ["backup_1"]}
+    assert "Could not delete backup folder backup_1" in caplog.text
+    assert backup_catalog.load_catalog(backup_path)["backups"]["backup_1"]["status"] == "delete_failed"
+
+    # the next run deletes the leftover
+    monkeypatch.setattr(backup_catalog, "_delete_tree", delete_tree)
+    job = backup_catalog.delete_backups(backup_path, [], background=False)
+    assert job["deleted"] == ["backup_1"]
+    assert os.listdir(backup_path) == [backup_catalog.catalog_filename]
+    assert backup_catalog.load_catalog(backup_path)["backups"] == {}
+
+
+def test_running_deletion_is_not_taken_as_leftover(tmp_path, monkeypatch):
+    backup_path = str(tmp_path / "backups")
+    make_backups(backup_path, ["backup_1", "backup_2"])
+    delete_tree = backup_catalog._delete_tree
+    release = threading.Event()
+    deleted_paths = []
+
+    def slow_delete_tree(path, *args, **kwargs):
+        release.wait(10)
+        deleted_paths.append(path)
+        delete_tree(path, *args, **kwargs)
+
+    monkeypatch.setattr(backup_catalog, "_delete_tree", slow_delete_tree)
+    first = backup_catalog.delete_backups(backup_path, ["backup_1"])
+    second = backup_catalog.delete_backups(backup_path, ["backup_2"])
+    release.set()
+    result = backup_catalog.wait_for_pruning(backup_path)
+
+    assert first["folders"] == ["backup_1"]
+    assert second["folders"] == ["backup_2"]
+    assert sorted(result["deleted"]) == ["backup_1", "backup_2"] and result["failed"] == []
+    assert len(deleted_paths) == 2
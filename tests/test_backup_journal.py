@@ -0,0 +1,72 @@
+"""
+Resume of interrupted backups and outputs of items with similar names (see backup_journal)
+"""
+
+import os
+
+import pytest
+
+import backup_tool
+import backup_journal
+from conftest import write_file
+
+
+@pytest.mark.parametrize("compression", ["SINGLE_PASS", "SINGLE_PASS_COPY", "gz", "CHUNK_STORE"])
+def test_sibling_outputs_are_kept(tmp_path, compression):
+    src, dst = str(tmp_path / "src"), str(tmp_path / "backups" / "b1")
+    write_file(os.path.join(src, "a", "f.txt"), b"folder a\n")
+    write_file(os.path.join(src, "a.zip"), b"file a.zip\n")
+    write_file(os.path.join(src, "a.tar.gz"), b"file a.tar.gz\n")
+    os.makedirs(dst)
+
+    backup_tool.perform_backup(src=src, dst=dst, compression=compression, max_workers=3)
+
+    results = backup_tool.verify_backup(dst)
+    assert results == {"a": "ok", "a.zip": "ok", "a.tar.gz": "ok"}
+    restored = str(tmp_path / "restored")
+    backup_tool.restore_backup(dst, restored)
+    with open(os.path.join(restored, "a.zip"), "rb") as f:
+        assert f.read() == b"file a.zip\n"
+    with open(os.path.join(restored, "a", "f.txt"), "rb") as f:
+        assert f.read() == b"folder a\n"
+
+
+def test_commit_output_only_touches_its_path(tmp_path):
+    dst = str(tmp_path)
+    write_file(os.path.join(dst, ".partial_a.zip"), b"in progress output of item a.zip")
+    write_file(os.path.join(dst, ".partial_a"), b"output of item a")
+
+    committed = backup_journal.commit_output(backup_journal.get_partial_path(dst, "a"), os.path.join(dst, "a"))
+
+    assert committed == "a"
+    assert sorted(os.listdir(dst)) == [".partial_a.zip", "a"]
+
+
+def test_resume_after_interruption(tmp_path, source_tree, monkeypatch):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+    backup_item = backup_tool.backup_item_from_src_to_dst
+    done = []
+
+    def crash_on_code(**kwargs):
+        if kwargs["item"] == "code":
+            raise KeyboardInterrupt("simulated crash")
+        done.append(kwargs["item"])
+        return backup_item(**kwargs)
+
+    monkeypatch.setattr(backup_tool, "backup_item_from_src_to_dst", crash_on_code)
+    with pytest.raises(KeyboardInterrupt):
+        backup_tool.perform_backup(src=source_tree, dst=dst, compression="SINGLE_PASS")
+    assert backup_journal.has_journal(dst)
+    finished = set(done)
+    assert finished
+
+    done.clear()
+    monkeypatch.setattr(backup_tool, "backup_item_from_src_to_dst",
+                        lambda **kwargs: done.append(kwargs["item"]) or backup_item(**kwargs))
+    backup_tool.perform_backup(src=source_tree, dst=dst, compression="SINGLE_PASS")
+
+    assert "code" in done
+    assert not finished.intersection(done)
+    assert not backup_journal.has_journal(dst)
+    assert set(backup_tool.verify_backup(dst).values()) == {"ok"}
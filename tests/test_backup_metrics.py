@@ -0,0 +1,74 @@
+"""
+Phase timings and throughput of backup_metrics in the info dict and the exports
+"""
+
+import os
+import json
+
+import backup_tool
+import backup_metrics
+
+
+def test_totals_from_items():
+    metrics = backup_metrics.new_metrics()
+    backup_metrics.record_item(metrics, item="a", phase="copy", bytes_read=4_000_000, bytes_written=4_000_000,
+                               seconds=1.0)
+    backup_metrics.record_item(metrics, item="b", phase="compress", bytes_read=6_000_000, bytes_written=2_000_000,
+                               seconds=3.0)
+    backup_metrics.record_files(metrics, 50)
+
+    totals = backup_metrics.finalize_metrics(metrics, seconds=5.0)["totals"]
+
+    assert totals["bytes_read"] == 10_000_000
+    assert totals["bytes_written"] == 6_000_000
+    assert totals["mb_per_s"] == 2.0
+    assert totals["files_per_s"] == 10.0
+    assert totals["compression_ratio"] == round(10 / 6, 3)
+    assert totals["bottleneck_phase"] == "compress"
+    assert metrics["items"]["b"]["compression_ratio"] == 3.0
+    assert "phase_intervals" not in metrics
+
+
+def test_bottleneck_by_wall_clock_time(monkeypatch):
+    now = [10.0]
+    monkeypatch.setattr(backup_metrics.time, "perf_counter", lambda: now[0])
+    metrics = backup_metrics.new_metrics()
+    # two items copied in parallel threads from 8 s to 10 s, one item compressed from 10 s to 13 s
+    backup_metrics.record_item(metrics, item="a", phase="copy", bytes_read=1, bytes_written=1, seconds=2.0)
+    backup_metrics.record_item(metrics, item="b", phase="copy", bytes_read=1, bytes_written=1, seconds=2.0)
+    now[0] = 13.0
+    backup_metrics.record_item(metrics, item="c", phase="compress", bytes_read=1, bytes_written=1, seconds=3.0)
+
+    metrics = backup_metrics.finalize_metrics(metrics, seconds=5.0)
+
+    assert metrics["phases_in_s"]["copy"] == 4.0
+    assert metrics["phases_wall_s"]["copy"] == 2.0
+    assert metrics["phases_wall_s"]["compress"] == 3.0
+    assert metrics["totals"]["bottleneck_phase"] == "compress"
+
+
+def test_metrics_of_a_backup(tmp_path, source_tree):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+    prometheus, jsonl = str(tmp_path / "backup.prom"), str(tmp_path / "metrics.jsonl")
+
+    info_dict = backup_tool.perform_backup(src=source_tree, dst=dst, metrics_prometheus=prometheus,
+                                           metrics_jsonl=jsonl)
+
+    metrics = info_dict["metrics"]
+    assert set(metrics["items"]) == {"top.txt", "docs", "code"}
+    assert metrics["totals"]["bytes_read"] == sum(
+        os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(source_tree) for file in files)
+    assert metrics["totals"]["files_read"] == 5
+    assert metrics["phases_in_s"]["scan"] > 0
+    with open(prometheus) as f:
+        samples = [line for line in f.read().splitlines() if not line.startswith("#")]
+    assert any(line.startswith("backup_tool_read_bytes{") for line in samples)
+    with open(jsonl) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 1
+    assert lines[0]["source_path"] == source_tree
+    # the info file and the exports hold the same metrics
+    with open(os.path.join(dst, info_dict["info_file"])) as f:
+        assert json.load(f)["metrics"] == lines[0]["metrics"] == metrics
+    assert any(line.startswith("backup_tool_phase_wall_seconds{") for line in samples)
@@ -0,0 +1,99 @@
+"""
+Dry-run plans of backup_planner: learned throughput, estimates, backup windows and the order of the rows
+"""
+
+import os
+from datetime import datetime
+
+import pytest
+
+import backup_tool
+import backup_planner
+
+
+def get_history(seconds: float, bytes_read: int, bytes_written: int, files_read: int, scan_s: float):
+    return {"phases_in_s": {"scan": scan_s}, "totals": {"seconds": seconds, "bytes_read": bytes_read,
+                                                         "bytes_written": bytes_written, "files_read": files_read}}
+
+
+def test_throughput_and_estimate():
+    history = [get_history(11.0, 100_000_000, 50_000_000, 1000, 1.0),
+               get_history(23.0, 200_000_000, 100_000_000, 2000, 3.0)]
+
+    throughput = backup_planner.get_throughput(history)
+
+    assert throughput["mb_per_s"] == 10.0
+    assert throughput["files_per_s"] == 100.0
+    assert throughput["overhead_s"] == 2.0
+    assert throughput["compression_ratio"] == 2.0
+    assert throughput["source"] == "history"
+    assert backup_planner.estimate(50_000_000, 10, throughput) == {
+        "seconds": 7.0, "expected_output_bytes": 25_000_000, "limited_by": "bytes"}
+    assert backup_planner.estimate(1_000_000, 1000, throughput)["limited_by"] == "files"
+    assert backup_planner.estimate(50_000_000, 10, throughput, max_read_bytes_per_s=1e6) == {
+        "seconds": 52.0, "expected_output_bytes": 25_000_000, "limited_by": "rate_limit"}
+    assert backup_planner.get_throughput([])["source"] == "default"
+
+
+@pytest.mark.parametrize("window, now, expected", [
+    # the window wraps midnight and is open since yesterday
+    ("22:00-06:00", datetime(2026, 10, 18, 2, 0), (datetime(2026, 10, 18, 2, 0), datetime(2026, 10, 18, 6, 0))),
+    ("22:00-06:00", datetime(2026, 10, 18, 12, 0), (datetime(2026, 10, 18, 22, 0), datetime(2026, 10, 19, 6, 0))),
+    ("22:00-06:00", datetime(2026, 10, 18, 23, 0), (datetime(2026, 10, 18, 23, 0), datetime(2026, 10, 19, 6, 0))),
+    ("01:00-05:00", datetime(2026, 10, 18, 7, 0), (datetime(2026, 10, 19, 1, 0), datetime(2026, 10, 19, 5, 0))),
+])
+def test_parse_window(window, now, expected):
+    assert backup_planner.parse_window(window, now=now) == expected
+
+
+def test_rows_of_a_destination_form_a_chain():
+    plans = [{"index": 0, "destination": "/backups/a", "seconds": 600},
+             {"index": 1, "destination": "/backups/b", "seconds": 3000},
+             {"index": 2, "destination": "/backups/a/", "seconds": 600},
+             {"index": 3, "destination": "/backups/c", "seconds": 100}]
+
+    ordered = backup_planner.schedule_rows(plans, start=datetime(2026, 10, 18, 22, 0), workers=2,
+                                           end=datetime(2026, 10, 18, 22, 30))
+
+    assert [(plan["index"], plan["start"], plan["fits"]) for plan in ordered] == [
+        (1, "20261018_220000", False), (0, "20261018_220000", True), (2, "20261018_221000", True),
+        (3, "20261018_222000", True)]
+
+
+def test_plan_writes_nothing_and_learns_from_backups(tmp_path, source_tree):
+    destination = str(tmp_path / "backups")
+    row = {"activate": True, "source": source_tree, "destination": destination, "strategy": "incremental",
+           "shutdown": False}
+    bytes_of_source = sum(os.path.getsize(os.path.join(root, file))
+                          for root, _, files in os.walk(source_tree) for file in files)
+
+    plan = backup_tool.plan_backup_instruction(0, row)
+
+    assert not os.path.exists(destination)
+    assert (plan["items"], plan["changed_items"], plan["files_to_read"]) == (3, 3, 5)
+    assert plan["bytes_to_read"] == bytes_of_source
+    assert plan["strategy"] == "full"
+    assert plan["throughput"]["source"] == "default"
+
+    backup_tool.run_backup_instruction(0, row)
+    entries = sorted(os.listdir(destination))
+    plan = backup_tool.plan_backup_instruction(0, row)
+
+    assert sorted(os.listdir(destination)) == entries
+    assert (plan["changed_items"], plan["bytes_to_read"], plan["strategy"]) == (0, 0, "incremental")
+    assert plan["throughput"]["source"] == "history"
+    assert backup_tool.plan_backup_instruction(0, dict(row, activate=False)) is None
+
+
+def test_plan_output_says_the_window_is_not_enforced(capsys):
+    plans = [{"index": 0, "changed_items": 1, "items": 2, "bytes_to_read": 1e6, "files_to_read": 3,
+              "expected_output_bytes": 5e5, "seconds": 7200, "start": "20261018_220000", "eta": "20261019_000000",
+              "fits": False, "source": "/data", "destination": "/backups/a"}]
+
+    backup_tool.print_plans(plans, window="22:00-23:00")
+
+    output = capsys.readouterr().out
+    assert "Rows [0] are expected to end after the backup window" in output
+    assert "only orders the rows" in output
+    backup_tool.print_plans(plans)
+    assert "only orders the rows" not in capsys.readouterr().out
@@ -0,0 +1,62 @@
+"""
+Backup, verify and restore of every compression method (see verify_backup and restore_backup of backup_tool)
+"""
+
+import os
+import zipfile
+
+import pytest
+
+import backup_tool
+import parallel_compression
+from conftest import read_tree
+
+# methods of the compression column of the backup instructions and the plain copy
+compressions = [None] + [compression for compression in backup_tool.compression_methods.values()
+                         if compression not in parallel_compression.codecs
+                         or compression in parallel_compression.get_available_codecs()]
+
+
+@pytest.mark.parametrize("compression", compressions)
+def test_backup_verify_restore(tmp_path, source_tree, compression):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+
+    info_dict = backup_tool.perform_backup(src=source_tree, dst=dst, compression=compression, max_workers=2)
+
+    assert {item["folder_name"] for item in info_dict["found_folders"]} == {"docs", "code"}
+    assert {item["file_name"] for item in info_dict["found_files"]} == {"top.txt"}
+    assert backup_tool.verify_backup(dst) == {"top.txt": "ok", "docs": "ok", "code": "ok"}
+    restored = str(tmp_path / "restored")
+    assert sorted(backup_tool.restore_backup(dst, restored)) == ["code", "docs", "top.txt"]
+    assert read_tree(restored) == read_tree(source_tree)
+
+
+@pytest.mark.parametrize("compression", ["SINGLE_PASS", "SINGLE_PASS_COPY"])
+def test_verify_finds_changed_data(tmp_path, source_tree, compression):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+    backup_tool.perform_backup(src=source_tree, dst=dst, compression=compression)
+
+    os.remove(os.path.join(dst, "top.txt"))
+    if compression == "SINGLE_PASS_COPY":
+        with open(os.path.join(dst, "docs", "a.txt"), "ab") as f:
+            f.write(b"bit rot")
+    else:
+        with zipfile.ZipFile(os.path.join(dst, "docs.zip"), "a") as zip_file, \
+                pytest.warns(UserWarning, match="Duplicate name"):
+            zip_file.writestr("a.txt", b"other content")
+
+    results = backup_tool.verify_backup(dst)
+    assert results["top.txt"] == "missing"
+    assert results["docs"] != "ok"
+    assert results["code"] == "ok"
+
+
+def test_restore_does_not_overwrite(tmp_path, source_tree):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+    backup_tool.perform_backup(src=source_tree, dst=dst)
+
+    with pytest.raises(FileExistsError):
+        backup_tool.restore_backup(dst, source_tree, items=["code"])
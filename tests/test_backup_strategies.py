@@ -0,0 +1,54 @@
+"""
+Incremental and differential backups that reference the unchanged items of earlier backups
+"""
+
+import os
+
+import backup_tool
+from conftest import write_file, read_tree
+
+
+def get_references(info_dict: dict):
+    return {item_info[f"{prefix}_name"]: item_info.get(f"{prefix}_backup_reference")
+            for prefix in ["file", "folder"] for item_info in info_dict[f"found_{prefix}s"]}
+
+
+def do_backup(backup_path: str, name: str, source: str, strategy: str, latest_info_dict: dict):
+    dst = os.path.join(backup_path, name)
+    os.makedirs(dst)
+    reference_dict = backup_tool.get_reference_info_dict(backup_path, latest_info_dict, strategy)
+    return backup_tool.perform_backup(src=source, dst=dst, strategy=strategy, reference_dict=reference_dict)
+
+
+def test_incremental_and_differential(tmp_path, source_tree):
+    backup_path = str(tmp_path / "backups")
+    info_1 = do_backup(backup_path, "b1", source_tree, "full", None)
+    write_file(os.path.join(source_tree, "code", "main.py"), b"changed in b2\n")
+    info_2 = do_backup(backup_path, "b2", source_tree, "incremental", info_1)
+    write_file(os.path.join(source_tree, "top.txt"), b"changed in b3\n")
+    info_3 = do_backup(backup_path, "b3", source_tree, "differential", info_2)
+
+    assert get_references(info_2) == {"top.txt": "b1", "docs": "b1", "code": None}
+    assert sorted(entry for entry in os.listdir(os.path.join(backup_path, "b2")) if "information" not in entry
+                  and not entry.endswith(".btm")) == ["code.zip"]
+    # differential backups compare with the latest full backup, code changed since b1 as well
+    assert info_3["strategy"] == "differential"
+    assert info_3["reference_backup"] == "b1"
+    assert get_references(info_3) == {"top.txt": None, "docs": "b1", "code": None}
+
+    for name in ["b1", "b2", "b3"]:
+        assert set(backup_tool.verify_backup(os.path.join(backup_path, name)).values()) == {"ok"}
+    restored = str(tmp_path / "restored")
+    backup_tool.restore_backup(os.path.join(backup_path, "b3"), restored)
+    assert read_tree(restored) == read_tree(source_tree)
+
+
+def test_deleted_reference_is_backuped_again(tmp_path, source_tree):
+    backup_path = str(tmp_path / "backups")
+    info_1 = do_backup(backup_path, "b1", source_tree, "full", None)
+    os.rename(os.path.join(backup_path, "b1"), os.path.join(backup_path, "moved"))
+
+    info_2 = do_backup(backup_path, "b2", source_tree, "incremental", info_1)
+
+    assert set(get_references(info_2).values()) == {None}
+    assert set(backup_tool.verify_backup(os.path.join(backup_path, "b2")).values()) == {"ok"}
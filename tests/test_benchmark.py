@@ -0,0 +1,34 @@
+"""
+Synthetic trees and stage timings of benchmark_backup_tool
+"""
+
+import os
+
+import pytest
+
+import benchmark_backup_tool
+from conftest import read_tree
+
+
+@pytest.mark.parametrize("profile", sorted(benchmark_backup_tool.profiles))
+def test_trees_are_reproducible(tmp_path, profile):
+    stats = benchmark_backup_tool.generate_tree(str(tmp_path / "a"), profile, seed=5, scale=0.01)
+    benchmark_backup_tool.generate_tree(str(tmp_path / "b"), profile, seed=5, scale=0.01)
+    benchmark_backup_tool.generate_tree(str(tmp_path / "c"), profile, seed=6, scale=0.01)
+
+    tree = read_tree(str(tmp_path / "a"))
+    assert tree == read_tree(str(tmp_path / "b"))
+    assert tree != read_tree(str(tmp_path / "c"))
+    assert stats == {"num_files": len(tree), "num_bytes": sum(len(data) for data in tree.values())}
+
+
+def test_profile_times_every_stage(tmp_path):
+    result = benchmark_backup_tool.benchmark_profile(str(tmp_path), "deep_nesting", repeat=1, scale=0.05, seed=1)
+
+    timings = result["timings"]
+    for method in benchmark_backup_tool.compression_methods:
+        assert timings[f"compression_{method}"]["files_per_s"] > 0
+        assert timings[f"compression_{method}"]["output_bytes"] > 0
+    assert {"perform_backup", "scan_item", "hash_md5"} <= set(timings)
+    # the work folder of the profile is removed
+    assert not os.path.exists(str(tmp_path / "deep_nesting"))
@@ -0,0 +1,123 @@
+"""
+Dirty journal of change_watcher with the polling and the inotify watcher
+"""
+
+import os
+import time
+import threading
+
+import pytest
+
+import backup_tool
+import backup_catalog
+import change_watcher
+from conftest import write_file, read_tree
+
+has_inotify = hasattr(os, "uname") and os.uname().sysname == "Linux"
+
+
+def wait_for(condition, timeout: float = 10.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise TimeoutError("condition not reached")
+        time.sleep(0.05)
+
+
+def test_journal_starts_after_the_startup_scan(tmp_path, source_tree, monkeypatch):
+    journal = change_watcher.DirtyJournal(str(tmp_path / "watch.json"), source_tree, interval=1)
+    scan = change_watcher.PollingWatcher._scan
+    scan_done = []
+
+    def slow_scan(self):
+        time.sleep(0.1)
+        signatures = scan(self)
+        scan_done.append(time.time())
+        return signatures
+
+    monkeypatch.setattr(change_watcher.PollingWatcher, "_scan", slow_scan)
+    change_watcher.PollingWatcher(source_tree, journal, interval=1)
+
+    assert journal.state["since"] >= scan_done[0]
+
+
+@pytest.mark.skipif(not has_inotify, reason="inotify only on Linux")
+def test_inotify_journal_starts_after_the_watches(tmp_path, source_tree, monkeypatch):
+    journal = change_watcher.DirtyJournal(str(tmp_path / "watch.json"), source_tree, interval=1)
+    add_tree = change_watcher.InotifyWatcher._add_tree
+    tree_done = []
+
+    def slow_add_tree(self, rel_dir):
+        time.sleep(0.1)
+        add_tree(self, rel_dir)
+        tree_done.append(time.time())
+
+    monkeypatch.setattr(change_watcher.InotifyWatcher, "_add_tree", slow_add_tree)
+    watcher = change_watcher.InotifyWatcher(source_tree, journal)
+    os.close(watcher.fd)
+
+    assert journal.state["since"] >= tree_done[0]
+
+
+@pytest.fixture(params=["polling", "inotify"] if has_inotify else ["polling"])
+def running_watcher(request, tmp_path, source_tree):
+    """
+    Watcher of source_tree in a thread, the polling watcher only scans every minute unless a backup asks it to sync
+    """
+    destination = str(tmp_path / "backups")
+    journal_path = change_watcher.get_journal_path(destination, source_tree)
+    stop = threading.Event()
+    thread = threading.Thread(target=change_watcher.watch, args=(source_tree, destination, stop),
+                              kwargs={"polling": request.param == "polling", "interval": 60})
+    thread.start()
+    try:
+        wait_for(lambda: os.path.isfile(journal_path))
+        yield destination, stop, thread
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_changed_items_are_recorded(source_tree, running_watcher):
+    destination, _, _ = running_watcher
+    since = time.time()
+    time.sleep(0.05)
+
+    assert change_watcher.get_dirty_items(destination, source_tree, since=since) == set()
+    write_file(os.path.join(source_tree, "docs", "sub", "new.txt"), b"new file")
+    # right after the change, long before the next flush or scan of the watcher
+    assert change_watcher.get_dirty_items(destination, source_tree, since=since) == {"docs"}
+    # the journal does not cover backups that started before the watcher
+    assert change_watcher.get_dirty_items(destination, source_tree, since=since - 3600) is None
+
+
+def test_stopped_watcher_does_not_answer(source_tree, running_watcher, monkeypatch):
+    destination, stop, thread = running_watcher
+    since = time.time()
+    stop.set()
+    thread.join()
+    write_file(os.path.join(source_tree, "top.txt"), b"changed")
+    monkeypatch.setattr(change_watcher, "sync_timeout", 0.5)
+
+    # the heartbeat is fresh, but nobody records the change
+    assert change_watcher.get_dirty_items(destination, source_tree, since=since) is None
+    assert change_watcher.get_dirty_items(destination, source_tree, since=since, sync=False) == set()
+
+
+def test_backup_right_after_a_change(tmp_path, source_tree, running_watcher):
+    destination, _, _ = running_watcher
+    row = {"activate": True, "source": source_tree, "destination": destination, "strategy": "incremental",
+           "shutdown": False}
+    # the start time of the reference backup is cut to full seconds, the journal has to start before it
+    time.sleep(1.1)
+    backup_tool.run_backup_instruction(0, row)
+
+    write_file(os.path.join(source_tree, "code", "main.py"), b"changed right before the backup\n")
+    backup_tool.run_backup_instruction(1, row)
+
+    latest = os.path.join(destination, backup_catalog.get_latest_backup(
+        backup_catalog.load_catalog(destination))["folder"])
+    restored = str(tmp_path / "restored")
+    backup_tool.restore_backup(latest, restored)
+    assert read_tree(restored) == read_tree(source_tree)
+
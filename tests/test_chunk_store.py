@@ -0,0 +1,93 @@
+"""
+Content-defined chunking and the deduplicated chunk store of chunk_store
+"""
+
+import os
+import random
+import shutil
+
+import pytest
+
+import backup_tool
+import backup_catalog
+import chunk_store
+from conftest import write_file
+
+
+def get_chunks(data: bytes):
+    ends, rest = chunk_store._split_chunks(data, final=True)
+    assert rest == b""
+    return [data[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+def test_chunks_survive_an_insertion():
+    data = random.Random(1).randbytes(12 * 1024 * 1024)
+    chunks = get_chunks(data)
+    shifted_chunks = get_chunks(b"inserted bytes" + data)
+
+    assert b"".join(chunks) == data
+    assert all(chunk_store.min_chunk_size <= len(chunk) <= chunk_store.max_chunk_size for chunk in chunks[:-1])
+    # only the chunks around the insertion change
+    assert len(set(chunks) - set(shifted_chunks)) <= 2
+
+
+def test_chunks_need_numpy(tmp_path, source_tree, monkeypatch):
+    monkeypatch.setattr(chunk_store, "np", False)
+    with pytest.raises(ImportError, match="numpy"):
+        chunk_store._split_chunks(b"data", final=True)
+
+    destination = str(tmp_path / "backups")
+    row = {"activate": True, "source": source_tree, "destination": destination, "strategy": "full",
+           "compression": "chunks", "shutdown": False}
+    backup_tool.run_backup_instruction(0, row)
+    # refused before anything is written to the destination
+    assert not os.path.exists(destination)
+
+
+def test_backups_share_chunks(tmp_path, source_tree):
+    write_file(os.path.join(source_tree, "docs", "big.bin"), random.Random(3).randbytes(4 * 1024 * 1024))
+    backup_path = tmp_path / "backups"
+    dst_1, dst_2 = str(backup_path / "b1"), str(backup_path / "b2")
+    os.makedirs(dst_1)
+    os.makedirs(dst_2)
+
+    info_1 = backup_tool.perform_backup(src=source_tree, dst=dst_1, compression="CHUNK_STORE")
+    info_2 = backup_tool.perform_backup(src=source_tree, dst=dst_2, compression="CHUNK_STORE")
+
+    # the second full backup only writes its manifests, all chunks are in the store already
+    written_1, written_2 = info_1["metrics"]["totals"]["bytes_written"], info_2["metrics"]["totals"]["bytes_written"]
+    assert written_2 < written_1 / 100
+    assert set(backup_tool.verify_backup(dst_2).values()) == {"ok"}
+
+    shutil.rmtree(dst_1)
+    assert chunk_store.collect_garbage(str(backup_path)) == 0
+    restored = str(tmp_path / "restored")
+    backup_tool.restore_backup(dst_2, restored)
+    with open(os.path.join(restored, "docs", "big.bin"), "rb") as f:
+        assert f.read() == random.Random(3).randbytes(4 * 1024 * 1024)
+
+    shutil.rmtree(dst_2)
+    assert chunk_store.collect_garbage(str(backup_path)) > 0
+    assert not any(files for _, _, files in os.walk(os.path.join(str(backup_path), chunk_store.chunk_store_foldername)))
+
+
+@pytest.mark.parametrize("compression, old_backup, collected", [
+    ("chunks", True, True), ("chunks", False, False), ("zip", True, False)])
+def test_garbage_is_collected_after_deletions(tmp_path, source_tree, monkeypatch, compression, old_backup,
+                                              collected):
+    destination = str(tmp_path / "backups")
+    if old_backup:
+        write_file(os.path.join(destination, "2026_01_01_backup_idx_0", "data.txt"), b"data")
+        entry = backup_catalog.new_entry("2026_01_01_backup_idx_0", status="complete")
+        entry["start_time"] = "20260101_000000"
+        backup_catalog.update_entry(destination, "2026_01_01_backup_idx_0", entry)
+    calls = []
+    monkeypatch.setattr(chunk_store, "collect_garbage", lambda backup_path: calls.append(backup_path))
+    row = {"activate": True, "source": source_tree, "destination": destination, "strategy": "full",
+           "compression": compression, "keep_last": 1, "shutdown": False}
+
+    backup_tool.run_backup_instruction(0, row)
+
+    assert not os.path.exists(os.path.join(destination, "2026_01_01_backup_idx_0"))
+    assert calls == ([destination] if collected else [])
+
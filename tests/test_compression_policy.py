@@ -0,0 +1,55 @@
+"""
+Per-file decisions of compression_policy and the zip members of adaptive backups
+"""
+
+import os
+import zipfile
+
+import pytest
+
+import backup_tool
+import compression_policy
+from conftest import write_file
+
+
+@pytest.mark.parametrize("name, data, expected", [
+    ("photo.JPG", b"text " * 10000, (False, 0, "extension")),
+    ("tiny.bin", os.urandom(100), (True, 6, "small")),
+    ("random.bin", os.urandom(100_000), (False, 0, "incompressible")),
+    ("text.txt", b"the same text " * 10000, (True, 6, "compressible")),
+])
+def test_decide(tmp_path, name, data, expected):
+    path = str(tmp_path / name)
+    write_file(path, data)
+
+    assert compression_policy.decide(path, len(data), level=6) == expected
+    # a given sample gives the same decision without reading the file
+    assert compression_policy.decide(str(tmp_path / f"missing_{name}"), len(data), level=6, sample=data) == expected
+
+
+def test_low_ratio_uses_fast_level():
+    # mostly random bytes with a repeated block and zeros compress to about 0.86 of the size
+    sample = os.urandom(24 * 1024) + os.urandom(4 * 1024) * 2 + b"\0" * 1024
+    ratio = compression_policy.get_sample_ratio("", sample=sample)
+    assert compression_policy.fast_sample_ratio < ratio < compression_policy.max_sample_ratio
+
+    assert compression_policy.decide("data.bin", len(sample), level=9, sample=sample) == (
+        True, compression_policy.fast_level, "low_ratio")
+
+
+@pytest.mark.parametrize("adaptive_compression", [True, False])
+def test_random_data_is_stored_in_zip(tmp_path, source_tree, adaptive_compression):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+
+    info_dict = backup_tool.perform_backup(src=source_tree, dst=dst, adaptive_compression=adaptive_compression)
+
+    with zipfile.ZipFile(os.path.join(dst, "docs.zip")) as zf:
+        compress_types = {os.path.basename(info.filename): info.compress_type for info in zf.infolist()
+                          if not info.is_dir()}
+    assert compress_types["a.txt"] == zipfile.ZIP_DEFLATED
+    expected = zipfile.ZIP_STORED if adaptive_compression else zipfile.ZIP_DEFLATED
+    assert compress_types["b.bin"] == expected
+    if adaptive_compression:
+        assert info_dict["metrics"]["compression_policy"]["bin"]["reasons"] == {"incompressible": 1}
+    assert set(backup_tool.verify_backup(dst).values()) == {"ok"}
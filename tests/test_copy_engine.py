@@ -0,0 +1,62 @@
+"""
+Copies of copy_engine with every method and the copy engine in uncompressed backups
+"""
+
+import os
+
+import pytest
+
+import backup_tool
+import copy_engine
+from conftest import write_file, read_tree
+
+
+@pytest.mark.parametrize("method", copy_engine.copy_methods)
+def test_every_method_copies_content_and_mtime(tmp_path, method):
+    src, dst = str(tmp_path / "src.bin"), str(tmp_path / "dst.bin")
+    data = os.urandom(300_000)
+    write_file(src, data)
+    os.utime(src, ns=(1_000_000_000, 2_000_000_000))
+
+    used_method = copy_engine.copy_file(src, dst, method=method)
+
+    assert used_method in copy_engine.copy_methods[1:]
+    with open(dst, "rb") as f:
+        assert f.read() == data
+    assert os.stat(dst).st_mtime_ns == 2_000_000_000
+
+
+def test_sparse_file_keeps_size_and_content(tmp_path):
+    src, dst = str(tmp_path / "sparse.bin"), str(tmp_path / "copy.bin")
+    with open(src, "wb") as f:
+        f.write(b"start")
+        f.seek(8 * 1024 * 1024)
+        f.write(b"middle")
+        # the end of the file is a hole
+        f.truncate(16 * 1024 * 1024)
+
+    copy_engine.copy_file(src, dst, method="copy_file_range")
+
+    with open(src, "rb") as f_src, open(dst, "rb") as f_dst:
+        assert f_src.read() == f_dst.read()
+
+
+def test_unknown_method(tmp_path):
+    with pytest.raises(ValueError):
+        copy_engine.copy_file(str(tmp_path / "a"), str(tmp_path / "b"), method="rsync")
+
+
+def test_copy_tree_and_backup_with_copy_engine(tmp_path, source_tree):
+    used_methods = copy_engine.copy_tree(source_tree, str(tmp_path / "copy"), scan=backup_tool.scan_item(source_tree))
+    assert sum(used_methods.values()) == 5
+    assert read_tree(str(tmp_path / "copy")) == read_tree(source_tree)
+
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+    info_dict = backup_tool.perform_backup(src=source_tree, dst=dst, compression="SINGLE_PASS_COPY",
+                                           copy_method="auto")
+    os.makedirs(str(tmp_path / "reference"))
+    reference = backup_tool.perform_backup(src=source_tree, dst=str(tmp_path / "reference"),
+                                           compression="SINGLE_PASS_COPY")
+    assert info_dict["found_folders"] == reference["found_folders"]
+    assert set(backup_tool.verify_backup(dst).values()) == {"ok"}
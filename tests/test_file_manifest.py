@@ -0,0 +1,52 @@
+"""
+Binary file manifest of file_manifest
+"""
+
+import hashlib
+import concurrent.futures
+
+import pytest
+
+import file_manifest
+
+
+def get_entries(count: int):
+    entries = []
+    for i in range(count):
+        hash = hashlib.md5(str(i).encode()).hexdigest() if i % 7 else None
+        entries.append((f"dir_{i % 13}/file_{i:05d}.txt", i * 3, 1_700_000_000_000_000_000 + i, hash))
+    return entries
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_round_trip(tmp_path, compress):
+    path = str(tmp_path / f"test{file_manifest.manifest_ending}")
+    entries = get_entries(3 * file_manifest.block_entries + 5)
+    file_manifest.write_manifest(path, entries, hash_func="md5", compress=compress)
+
+    reader = file_manifest.ManifestReader(path)
+
+    assert len(reader) == len(entries)
+    assert reader.hash_func == "md5"
+    assert list(reader) == sorted(entries)
+    for entry in entries[::97]:
+        assert reader.lookup(entry[0]) == entry[1:]
+    assert reader.lookup("dir_0/missing.txt") is None
+    assert list(reader.iter_prefix("dir_5/")) == sorted(entry for entry in entries if entry[0].startswith("dir_5/"))
+
+
+def test_lookups_from_parallel_threads(tmp_path):
+    path = str(tmp_path / f"test{file_manifest.manifest_ending}")
+    entries = get_entries(4 * file_manifest.block_entries)
+    file_manifest.write_manifest(path, entries)
+    reader = file_manifest.ManifestReader(path)
+    expected = {entry[0]: entry[1:] for entry in entries}
+
+    def lookup_all(offset):
+        # every thread jumps between the blocks, so the cached block of the reader is replaced all the time
+        paths = list(expected)[offset::29]
+        return [path for path in paths if reader.lookup(path) != expected[path]]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=7) as executor:
+        wrong = [path for result in executor.map(lookup_all, range(7)) for path in result]
+    assert wrong == []
@@ -0,0 +1,79 @@
+"""
+Stat-tree fingerprints of scan_item and the change detection built on them
+"""
+
+import os
+
+import backup_tool
+import hash_cache
+from conftest import write_file
+
+
+def get_fingerprints(path: str):
+    return backup_tool.scan_item(path)["dir_fingerprints"]
+
+
+def test_changes_propagate_to_parents_only(source_tree):
+    docs = os.path.join(source_tree, "docs")
+    before = get_fingerprints(docs)
+    assert get_fingerprints(docs) == before
+
+    path = os.path.join(docs, "sub", "b.bin")
+    os.utime(path, ns=(1, os.stat(path).st_mtime_ns + 1))
+    after = get_fingerprints(docs)
+
+    assert after["sub"] != before["sub"]
+    assert after[""] != before[""]
+
+
+def test_rename_and_delete_of_old_files_are_detected(source_tree):
+    docs = os.path.join(source_tree, "docs")
+    before = get_fingerprints(docs)[""]
+
+    # neither changes the newest mtime of the folder
+    os.rename(os.path.join(docs, "a.txt"), os.path.join(docs, "renamed.txt"))
+    renamed = get_fingerprints(docs)[""]
+    os.remove(os.path.join(docs, "empty.txt"))
+    deleted = get_fingerprints(docs)[""]
+
+    assert len({before, renamed, deleted}) == 3
+
+
+def test_incremental_backup_after_rename(tmp_path, source_tree):
+    backup_path = str(tmp_path / "backups")
+    os.makedirs(os.path.join(backup_path, "b1"))
+    info_1 = backup_tool.perform_backup(src=source_tree, dst=os.path.join(backup_path, "b1"))
+    os.rename(os.path.join(source_tree, "docs", "a.txt"), os.path.join(source_tree, "docs", "renamed.txt"))
+
+    os.makedirs(os.path.join(backup_path, "b2"))
+    reference_dict = backup_tool.get_reference_info_dict(backup_path, info_1, "incremental")
+    info_2 = backup_tool.perform_backup(src=source_tree, dst=os.path.join(backup_path, "b2"), strategy="incremental",
+                                        reference_dict=reference_dict)
+
+    references = {item_info["folder_name"]: item_info.get("folder_backup_reference")
+                  for item_info in info_2["found_folders"]}
+    assert references == {"docs": None, "code": "b1"}
+
+
+def test_only_changed_folders_are_hashed(tmp_path, source_tree, monkeypatch):
+    docs = os.path.join(source_tree, "docs")
+    write_file(os.path.join(docs, "other", "c.txt"), b"untouched folder")
+    cache = hash_cache.open_hash_cache(str(tmp_path / "cache"))
+    checksum = backup_tool.build_checksum_of_directory(docs, hash_func="md5", cache=cache)
+    hashed = []
+    build_hashes = backup_tool.build_hashes_of_scanned_files
+
+    def recording_build_hashes(paths, *args, **kwargs):
+        hashed.extend(path for path, _ in paths)
+        return build_hashes(paths, *args, **kwargs)
+
+    monkeypatch.setattr(backup_tool, "build_hashes_of_scanned_files", recording_build_hashes)
+    write_file(os.path.join(docs, "sub", "new.txt"), b"new file")
+    changed = backup_tool.build_checksum_of_directory(docs, hash_func="md5", cache=cache)
+    hash_cache.close_hash_cache(cache)
+
+    assert changed != checksum
+    # the changed folder and its parents are looked at, the untouched sibling folder not
+    assert sorted(os.path.relpath(path, docs) for path in hashed) == [
+        "a.txt", "empty.txt", os.path.join("sub", "b.bin"), os.path.join("sub", "new.txt")]
+    assert changed == backup_tool.build_checksum_of_directory(docs, hash_func="md5")
@@ -0,0 +1,82 @@
+"""
+Persistent hash cache keyed by inode, size and mtime (see hash_cache)
+"""
+
+import os
+import hashlib
+
+import pytest
+
+import backup_tool
+import hash_cache
+import hash_functions
+from conftest import write_file
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = hash_cache.open_hash_cache(str(tmp_path / "cache"))
+    yield cache
+    hash_cache.close_hash_cache(cache)
+
+
+@pytest.fixture
+def hashed_files(monkeypatch):
+    hashed = []
+    hash_file = hash_functions.hash_file
+
+    def counting_hash_file(path, *args, **kwargs):
+        hashed.append(path)
+        return hash_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(hash_functions, "hash_file", counting_hash_file)
+    return hashed
+
+
+def test_file_is_only_read_if_changed(tmp_path, cache, hashed_files):
+    path = str(tmp_path / "data.txt")
+    write_file(path, b"first version")
+
+    first = backup_tool.build_hash_of_file(path, hash_func="md5", cache=cache)
+    second = backup_tool.build_hash_of_file(path, hash_func="md5", cache=cache)
+    assert first == second == hashlib.md5(b"first version").hexdigest()
+    assert len(hashed_files) == 1
+
+    write_file(path, b"second version")
+    os.utime(path, ns=(1, 1))
+    assert backup_tool.build_hash_of_file(path, hash_func="md5", cache=cache) == \
+        hashlib.md5(b"second version").hexdigest()
+    assert len(hashed_files) == 2
+    # another algorithm has its own entry
+    backup_tool.build_hash_of_file(path, hash_func="sha256", cache=cache)
+    assert len(hashed_files) == 3
+
+
+def test_cache_survives_reopening(tmp_path, source_tree, hashed_files):
+    folder = os.path.join(source_tree, "docs")
+    cache = hash_cache.open_hash_cache(str(tmp_path / "cache"))
+    checksum = backup_tool.build_checksum_of_directory(folder, hash_func="md5", cache=cache)
+    hash_cache.close_hash_cache(cache)
+    num_hashed = len(hashed_files)
+
+    cache = hash_cache.open_hash_cache(str(tmp_path / "cache"))
+    assert set(hash_cache.get_tree_hashes(cache, os.path.abspath(folder), "md5")) == {"", "sub"}
+    assert backup_tool.build_checksum_of_directory(folder, hash_func="md5", cache=cache) == checksum
+    hash_cache.close_hash_cache(cache)
+
+    assert len(hashed_files) == num_hashed
+    assert checksum == backup_tool.build_checksum_of_directory(folder, hash_func="md5")
+
+
+def test_deleted_files_are_evicted(tmp_path, cache):
+    root = str(tmp_path / "src")
+    for name in ["a.txt", "b.txt"]:
+        write_file(os.path.join(root, name), name.encode())
+        backup_tool.build_hash_of_file(os.path.join(root, name), hash_func="md5", cache=cache)
+
+    num_evicted = hash_cache.evict_deleted_files(cache, root, {os.path.join(root, "a.txt")})
+
+    assert num_evicted == 1
+    stat = os.stat(os.path.join(root, "a.txt"))
+    assert hash_cache.get_cached_hash(cache, os.path.join(root, "a.txt"), stat.st_ino, stat.st_size,
+                                      stat.st_mtime_ns, "md5") == hashlib.md5(b"a.txt").hexdigest()
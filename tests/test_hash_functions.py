@@ -0,0 +1,55 @@
+"""
+Hash algorithms of hash_functions and the hash algorithm recorded per backup
+"""
+
+import os
+import hashlib
+import importlib.util
+
+import pytest
+
+import backup_tool
+import hash_functions
+from conftest import write_file
+
+
+@pytest.mark.parametrize("hash_func", hash_functions.hashlib_functions)
+def test_hash_file_matches_hashlib(tmp_path, hash_func):
+    path = str(tmp_path / "data.bin")
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    write_file(path, data)
+    assert hash_functions.hash_file(path, hash_func=hash_func, buffer_size=64 * 1024) == \
+        hashlib.new(hash_func, data).hexdigest()
+
+
+def test_optional_packages_are_looked_up_once(tmp_path, monkeypatch):
+    calls = []
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: calls.append(name) or find_spec(name))
+    monkeypatch.setattr(hash_functions, "_available_functions", None)
+    path = str(tmp_path / "data.txt")
+    write_file(path, b"data")
+
+    for _ in range(100):
+        backup_tool.build_hash_of_file(path, hash_func="sha256")
+
+    assert len(calls) == len(hash_functions.optional_functions)
+    assert backup_tool.build_hash_of_file(path, hash_func="unknown") is None
+
+
+def test_hash_func_is_recorded_per_backup(tmp_path, source_tree):
+    backup_path = tmp_path / "backups"
+    dst_1, dst_2 = str(backup_path / "b1"), str(backup_path / "b2")
+    os.makedirs(dst_1)
+    os.makedirs(dst_2)
+
+    info_1 = backup_tool.perform_backup(src=source_tree, dst=dst_1, hash_func="blake2b")
+    info_2 = backup_tool.perform_backup(src=source_tree, dst=dst_2, strategy="incremental", reference_dict=info_1,
+                                        hash_func="sha256")
+
+    assert info_1["hash_func"] == "blake2b"
+    assert info_2["hash_func"] == "sha256"
+    # another algorithm than the reference backup --> full backup
+    assert info_2["strategy"] == "full"
+    assert set(backup_tool.verify_backup(dst_1).values()) == {"ok"}
+    assert set(backup_tool.verify_backup(dst_2).values()) == {"ok"}
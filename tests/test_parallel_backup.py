@@ -0,0 +1,74 @@
+"""
+Rows and top-level items processed in parallel (see run_backup_instructions and backup_items_from_src_to_dst)
+"""
+
+import os
+import time
+import threading
+
+import backup_tool
+
+
+def get_hashes(info_dict: dict):
+    return {item_info[f"{prefix}_name"]: item_info[f"{prefix}_hash"]
+            for prefix in ["file", "folder"] for item_info in info_dict[f"found_{prefix}s"]}
+
+
+def test_parallel_items_give_the_same_backup(tmp_path, source_tree):
+    dst_serial, dst_parallel = str(tmp_path / "serial" / "b1"), str(tmp_path / "parallel" / "b1")
+    os.makedirs(dst_serial)
+    os.makedirs(dst_parallel)
+
+    serial = backup_tool.perform_backup(src=source_tree, dst=dst_serial, max_workers=1)
+    parallel = backup_tool.perform_backup(src=source_tree, dst=dst_parallel, max_workers=4, device_limit=4)
+
+    assert get_hashes(serial) == get_hashes(parallel)
+    assert set(backup_tool.verify_backup(dst_parallel).values()) == {"ok"}
+
+
+def test_rows_of_a_destination_run_one_after_another(monkeypatch):
+    lock = threading.Lock()
+    running, events, registries = set(), [], []
+
+    def fake_run(idx, row, device_semaphores=None):
+        registries.append(device_semaphores)
+        with lock:
+            running.add(idx)
+            events.append(("start", idx, frozenset(running)))
+        time.sleep(0.1)
+        with lock:
+            running.discard(idx)
+
+    monkeypatch.setattr(backup_tool, "run_backup_instruction", fake_run)
+    rows = [{"destination": "/backups/a"}, {"destination": "/backups/b"}, {"destination": "/backups/a/"},
+            {"destination": "/backups/c"}]
+
+    backup_tool.run_backup_instructions(rows, max_workers=3, order=[3])
+
+    starts = [idx for _, idx, _ in events]
+    assert sorted(starts) == [0, 1, 2, 3]
+    assert starts.index(0) < starts.index(2)
+    for _, idx, running_rows in events:
+        # the rows 0 and 2 have the same destination
+        assert not {0, 2} <= running_rows
+    # rows of different destinations overlap
+    assert any(len(running_rows) > 1 for _, _, running_rows in events)
+    # all rows of the run share one registry of device semaphores
+    assert len({id(registry) for registry in registries}) == 1
+
+
+def test_device_semaphores_per_limit(tmp_path):
+    registry = backup_tool.new_device_semaphores()
+    paths = [str(tmp_path), str(tmp_path)]
+
+    one = backup_tool.get_device_semaphores(paths, limit=1, registry=registry)
+    two = backup_tool.get_device_semaphores(paths, limit=2, registry=registry)
+
+    assert len(one) == len(two) == 1
+    assert one == backup_tool.get_device_semaphores(paths, limit=1, registry=registry)
+    # a row with another limit does not get the semaphore of the first row
+    assert one[0] is not two[0]
+    assert two[0].acquire(blocking=False) and two[0].acquire(blocking=False)
+    assert not two[0].acquire(blocking=False)
+    # a new run starts with new semaphores
+    assert backup_tool.get_device_semaphores(paths, limit=1, registry=backup_tool.new_device_semaphores()) != one
@@ -0,0 +1,52 @@
+"""
+Compressed tar archives of parallel_compression and the compression settings of the zip archives
+"""
+
+import os
+import zipfile
+
+import pytest
+
+import backup_tool
+import parallel_compression
+from conftest import write_file
+
+
+@pytest.mark.parametrize("codec", ["gz", "xz"])
+def test_tar_backup_verify_restore(tmp_path, source_tree, codec):
+    os.symlink("a.txt", os.path.join(source_tree, "docs", "link.txt"))
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+
+    backup_tool.perform_backup(src=source_tree, dst=dst, compression=codec)
+
+    assert os.path.isfile(os.path.join(dst, f"docs.tar.{codec}"))
+    assert set(backup_tool.verify_backup(dst).values()) == {"ok"}
+    restored = str(tmp_path / "restored")
+    backup_tool.restore_backup(dst, restored)
+    for rel_path in ["docs/a.txt", "docs/link.txt", "docs/sub/b.bin", "docs/empty.txt", "code/main.py"]:
+        with open(os.path.join(source_tree, rel_path), "rb") as f_src, \
+                open(os.path.join(restored, rel_path), "rb") as f_restored:
+            assert f_src.read() == f_restored.read()
+
+
+def test_zip_compression_level_is_used(tmp_path):
+    src_file = str(tmp_path / "words.txt")
+    write_file(src_file, b" ".join(b"word%d" % (i % 997) for i in range(50000)))
+    sizes = {}
+    for level in [0, 9]:
+        with zipfile.ZipFile(str(tmp_path / f"level_{level}.zip"), mode="w") as zip_file:
+            backup_tool.write_file_to_zip(zip_file, src_file, "words.txt", compression_level=level)
+            sizes[level] = zip_file.getinfo("words.txt").compress_size
+    assert sizes[9] < os.path.getsize(src_file) < sizes[0]
+
+
+def test_missing_codec_package_skips_row(tmp_path, source_tree, monkeypatch):
+    monkeypatch.setattr(parallel_compression, "get_available_codecs", lambda: ["gz", "xz"])
+    destination = str(tmp_path / "backups")
+    row = {"activate": True, "source": source_tree, "destination": destination, "strategy": "full",
+           "compression": "zstd", "shutdown": False}
+
+    backup_tool.run_backup_instruction(0, row)
+
+    assert not os.path.exists(destination)
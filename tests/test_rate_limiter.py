@@ -0,0 +1,97 @@
+"""
+Schedules, token buckets and priorities of rate_limiter
+"""
+
+import os
+import threading
+from datetime import datetime
+
+import pytest
+
+import backup_tool
+import rate_limiter
+
+
+class FakeTime:
+    """
+    Clock that only moves when the token bucket sleeps
+    """
+
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_parse_schedule_and_rate():
+    schedule = rate_limiter.parse_schedule("08:00-18:00=20, 22:00-06:00=0, 200", scale=1e6)
+
+    assert schedule == [(480, 1080, 20e6), (1320, 360, 0), (None, None, 200e6)]
+    assert rate_limiter.get_rate(schedule, datetime(2026, 10, 18, 12, 0)) == 20e6
+    assert rate_limiter.get_rate(schedule, datetime(2026, 10, 18, 18, 0)) == 200e6
+    # the window wraps midnight
+    assert rate_limiter.get_rate(schedule, datetime(2026, 10, 18, 23, 30)) == 0
+    assert rate_limiter.get_rate(schedule, datetime(2026, 10, 18, 5, 59)) == 0
+    assert rate_limiter.parse_schedule(None) == rate_limiter.parse_schedule(" ") == rate_limiter.parse_schedule(0) == []
+    assert rate_limiter.create_limiter(max_read_mb_s="", max_write_mb_s=None, max_file_ops="0") is None
+
+
+def test_token_bucket_pays_debt_afterwards(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    bucket = rate_limiter.TokenBucket(rate_limiter.parse_schedule(100), "test")
+
+    assert bucket.consume(50) == 0.5
+    assert bucket.consume(300) == 3.0
+    # idle time saves up at most burst_seconds of tokens
+    clock.now += 10
+    assert bucket.consume(100) == 0.0
+    assert bucket.consume(50) == 0.5
+    assert clock.slept == [0.5, 3.0, 0.5]
+    assert bucket.waited_s == 4.0
+
+
+def test_limiter_counts_reads_writes_and_file_ops(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    limiter = rate_limiter.create_limiter(max_read_mb_s=1, max_write_mb_s="00:00-12:00=2,2", max_file_ops=10)
+    written = []
+
+    limiter.read(500_000)
+    # the buckets of writes and file ops filled up while the read waited
+    limiter.limit_write(written.append)(b"x" * 2_500_000)
+    limiter.file_op(20)
+
+    assert written == [b"x" * 2_500_000]
+    assert limiter.get_stats() == {"read_bytes": 0.5, "write_bytes": 0.75, "file_ops": 1.0}
+
+
+def test_run_with_priority():
+    def get_nice():
+        return os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+
+    nice = get_nice()
+    assert rate_limiter.run_with_priority(get_nice, nice=5) == min(nice + 5, 19)
+    # the priority of the calling thread is unchanged
+    assert get_nice() == nice
+    with pytest.raises(ValueError):
+        rate_limiter.run_with_priority(get_nice, io_class="fastest")
+
+
+def test_throttled_backup(tmp_path, source_tree):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+    limiter = rate_limiter.create_limiter(max_read_mb_s=1, max_file_ops=1000)
+
+    info_dict = backup_tool.perform_backup(src=source_tree, dst=dst, limiter=limiter)
+
+    # about 0.26 MB read at 1 MB/s from an empty bucket
+    assert limiter.get_stats()["read_bytes"] > 0.1
+    assert set(backup_tool.verify_backup(dst).values()) == {"ok"}
+    assert len(info_dict["found_files"]) == 1
@@ -0,0 +1,40 @@
+"""
+Single scan of an item and the hashes built from it (see scan_item of backup_tool)
+"""
+
+import os
+import hashlib
+
+import backup_tool
+
+
+def test_scan_of_folder(source_tree):
+    scan = backup_tool.scan_item(os.path.join(source_tree, "docs"))
+
+    assert scan["is_dir"]
+    assert scan["dirs"] == ["sub"]
+    assert [f[0] for f in scan["files"]] == ["a.txt", "empty.txt", os.path.join("sub", "b.bin")]
+    assert scan["size"] == sum(f[1] for f in scan["files"]) == 6 * 5000 + 200 * 1024
+    assert all(f[3] == os.stat(os.path.join(source_tree, "docs", f[0])).st_ino for f in scan["files"])
+
+
+def test_scan_of_file(source_tree):
+    scan = backup_tool.scan_item(os.path.join(source_tree, "top.txt"))
+
+    assert not scan["is_dir"]
+    assert scan["files"][0][:2] == ("top.txt", 1500)
+    assert scan["size"] == 1500
+
+
+def test_single_pass_hash_matches_checksum(tmp_path, source_tree):
+    src = os.path.join(source_tree, "docs")
+    scan = backup_tool.scan_item(src)
+
+    zip_hash = backup_tool.backup_folder_single_pass(src=src, dst=str(tmp_path / "docs"), scan=scan, hash_func="md5")
+    copy_hash = backup_tool.backup_folder_single_pass(src=src, dst=str(tmp_path / "copy"), scan=scan,
+                                                      compression=False, hash_func="md5")
+
+    assert zip_hash == copy_hash == backup_tool.build_checksum_of_directory(src, hash_func="md5")
+    with open(os.path.join(src, "a.txt"), "rb") as f:
+        assert backup_tool.build_hash_of_file(os.path.join(str(tmp_path / "copy"), "a.txt"), hash_func="md5") == \
+            hashlib.md5(f.read()).hexdigest()
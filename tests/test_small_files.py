@@ -0,0 +1,74 @@
+"""
+Batched reads and hashes of small files (see small_files) and backups of trees of tiny files
+"""
+
+import os
+import hashlib
+import threading
+
+import pytest
+
+import backup_tool
+import small_files
+from conftest import write_file, read_tree
+
+
+@pytest.fixture
+def tiny_files(tmp_path):
+    """
+    Folder with 300 tiny files of different sizes and two bigger files between them
+    """
+    src = tmp_path / "src"
+    for i in range(300):
+        write_file(str(src / "tiny" / f"{i // 100}" / f"file_{i:03d}.txt"), f"content of file {i}\n".encode() * i)
+    write_file(str(src / "tiny" / "1" / "file_150_big.bin"), os.urandom(small_files.small_file_size + 1))
+    write_file(str(src / "tiny" / "2" / "file_250_big.bin"), os.urandom(600 * 1024))
+    return str(src)
+
+
+def test_groups_keep_the_order():
+    files = [("a", 10, 0, 1), ("b", 20, 0, 2), ("c", 300, 0, 3), ("d", 5, 0, 4)]
+
+    groups = small_files.group_files(files, max_size=100)
+
+    assert groups == [(True, files[:2]), (False, files[2:3]), (True, files[3:])]
+
+
+def test_read_in_batches(tiny_files, monkeypatch):
+    monkeypatch.setattr(small_files, "batch_files", 16)
+    scan = backup_tool.scan_item(tiny_files)
+    paths = [os.path.join(tiny_files, f[0]) for f in scan["files"]]
+    threads = set()
+
+    def process(path, data):
+        threads.add(threading.current_thread().name)
+        return len(data)
+
+    results = list(small_files.read_small_files(paths, [f[1] for f in scan["files"]], hash_func="sha1",
+                                                process=process, workers=3))
+
+    assert len(results) == len(paths)
+    for path, (data, hash, stat, size) in zip(paths, results):
+        with open(path, "rb") as f:
+            content = f.read()
+        assert data == content
+        assert hash == hashlib.sha1(content).hexdigest()
+        assert stat.st_size == size == len(content)
+    assert all(name.startswith("small files") for name in threads)
+    assert small_files.hash_small_files(paths, [f[1] for f in scan["files"]]) == [
+        hashlib.md5(data).hexdigest() for data, _, _, _ in results]
+
+
+@pytest.mark.parametrize("compression", ["SINGLE_PASS", "SINGLE_PASS_COPY"])
+def test_backup_of_tiny_files(tmp_path, tiny_files, compression):
+    dst = str(tmp_path / "backups" / "b1")
+    os.makedirs(dst)
+
+    info_dict = backup_tool.perform_backup(src=tiny_files, dst=dst, compression=compression)
+
+    assert info_dict["found_folders"][0]["folder_hash"] == backup_tool.build_checksum_of_directory(
+        os.path.join(tiny_files, "tiny"), hash_func="md5")
+    assert set(backup_tool.verify_backup(dst).values()) == {"ok"}
+    restored = str(tmp_path / "restored")
+    backup_tool.restore_backup(dst, restored)
+    assert read_tree(restored) == read_tree(tiny_files)
@@ -0,0 +1,57 @@
+"""
+Snapshots of uncompressed backups with hard links to the previous backup (strategy "snapshot")
+"""
+
+import os
+
+import pytest
+
+import backup_tool
+from conftest import write_file, read_tree
+
+
+def do_backup(backup_path: str, name: str, source: str, strategy: str, latest_info_dict: dict):
+    dst = os.path.join(backup_path, name)
+    os.makedirs(dst)
+    reference_dict = backup_tool.get_reference_info_dict(backup_path, latest_info_dict, strategy)
+    return backup_tool.perform_backup(src=source, dst=dst, strategy=strategy, reference_dict=reference_dict,
+                                      compression="SINGLE_PASS_COPY")
+
+
+def test_unchanged_files_are_linked(tmp_path, source_tree):
+    backup_path = str(tmp_path / "backups")
+    info_1 = do_backup(backup_path, "b1", source_tree, "full", None)
+    write_file(os.path.join(source_tree, "docs", "a.txt"), b"changed in b2\n")
+    info_2 = do_backup(backup_path, "b2", source_tree, "snapshot", info_1)
+
+    assert info_2["strategy"] == "snapshot"
+    assert info_2["reference_backup"] == "b1"
+    b1, b2 = os.path.join(backup_path, "b1"), os.path.join(backup_path, "b2")
+    for rel_path in ["top.txt", os.path.join("docs", "sub", "b.bin"), os.path.join("code", "main.py")]:
+        assert os.stat(os.path.join(b1, rel_path)).st_ino == os.stat(os.path.join(b2, rel_path)).st_ino
+    assert os.stat(os.path.join(b1, "docs", "a.txt")).st_ino != os.stat(os.path.join(b2, "docs", "a.txt")).st_ino
+    with open(os.path.join(b1, "docs", "a.txt"), "rb") as f:
+        assert f.read() == b"alpha " * 5000
+
+    # every snapshot is complete on its own
+    assert set(backup_tool.verify_backup(b2).values()) == {"ok"}
+    restored = str(tmp_path / "restored")
+    backup_tool.restore_backup(b2, restored)
+    assert read_tree(restored) == read_tree(source_tree)
+
+
+@pytest.mark.parametrize("compression", ["zip", "gz", "chunks"])
+def test_snapshot_of_compressed_backup_is_rejected(tmp_path, source_tree, compression):
+    destination = str(tmp_path / "backups")
+    row = {"activate": True, "source": source_tree, "destination": destination, "strategy": "snapshot",
+           "compression": compression, "shutdown": False}
+
+    backup_tool.run_backup_instruction(0, row)
+
+    # rejected when the row is read, not downgraded to a full backup
+    assert not os.path.exists(destination)
+    dst = str(tmp_path / "b1")
+    os.makedirs(dst)
+    with pytest.raises(ValueError):
+        backup_tool.perform_backup(src=source_tree, dst=dst, strategy="snapshot",
+                                   compression=backup_tool.compression_methods[compression])
@@ -0,0 +1,61 @@
+"""
+Import of backup_tool without side effects, lazy optional modules and the instructions csv
+"""
+
+import os
+import sys
+import json
+import logging
+import subprocess
+
+import backup_tool
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_has_no_side_effects(tmp_path):
+    code = ("import sys, json, logging; import backup_tool; "
+            "print(json.dumps({'modules': sorted(sys.modules), 'handlers': len(logging.getLogger().handlers)}))")
+    env = dict(os.environ, PYTHONPATH=repo_path)
+
+    result = subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path), env=env, capture_output=True,
+                            text=True, check=True)
+
+    imported = json.loads(result.stdout)
+    assert os.listdir(str(tmp_path)) == []
+    assert imported["handlers"] == 0
+    for module in ["pandas", "checksumdir", "numpy", "zstandard", "lz4"]:
+        assert module not in imported["modules"]
+
+
+def test_setup_logging_creates_log_file(tmp_path):
+    logger = logging.getLogger()
+    handlers, level = list(logger.handlers), logger.level
+    try:
+        log_path = backup_tool.setup_logging(str(tmp_path / "logs"))
+        logger.debug("first line")
+    finally:
+        for handler in logger.handlers[len(handlers):]:
+            handler.close()
+            logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    assert os.path.dirname(log_path) == str(tmp_path / "logs")
+    with open(log_path) as f:
+        assert "first line" in f.read()
+
+
+def test_instructions_are_converted(tmp_path):
+    with open(str(tmp_path / "instructions.csv"), "w", encoding="utf-8-sig") as f:
+        f.write("activate;source;destination;strategy;max_workers;compression\n")
+        f.write("True;data/src;data/backup;full;4;\n")
+        f.write("false;data/src;data/backup;incremental;;zstd\n")
+
+    rows = backup_tool.read_backup_instructions(str(tmp_path), "instructions.csv")
+
+    assert rows == [
+        {"activate": True, "source": "data/src", "destination": "data/backup", "strategy": "full", "max_workers": 4,
+         "compression": None},
+        {"activate": False, "source": "data/src", "destination": "data/backup", "strategy": "incremental",
+         "max_workers": None, "compression": "zstd"}]
+    assert backup_tool.read_backup_instructions(str(tmp_path), "missing.csv") is None
@@ -0,0 +1,101 @@
+"""
+Streaming of files through the bounded buffer pool of streaming_io
+"""
+
+import io
+import os
+import hashlib
+
+import pytest
+
+import streaming_io
+import benchmark_backup_tool
+from conftest import write_file
+
+
+@pytest.fixture
+def small_pool(monkeypatch):
+    """
+    Pool of a few small buffers, so the test files need many of them and the pipeline is used
+    """
+    pool = streaming_io.BufferPool(4, 64 * 1024)
+    monkeypatch.setattr(streaming_io, "_pool", pool)
+    monkeypatch.setattr(streaming_io, "pipeline_min_size", 256 * 1024)
+    return pool
+
+
+@pytest.mark.parametrize("read_ahead", [0, 2])
+def test_stream_gives_content_hash_and_size(tmp_path, small_pool, read_ahead):
+    path = str(tmp_path / "big.bin")
+    data = os.urandom(1024 * 1024 + 123)
+    write_file(path, data)
+    out = io.BytesIO()
+
+    hash, size = streaming_io.stream_file(path, out.write, hash_func="sha256", read_ahead=read_ahead)
+
+    assert out.getvalue() == data
+    assert hash == hashlib.sha256(data).hexdigest()
+    assert size == len(data)
+    # the memory is bounded by the pool and every buffer is back in the pool
+    assert small_pool.created <= small_pool.num_buffers
+    assert small_pool.free.qsize() == small_pool.created
+
+
+def test_buffers_are_given_back_after_write_error(tmp_path, small_pool):
+    path = str(tmp_path / "big.bin")
+    write_file(path, os.urandom(1024 * 1024))
+    written = []
+
+    def failing_write(data):
+        written.append(len(data))
+        if len(written) == 3:
+            raise OSError("disk full")
+
+    with pytest.raises(OSError, match="disk full"):
+        streaming_io.stream_file(path, failing_write, read_ahead=2)
+
+    assert small_pool.free.qsize() == small_pool.created
+
+
+def test_progress_of_big_files(tmp_path, small_pool, monkeypatch):
+    monkeypatch.setattr(streaming_io, "progress_interval", 256 * 1024)
+    path = str(tmp_path / "big.bin")
+    write_file(path, os.urandom(1024 * 1024))
+    progress = []
+
+    streaming_io.stream_file(path, lambda data: None, progress=lambda *args: progress.append(args))
+
+    assert [done for _, done, _ in progress] == [256 * 1024, 512 * 1024, 768 * 1024, 1024 * 1024]
+    assert {total for _, _, total in progress} == {1024 * 1024}
+
+
+def test_write_behind_to_slow_destination(tmp_path, small_pool):
+    path = str(tmp_path / "big.bin")
+    data = os.urandom(1024 * 1024)
+    write_file(path, data)
+    out = io.BytesIO()
+    writer = benchmark_backup_tool.ThrottledWriter(out, latency_s=0.001, bytes_per_s=1e9)
+
+    hash, size = streaming_io.stream_file(path, writer.write, hash_func="md5", write_behind=2)
+
+    assert out.getvalue() == data
+    assert (hash, size) == (hashlib.md5(data).hexdigest(), len(data))
+    assert small_pool.free.qsize() == small_pool.created
+
+
+def test_write_behind_raises_first_write_error(tmp_path, small_pool):
+    path = str(tmp_path / "big.bin")
+    write_file(path, os.urandom(1024 * 1024))
+    written = []
+
+    def failing_write(data):
+        written.append(len(data))
+        if len(written) == 2:
+            raise OSError("share is gone")
+
+    with pytest.raises(OSError, match="share is gone"):
+        streaming_io.stream_file(path, failing_write, write_behind=2)
+
+    # no writes after the error and all buffers are back in the pool
+    assert len(written) == 2
+    assert small_pool.free.qsize() == small_pool.created